@@ -0,0 +1,64 @@
+from flask import Blueprint, current_app, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from datetime import date, datetime, timedelta
+from src.doctor_stats import daily, doctors_summary, summarize
+
+DEFAULT_DAYS = 30
+
+analytics_bp = Blueprint('analytics', __name__)
+
+def _date_range():
+    """``(start, end, error)`` from the from/to query parameters, the last 30 days by default"""
+    try:
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if 'to' in request.args else date.today()
+        start = (datetime.strptime(request.args['from'], '%Y-%m-%d').date() if 'from' in request.args
+                 else end - timedelta(days=DEFAULT_DAYS - 1))
+    except ValueError:
+        return None, None, 'Invalid date format, use YYYY-MM-DD'
+    if start > end:
+        return None, None, 'from must not be after to'
+    max_days = current_app.config.get('ANALYTICS_MAX_DAYS', 366)
+    if (end - start).days + 1 > max_days:
+        return None, None, f'The range is limited to {max_days} days'
+    return start, end, None
+
+@analytics_bp.route('/analytics/doctors', methods=['GET'])
+@jwt_required()
+def get_doctors_analytics():
+    """Appointments, no-shows and notes per doctor over a date range (doctors only)"""
+    current_user = get_jwt_identity()
+
+    if current_user['type'] != 'doctor':
+        return jsonify({'error': 'Only doctors can view analytics'}), 403
+
+    start, end, error = _date_range()
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify({
+        'from': start,
+        'to': end,
+        'doctors': doctors_summary(start, end)
+    }), 200
+
+@analytics_bp.route('/analytics/doctors/<int:doctor_id>', methods=['GET'])
+@jwt_required()
+def get_doctor_analytics(doctor_id):
+    """One doctor's daily appointments, no-shows and notes over a date range (doctors only)"""
+    current_user = get_jwt_identity()
+
+    if current_user['type'] != 'doctor':
+        return jsonify({'error': 'Only doctors can view analytics'}), 403
+
+    start, end, error = _date_range()
+    if error:
+        return jsonify({'error': error}), 400
+
+    days = daily(doctor_id, start, end)
+    return jsonify({
+        'doctor_id': doctor_id,
+        'from': start,
+        'to': end,
+        'totals': summarize(days),
+        'days': days
+    }), 200
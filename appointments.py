@@ -1,7 +1,17 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime, date, time
+from sqlalchemy.exc import IntegrityError
 from src.models.user import db, Appointment, Doctor, Patient
+from src.fieldsets import all_fields, requested_fields, select_fields, only, write_returning
+from src.idempotency import idempotent
+from src.calendar_feeds import feeds
+from src.db_utils import (
+    etag_response, if_match_versions, insert_ignoring_conflicts, integrity_error_kind,
+    missed_write, run_with_retry, slot_lock, versioned_delete, versioned_update
+)
+
+SLOT_COLUMNS = ['doctor_id', 'appointment_date', 'appointment_time']
 
 appointments_bp = Blueprint('appointments', __name__)
 
@@ -9,11 +19,18 @@ appointments_bp = Blueprint('appointments', __name__)
 @jwt_required()
 def get_doctors():
     """Get list of all doctors for appointment booking"""
+    fields, error = requested_fields('doctors')
+    if error:
+        return jsonify({'error': error}), 400
+    if fields:
+        return jsonify([only(row, fields) for row in select_fields('doctors', fields)]), 200
+    
     doctors = Doctor.query.all()
-    return jsonify([doctor.to_dict() for doctor in doctors]), 200
+    return jsonify(doctors), 200
 
 @appointments_bp.route('/appointments', methods=['POST'])
 @jwt_required()
+@idempotent
 def book_appointment():
     """Book a new appointment (patients only)"""
     current_user = get_jwt_identity()
@@ -34,23 +51,10 @@ def book_appointment():
         appointment_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
         appointment_time = datetime.strptime(data['appointment_time'], '%H:%M').time()
         
-        # Check if doctor exists
-        doctor = Doctor.query.get(data['doctor_id'])
-        if not doctor:
-            return jsonify({'error': 'Doctor not found'}), 404
-        
-        # Check for conflicting appointments
-        existing_appointment = Appointment.query.filter_by(
-            doctor_id=data['doctor_id'],
-            appointment_date=appointment_date,
-            appointment_time=appointment_time
-        ).first()
-        
-        if existing_appointment:
-            return jsonify({'error': 'This time slot is already booked'}), 400
-        
-        # Create new appointment
-        new_appointment = Appointment(
+        # The unique constraint on the slot decides the race: the losing
+        # insert returns no row rather than double-booking. The doctor's
+        # foreign key replaces a separate existence check.
+        statement = insert_ignoring_conflicts(Appointment.__table__, SLOT_COLUMNS).values(
             patient_id=current_user['id'],
             doctor_id=data['doctor_id'],
             appointment_date=appointment_date,
@@ -58,12 +62,26 @@ def book_appointment():
             reason=data.get('reason', '')
         )
         
-        db.session.add(new_appointment)
-        db.session.commit()
+        def insert_appointment():
+            with slot_lock((data['doctor_id'], appointment_date, appointment_time)):
+                try:
+                    appointment = write_returning(statement, 'appointments')
+                except IntegrityError as error:
+                    db.session.rollback()
+                    return None, integrity_error_kind(error)
+                db.session.commit()
+                return appointment, None
+        
+        appointment, error_kind = run_with_retry(insert_appointment)
+        if error_kind == 'foreign_key':
+            return jsonify({'error': 'Doctor not found'}), 404
+        if appointment is None:
+            return jsonify({'error': 'This time slot is already booked'}), 400
+        feeds.appointment_saved(appointment)
         
         return jsonify({
             'message': 'Appointment booked successfully',
-            'appointment': new_appointment.to_dict()
+            'appointment': appointment
         }), 201
         
     except ValueError as e:
@@ -78,14 +96,21 @@ def get_appointments():
     """Get appointments for current user"""
     current_user = get_jwt_identity()
     
+    fields, error = requested_fields('appointments')
+    if error:
+        return jsonify({'error': error}), 400
+    
     if current_user['type'] == 'patient':
-        appointments = Appointment.query.filter_by(patient_id=current_user['id']).all()
+        criterion = Appointment.patient_id == current_user['id']
     elif current_user['type'] == 'doctor':
-        appointments = Appointment.query.filter_by(doctor_id=current_user['id']).all()
+        criterion = Appointment.doctor_id == current_user['id']
     else:
         return jsonify({'error': 'Invalid user type'}), 400
     
-    return jsonify([appointment.to_dict() for appointment in appointments]), 200
+    # The full representation too, so the names come from one joined SELECT
+    fields = fields or all_fields('appointments')
+    rows = select_fields('appointments', fields, criterion)
+    return jsonify([only(row, fields) for row in rows]), 200
 
 @appointments_bp.route('/appointments/<int:appointment_id>', methods=['GET'])
 @jwt_required()
@@ -93,7 +118,16 @@ def get_appointment(appointment_id):
     """Get specific appointment details"""
     current_user = get_jwt_identity()
     
-    appointment = Appointment.query.get(appointment_id)
+    fields, error = requested_fields('appointments')
+    if error:
+        return jsonify({'error': error}), 400
+    
+    if fields:
+        rows = select_fields('appointments', fields, Appointment.appointment_id == appointment_id,
+                             include=('patient_id', 'doctor_id', 'version'))
+        appointment = rows[0] if rows else None
+    else:
+        appointment = Appointment.query.get(appointment_id)
     if not appointment:
         return jsonify({'error': 'Appointment not found'}), 404
     
@@ -103,49 +137,61 @@ def get_appointment(appointment_id):
     elif current_user['type'] == 'doctor' and appointment.doctor_id != current_user['id']:
         return jsonify({'error': 'Access denied'}), 403
     
-    return jsonify(appointment.to_dict()), 200
+    if fields:
+        return etag_response(only(appointment, fields), appointment.version)
+    return etag_response(appointment.to_dict(), appointment.version)
 
 @appointments_bp.route('/appointments/<int:appointment_id>', methods=['PUT'])
 @jwt_required()
 def update_appointment(appointment_id):
-    """Update appointment (patients can update reason, doctors can update all fields)"""
+    """Update appointment (patients can update reason, doctors can update all fields)
+
+    Honours If-Match: the update only applies to the version named by the
+    ETag, and a stale version gets 412.
+    """
     current_user = get_jwt_identity()
-    
-    appointment = Appointment.query.get(appointment_id)
-    if not appointment:
-        return jsonify({'error': 'Appointment not found'}), 404
-    
-    # Check if user has access to this appointment
-    if current_user['type'] == 'patient' and appointment.patient_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
-    elif current_user['type'] == 'doctor' and appointment.doctor_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
-    
     data = request.get_json()
+    values = {}
     
     try:
         # Patients can only update reason
         if current_user['type'] == 'patient':
+            owner = (Appointment.patient_id, current_user['id'])
             if 'reason' in data:
-                appointment.reason = data['reason']
+                values['reason'] = data['reason']
         
         # Doctors can update date, time, and reason
         elif current_user['type'] == 'doctor':
+            owner = (Appointment.doctor_id, current_user['id'])
             if 'appointment_date' in data:
-                appointment.appointment_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
+                values['appointment_date'] = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
             if 'appointment_time' in data:
-                appointment.appointment_time = datetime.strptime(data['appointment_time'], '%H:%M').time()
+                values['appointment_time'] = datetime.strptime(data['appointment_time'], '%H:%M').time()
             if 'reason' in data:
-                appointment.reason = data['reason']
+                values['reason'] = data['reason']
+        else:
+            return jsonify({'error': 'Invalid user type'}), 400
+        
+        key = Appointment.appointment_id == appointment_id
+        statement = versioned_update(Appointment, key, values, owner[0] == owner[1],
+                                     versions=if_match_versions())
+        appointment = write_returning(statement, 'appointments')
+        if appointment is None:
+            return missed_write(Appointment, key, 'Appointment', owner)
         
         db.session.commit()
-        return jsonify({
+        feeds.appointment_saved(appointment)
+        return etag_response({
             'message': 'Appointment updated successfully',
-            'appointment': appointment.to_dict()
-        }), 200
+            'appointment': appointment
+        }, appointment['version'])
         
     except ValueError as e:
         return jsonify({'error': 'Invalid date or time format'}), 400
+    except IntegrityError:
+        # Rescheduled onto a slot the doctor already has booked
+        db.session.rollback()
+        return jsonify({'error': 'This time slot is already booked'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to update appointment'}), 500
@@ -153,22 +199,26 @@ def update_appointment(appointment_id):
 @appointments_bp.route('/appointments/<int:appointment_id>', methods=['DELETE'])
 @jwt_required()
 def cancel_appointment(appointment_id):
-    """Cancel appointment"""
+    """Cancel appointment, honouring If-Match"""
     current_user = get_jwt_identity()
     
-    appointment = Appointment.query.get(appointment_id)
-    if not appointment:
-        return jsonify({'error': 'Appointment not found'}), 404
-    
     # Check if user has access to this appointment
-    if current_user['type'] == 'patient' and appointment.patient_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
-    elif current_user['type'] == 'doctor' and appointment.doctor_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
+    if current_user['type'] == 'patient':
+        owner = (Appointment.patient_id, current_user['id'])
+    elif current_user['type'] == 'doctor':
+        owner = (Appointment.doctor_id, current_user['id'])
+    else:
+        return jsonify({'error': 'Invalid user type'}), 400
     
     try:
-        db.session.delete(appointment)
+        key = Appointment.appointment_id == appointment_id
+        statement = versioned_delete(Appointment, key, owner[0] == owner[1], versions=if_match_versions())
+        deleted = db.session.execute(statement.returning(
+            Appointment.appointment_id, Appointment.patient_id, Appointment.doctor_id)).first()
+        if deleted is None:
+            return missed_write(Appointment, key, 'Appointment', owner)
         db.session.commit()
+        feeds.appointment_removed(*deleted)
         return jsonify({'message': 'Appointment cancelled successfully'}), 200
     except Exception as e:
         db.session.rollback()
@@ -0,0 +1,308 @@
+"""
+ASGI entry point serving the read-heavy endpoints asynchronously.
+
+    uvicorn src.asgi:application --workers 4
+
+GET requests for the routes in ``ASYNC_ROUTES`` run as coroutines on the
+async engine (``src.async_db``). While the database answers, the worker
+holds no thread, so it can keep far more requests in flight than it has
+threads. They run inside a Flask request context with the app's
+before/after-request hooks, so authentication, error responses, JSON
+encoding, security headers and metrics match the sync views. Every other
+request goes to the Flask app as WSGI, run on a bounded thread pool
+(``ASGI_SYNC_THREADS``), with its body streamed to the view as it is read,
+so large uploads are not buffered. Requests sent with
+``Prefer: respond-async`` also go to the Flask app, which queues them as
+jobs (``src.job_queue``).
+
+Set ``ASYNC_READS_ENABLED=0`` to send everything through the sync views.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, jsonify
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from werkzeug.exceptions import ClientDisconnected
+
+from src.main import app
+from src.models.user import Patient, Doctor
+from src.fieldsets import RESOURCES, all_fields, fields_statement, only, requested_fields
+from src.db_utils import etag_response
+from src.routes.gdpr import build_export, export_result, export_statements
+from src.token_revocation import revoked_tokens
+from src import async_db
+
+# Request bodies reach WSGI views in reads of about this size
+STREAM_BUFFER_SIZE = 64 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=app.config.get('ASGI_SYNC_THREADS', 32),
+                               thread_name_prefix='wsgi')
+
+
+def _sync_revocations():
+    with app.app_context():
+        revoked_tokens.sync()
+
+
+async def _current_user():
+    # The blocklist check syncs the revocation list from the database when it
+    # is due; do that on the thread pool so the check itself only reads memory
+    if revoked_tokens.sync_due():
+        await asyncio.get_running_loop().run_in_executor(_executor, _sync_revocations)
+    verify_jwt_in_request()
+    return get_jwt_identity()
+
+
+async def _rows(session, resource_name, fields, *criteria, include=()):
+    result = await session.execute(fields_statement(resource_name, fields, *criteria, include=include))
+    return result.all()
+
+
+async def _records(resource_name, user):
+    """Appointments or notes of the current user, as ``get_appointments``/``get_medical_notes`` return them"""
+    fields, error = requested_fields(resource_name)
+    if error:
+        return jsonify({'error': error}), 400
+
+    model = RESOURCES[resource_name].model
+    if user['type'] == 'patient':
+        criterion = model.patient_id == user['id']
+    elif user['type'] == 'doctor':
+        criterion = model.doctor_id == user['id']
+    else:
+        return jsonify({'error': 'Invalid user type'}), 400
+
+    fields = fields or all_fields(resource_name)
+    async with async_db.session(current_app.config) as session:
+        rows = await _rows(session, resource_name, fields, criterion)
+    return jsonify([only(row, fields) for row in rows]), 200
+
+
+async def get_appointments():
+    return await _records('appointments', await _current_user())
+
+
+async def get_medical_notes():
+    return await _records('medical_notes', await _current_user())
+
+
+async def get_doctors():
+    await _current_user()
+    fields, error = requested_fields('doctors')
+    if error:
+        return jsonify({'error': error}), 400
+
+    fields = fields or all_fields('doctors')
+    async with async_db.session(current_app.config) as session:
+        rows = await _rows(session, 'doctors', fields)
+    return jsonify([only(row, fields) for row in rows]), 200
+
+
+async def get_profile():
+    current_user = await _current_user()
+
+    if current_user['type'] == 'patient':
+        resource, id_column = 'patients', Patient.patient_id
+    elif current_user['type'] == 'doctor':
+        resource, id_column = 'doctors', Doctor.doctor_id
+    else:
+        return jsonify({'error': 'Invalid user type'}), 400
+
+    fields, error = requested_fields(resource)
+    if error:
+        return jsonify({'error': error}), 400
+
+    fields = fields or all_fields(resource)
+    async with async_db.session(current_app.config) as session:
+        rows = await _rows(session, resource, fields, id_column == current_user['id'], include=('version',))
+    if not rows:
+        return jsonify({'error': 'User not found'}), 404
+    return etag_response(only(rows[0], fields), rows[0].version)
+
+
+async def export_user_data():
+    current_user = await _current_user()
+    statements = export_statements(current_user)
+    if statements is None:
+        return jsonify({'error': 'Invalid user type'}), 400
+
+    try:
+        async with async_db.session(current_app.config) as session:
+            results = {section: export_result(section, await session.execute(statement))
+                       for section, statement in statements.items()}
+            export_data = build_export(current_user, results)
+        if export_data is None:
+            return jsonify({'error': f"{current_user['type'].capitalize()} not found"}), 404
+        return jsonify(export_data), 200
+    except Exception as e:
+        return jsonify({'error': 'Failed to export data'}), 500
+
+
+ASYNC_ROUTES = {
+    '/api/appointments': get_appointments,
+    '/api/medical-notes': get_medical_notes,
+    '/api/doctors': get_doctors,
+    '/api/profile': get_profile,
+    '/api/gdpr/data-export': export_user_data
+}
+
+
+def _handle_exception(error):
+    try:
+        return app.handle_user_exception(error)
+    except Exception as unhandled:
+        return app.handle_exception(unhandled)
+
+
+def _environ(scope, stream):
+    """WSGI environ for an ASGI HTTP scope, enough for a Flask request context"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+    return environ
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+class _ReceiveStream(io.RawIOBase):
+    """``wsgi.input`` that pulls the ASGI request body as the app reads it.
+
+    Read from the worker thread; each message is awaited on the event loop,
+    so an upload is never held in memory as a whole.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._pending = memoryview(b'')
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self._pending = memoryview(message.get('body', b''))
+            self._more_body = message.get('more_body', False)
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+async def _dispatch(view, scope, receive, send):
+    body = await _read_body(receive)
+    with app.request_context(_environ(scope, io.BytesIO(body))):
+        try:
+            response = app.preprocess_request()
+            if response is None:
+                response = await view()
+            response = app.make_response(response)
+        except Exception as e:
+            response = app.make_response(_handle_exception(e))
+        response = app.process_response(response)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                        for key, value in response.headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def _call_wsgi(scope, receive, send):
+    """Run the Flask app for a request on the thread pool, streaming its body both ways"""
+    loop = asyncio.get_running_loop()
+    environ = _environ(scope, io.BufferedReader(_ReceiveStream(receive, loop), STREAM_BUFFER_SIZE))
+    # The body ends where the ASGI messages end, even without Content-Length
+    environ['wsgi.input_terminated'] = True
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    iterable = await loop.run_in_executor(_executor, app, environ, start_response)
+    try:
+        iterator = iter(iterable)
+        # start_response may be deferred until the first chunk
+        chunk = await loop.run_in_executor(_executor, next, iterator, None)
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                        for key, value in started['headers']]
+        })
+        while chunk is not None:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_executor, next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(_executor, iterable.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_db.dispose()
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def _prefers_async(scope):
+    # The sync views answer these with a background job
+    return any(name == b'prefer' and b'respond-async' in value.lower() for name, value in scope['headers'])
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET' and app.config.get('ASYNC_READS_ENABLED', True):
+        view = ASYNC_ROUTES.get(scope['path'])
+        if view is not None and not _prefers_async(scope):
+            return await _dispatch(view, scope, receive, send)
+    if scope['type'] == 'http':
+        return await _call_wsgi(scope, receive, send)
@@ -0,0 +1,62 @@
+"""
+Async engine and sessions for the read endpoints served by ``src.asgi``.
+
+The async engine has its own connection pool, sized by
+``ASYNC_DB_POOL_SIZE``/``ASYNC_DB_MAX_OVERFLOW``, next to the sync pool used
+by the Flask views. It is created lazily inside the running event loop, since
+asyncpg/aiosqlite connections belong to the loop that opened them. The URL
+is ``ASYNC_DATABASE_URL`` if set, otherwise ``SQLALCHEMY_DATABASE_URI``
+with its driver swapped for the async one.
+"""
+from contextlib import asynccontextmanager
+
+from sqlalchemy.engine import make_url
+
+# Async driver for each sync dialect
+_ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite'
+}
+
+_state = {'engine': None, 'sessionmaker': None}
+
+
+def async_url(url):
+    """``url`` with its driver replaced by the async driver for its dialect"""
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    if dialect not in _ASYNC_DRIVERS:
+        raise ValueError(f'No async driver configured for {dialect}')
+    return url.set(drivername=f'{dialect}+{_ASYNC_DRIVERS[dialect]}')
+
+
+def get_engine(config):
+    if _state['engine'] is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        url = config.get('ASYNC_DATABASE_URL') or async_url(config['SQLALCHEMY_DATABASE_URI'])
+        options = {'pool_pre_ping': True}
+        # In-memory SQLite uses a static pool that takes no sizing
+        if make_url(url).database not in (None, '', ':memory:'):
+            options.update(pool_size=config.get('ASYNC_DB_POOL_SIZE', 20),
+                           max_overflow=config.get('ASYNC_DB_MAX_OVERFLOW', 30),
+                           pool_timeout=config.get('ASYNC_DB_POOL_TIMEOUT', 30))
+        _state['engine'] = create_async_engine(url, **options)
+        _state['sessionmaker'] = async_sessionmaker(_state['engine'], expire_on_commit=False)
+    return _state['engine']
+
+
+@asynccontextmanager
+async def session(config):
+    """Async session from the shared pool, closed on exit"""
+    get_engine(config)
+    async with _state['sessionmaker']() as async_session:
+        yield async_session
+
+
+async def dispose():
+    """Close the pool; called on ASGI lifespan shutdown"""
+    if _state['engine'] is not None:
+        await _state['engine'].dispose()
+        _state['engine'] = None
+        _state['sessionmaker'] = None
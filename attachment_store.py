@@ -0,0 +1,321 @@
+"""
+Content-addressed file storage for medical note attachments.
+
+Files live under ``ATTACHMENT_DIR`` as ``objects/<aa>/<sha256>``, where ``aa``
+is the first two characters of the digest; identical files are stored once.
+Only metadata rows go in the database.
+
+Request bodies are copied to disk ``CHUNK_SIZE`` bytes at a time and hashed
+as they are written, so memory stays flat whatever the size of the file.
+A finished file is renamed from ``uploads/`` into ``objects/`` on the same
+filesystem, so a partial file is never visible under its digest.
+
+Resumable uploads append each chunk to ``uploads/<upload_id>``. The running
+SHA-256 of an upload is kept by the worker that wrote its last chunk; when a
+chunk reaches another worker, or one that restarted, the staged bytes are
+rehashed from disk first. Chunks of one upload are serialised with an
+exclusive lock on its staging file.
+
+``erase`` and ``release`` keep the stored files in step with the
+``note_attachments`` rows when attachments are deleted. Files are not
+unlinked there: the same content may be stored again for a new attachment
+whose row is not committed yet. Instead they queue an
+``attachments.collect`` job in the deleting transaction. The job deletes a
+file only if no row refers to it and it was last stored more than
+``ATTACHMENT_GC_GRACE_SECONDS`` ago, checked under a lock that storing a
+file also takes. An upload therefore has the grace period to commit its
+row after storing the file.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from src.models.user import db, AttachmentUpload, NoteAttachment
+from src.job_queue import enqueue, task
+
+CHUNK_SIZE = 1024 * 1024
+
+# Running hashes of uploads kept per worker, most recently used last
+MAX_CACHED_HASHES = 1000
+
+_settings = {'root': os.path.join('instance', 'attachments'), 'max_bytes': 2 * 1024 ** 3, 'grace_seconds': 600}
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+class TooLarge(Exception):
+    """The body is larger than allowed"""
+
+
+class Busy(Exception):
+    """Another request is writing a chunk of the same upload"""
+
+
+def configure(root=None, max_bytes=None, grace_seconds=None):
+    if root is not None:
+        _settings['root'] = root
+    if max_bytes is not None:
+        _settings['max_bytes'] = max_bytes
+    if grace_seconds is not None:
+        _settings['grace_seconds'] = grace_seconds
+
+
+def max_bytes():
+    return _settings['max_bytes']
+
+
+def object_path(sha256):
+    return os.path.join(_settings['root'], 'objects', sha256[:2], sha256)
+
+
+def staging_path(name):
+    return os.path.join(_settings['root'], 'uploads', name)
+
+
+def _copy(stream, target, digest, limit):
+    """Copy ``stream`` to ``target`` until EOF, hashing as it goes; returns the bytes copied"""
+    copied = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise TooLarge()
+        digest.update(chunk)
+        target.write(chunk)
+
+
+@contextmanager
+def _object_lock(sha256):
+    """Exclusive lock, across workers, on the stored files sharing the digest's first two characters"""
+    path = os.path.join(_settings['root'], 'locks', sha256[:2])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _publish(path, sha256):
+    """Move a finished staging file to its content address"""
+    destination = object_path(sha256)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with _object_lock(sha256):
+        os.replace(path, destination)
+        # A fresh mtime keeps a released copy of the same content from being
+        # collected before the caller commits its row
+        os.utime(destination)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class StagedFile:
+    """A new file being written to the staging area, hashed as it is written"""
+
+    def __init__(self):
+        self.path = staging_path(f'{uuid.uuid4().hex}.part')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > _settings['max_bytes']:
+            raise TooLarge()
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def seek(self, *args):
+        # The multipart parser rewinds finished files
+        return self.file.seek(*args)
+
+    def close(self):
+        self.file.close()
+
+    def publish(self):
+        """Store the file under its digest; returns ``(sha256, size)``"""
+        self.file.close()
+        sha256 = self.digest.hexdigest()
+        _publish(self.path, sha256)
+        return sha256, self.size
+
+    def discard(self):
+        self.file.close()
+        _discard(self.path)
+
+
+def save(stream):
+    """Store a whole request body; returns ``(sha256, size)``"""
+    staged = StagedFile()
+    try:
+        _copy(stream, staged.file, staged.digest, _settings['max_bytes'])
+        staged.size = staged.file.tell()
+        return staged.publish()
+    except BaseException:
+        staged.discard()
+        raise
+
+
+def multipart_factory(staged_files):
+    """``stream_factory`` for werkzeug's form parser writing file parts straight to staging"""
+    def factory(total_content_length, content_type, filename, content_length=None):
+        staged = StagedFile()
+        staged_files.append(staged)
+        return staged
+    return factory
+
+
+def _running_hash(upload_id, path, offset):
+    """The SHA-256 of the first ``offset`` bytes of an upload"""
+    with _hashes_lock:
+        cached = _hashes.pop(upload_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = offset
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError(f'Upload {upload_id} is missing staged bytes')
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+def _remember(upload_id, offset, digest):
+    with _hashes_lock:
+        _hashes[upload_id] = (offset, digest)
+        while len(_hashes) > MAX_CACHED_HASHES:
+            _hashes.popitem(last=False)
+
+
+def start_upload(upload_id):
+    path = staging_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def append(upload_id, stream, offset, limit, received, confirm):
+    """Append a chunk of at most ``limit`` bytes to an upload at ``offset``.
+
+    With the staging file locked, ``received()`` must return the offset
+    confirmed in the database and ``confirm(offset, new_offset)`` records
+    the new one. Returns the new offset, or None when ``offset`` is not the
+    confirmed one. Raises Busy if another chunk of the upload is being
+    written.
+    """
+    path = staging_path(upload_id)
+    with open(path, 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Busy()
+        if received() != offset:
+            return None
+        # Bytes past the confirmed offset are left from a chunk that failed
+        f.truncate(offset)
+        f.seek(offset)
+        digest = _running_hash(upload_id, path, offset)
+        copied = _copy(stream, f, digest, limit)
+        f.flush()
+        confirm(offset, offset + copied)
+        _remember(upload_id, offset + copied, digest)
+        return offset + copied
+
+
+def finish_upload(upload_id, size):
+    """Store a complete upload under its digest; returns the sha256"""
+    path = staging_path(upload_id)
+    digest = _running_hash(upload_id, path, size)
+    sha256 = digest.hexdigest()
+    _publish(path, sha256)
+    return sha256
+
+
+def discard_upload(upload_id):
+    with _hashes_lock:
+        _hashes.pop(upload_id, None)
+    _discard(staging_path(upload_id))
+
+
+def release(digests):
+    """Queue the collection of stored files in the transaction that deletes their attachments"""
+    digests = sorted(set(digests))
+    if digests:
+        enqueue('attachments.collect', {'digests': digests}, delay_seconds=_settings['grace_seconds'])
+
+
+@task('attachments.collect', queue='attachments')
+def collect(digests):
+    """Delete the stored files of ``digests`` that no attachment refers to"""
+    deleted, recent = 0, []
+    for sha256 in digests:
+        path = object_path(sha256)
+        with _object_lock(sha256):
+            try:
+                age = time.time() - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age < _settings['grace_seconds']:
+                # Stored again since it was released; its row may not be committed yet
+                recent.append(sha256)
+                continue
+            used = db.session.execute(
+                select(NoteAttachment.attachment_id).where(NoteAttachment.sha256 == sha256).limit(1)
+            ).first()
+            if used is None:
+                _discard(path)
+                deleted += 1
+    if recent:
+        release(recent)
+    return {'deleted': deleted, 'deferred': len(recent)}
+
+
+def erase(owner, owner_id):
+    """Delete a patient's or doctor's attachments and uploads in the current transaction.
+
+    ``owner`` is 'patient_id' or 'doctor_id'. Their files are released in
+    the same transaction.
+    """
+    digests = db.session.execute(
+        delete(NoteAttachment).where(getattr(NoteAttachment, owner) == owner_id).returning(NoteAttachment.sha256)
+    ).scalars().all()
+    uploads = db.session.execute(
+        delete(AttachmentUpload).where(getattr(AttachmentUpload, owner) == owner_id)
+        .returning(AttachmentUpload.upload_id)
+    ).scalars().all()
+    for upload_id in uploads:
+        discard_upload(upload_id)
+    release(digests)
+
+
+def expire_uploads(max_age_hours, limit=100):
+    """Drop uploads that have not received a chunk for ``max_age_hours``"""
+    cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+    expired = db.session.execute(
+        select(AttachmentUpload.upload_id).where(AttachmentUpload.updated_at < cutoff).limit(limit)
+    ).scalars().all()
+    if expired:
+        db.session.execute(delete(AttachmentUpload).where(AttachmentUpload.upload_id.in_(expired)))
+        for upload_id in expired:
+            discard_upload(upload_id)
+    return len(expired)
+
+
+def init_app(app):
+    configure(root=app.config.get('ATTACHMENT_DIR'), max_bytes=app.config.get('ATTACHMENT_MAX_BYTES'),
+              grace_seconds=app.config.get('ATTACHMENT_GC_GRACE_SECONDS'))
@@ -0,0 +1,297 @@
+from flask import Blueprint, current_app, request, jsonify, send_file
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from datetime import datetime
+from sqlalchemy import delete, select, update
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.formparser import FormDataParser
+from src.models.user import db, AttachmentUpload, MedicalNote, NoteAttachment
+from src.idempotency import idempotent
+from src import attachment_store
+from src.attachment_store import Busy, TooLarge
+import os
+import re
+import uuid
+
+attachments_bp = Blueprint('attachments', __name__)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+def _own_note(note_id, current_user):
+    """``(note, error response)`` for a note the current doctor may attach files to"""
+    if current_user['type'] != 'doctor':
+        return None, (jsonify({'error': 'Only doctors can attach files'}), 403)
+    note = db.session.get(MedicalNote, note_id)
+    if not note:
+        return None, (jsonify({'error': 'Medical note not found'}), 404)
+    if note.doctor_id != current_user['id']:
+        return None, (jsonify({'error': 'Access denied'}), 403)
+    return note, None
+
+def _can_read(record, current_user):
+    """Attachments follow the access rules of their note"""
+    if current_user['type'] == 'patient':
+        return record.patient_id == current_user['id']
+    if current_user['type'] == 'doctor':
+        return record.doctor_id == current_user['id']
+    return False
+
+def _file_details(filename, content_type):
+    """``(filename, content type, error response)`` after checking both"""
+    filename = os.path.basename((filename or '').replace('\\', '/')).strip()
+    if not filename or len(filename) > 255:
+        return None, None, (jsonify({'error': 'filename is required, at most 255 characters'}), 400)
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    allowed = current_app.config.get('ATTACHMENT_CONTENT_TYPES', [])
+    if content_type not in allowed:
+        return None, None, (jsonify({'error': f"Content type must be one of {', '.join(allowed)}"}), 415)
+    return filename, content_type, None
+
+def _release_connection():
+    """Return the pooled connection before a body that may take minutes is read.
+
+    The next query checks one out again; loaded objects stay usable.
+    """
+    db.session.close()
+
+def _too_large():
+    return jsonify({'error': f'Attachments are limited to {attachment_store.max_bytes()} bytes'}), 413
+
+def _attach(note_id, patient_id, doctor_id, filename, content_type, sha256, size):
+    attachment = NoteAttachment(note_id=note_id, patient_id=patient_id, doctor_id=doctor_id,
+                                filename=filename, content_type=content_type, size=size, sha256=sha256)
+    db.session.add(attachment)
+    return attachment
+
+@attachments_bp.route('/medical-notes/<int:note_id>/attachments', methods=['POST'])
+@jwt_required()
+def upload_attachment(note_id):
+    """Attach a file to a medical note in one request (doctors only).
+
+    Send either the raw file with its Content-Type and ?filename=, or
+    multipart/form-data with a ``file`` part. The body is streamed to disk.
+    """
+    current_user = get_jwt_identity()
+
+    note, error = _own_note(note_id, current_user)
+    if error:
+        return error
+    _release_connection()
+
+    if request.content_length is not None and request.content_length > attachment_store.max_bytes():
+        return _too_large()
+
+    staged_files = []
+    try:
+        if request.mimetype == 'multipart/form-data':
+            parser = FormDataParser(stream_factory=attachment_store.multipart_factory(staged_files))
+            _, _, files = parser.parse(request.stream, request.mimetype, request.content_length,
+                                       request.mimetype_params)
+            upload = files.get('file')
+            if upload is None:
+                return jsonify({'error': 'file is required'}), 400
+            filename, content_type, error = _file_details(upload.filename, upload.mimetype)
+            if error:
+                return error
+            staged_files.remove(upload.stream)
+            sha256, size = upload.stream.publish()
+        else:
+            filename, content_type, error = _file_details(request.args.get('filename'), request.mimetype)
+            if error:
+                return error
+            sha256, size = attachment_store.save(request.stream)
+    except TooLarge:
+        return _too_large()
+    except ClientDisconnected:
+        return jsonify({'error': 'The upload was interrupted'}), 400
+    finally:
+        for staged in staged_files:
+            staged.discard()
+    if size == 0:
+        attachment_store.release([sha256])
+        db.session.commit()
+        return jsonify({'error': 'The file is empty'}), 400
+
+    attachment = _attach(note.note_id, note.patient_id, note.doctor_id, filename, content_type, sha256, size)
+    db.session.commit()
+    return jsonify({
+        'message': 'Attachment uploaded successfully',
+        'attachment': attachment
+    }), 201
+
+@attachments_bp.route('/medical-notes/<int:note_id>/attachments/uploads', methods=['POST'])
+@jwt_required()
+@idempotent
+def start_attachment_upload(note_id):
+    """Start a resumable upload (doctors only); chunks are then PUT to the returned upload"""
+    current_user = get_jwt_identity()
+
+    note, error = _own_note(note_id, current_user)
+    if error:
+        return error
+
+    data = request.get_json()
+    filename, content_type, error = _file_details(data.get('filename'), data.get('content_type'))
+    if error:
+        return error
+    size = data.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        return jsonify({'error': 'size must be a positive integer'}), 400
+    if size > attachment_store.max_bytes():
+        return _too_large()
+
+    attachment_store.expire_uploads(current_app.config.get('ATTACHMENT_UPLOAD_EXPIRY_HOURS', 24))
+    upload = AttachmentUpload(upload_id=uuid.uuid4().hex, note_id=note.note_id, patient_id=note.patient_id,
+                              doctor_id=note.doctor_id, filename=filename, content_type=content_type, size=size)
+    attachment_store.start_upload(upload.upload_id)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(upload), 201
+
+def _own_upload(upload_id, current_user):
+    upload = db.session.get(AttachmentUpload, upload_id)
+    if not upload or current_user['type'] != 'doctor' or upload.doctor_id != current_user['id']:
+        return None
+    return upload
+
+@attachments_bp.route('/attachments/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_attachment_upload(upload_id):
+    """Progress of a resumable upload; the next chunk starts at ``offset``"""
+    upload = _own_upload(upload_id, get_jwt_identity())
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload), 200
+
+@attachments_bp.route('/attachments/uploads/<upload_id>', methods=['PUT'])
+@jwt_required()
+def put_attachment_chunk(upload_id):
+    """Write the chunk given by ``Content-Range: bytes start-end/size``; the last one creates the attachment"""
+    upload = _own_upload(upload_id, get_jwt_identity())
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    _release_connection()
+
+    match = CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify({'error': 'Content-Range: bytes start-end/size is required'}), 400
+    start, end, total = (int(value) for value in match.groups())
+    if total != upload.size or end < start or end >= total:
+        return jsonify({'error': f'Content-Range must lie within the upload size of {upload.size} bytes'}), 416
+    if request.content_length is not None and request.content_length != end - start + 1:
+        return jsonify({'error': 'Content-Length does not match Content-Range'}), 400
+
+    def received():
+        offset = db.session.execute(
+            select(AttachmentUpload.received).where(AttachmentUpload.upload_id == upload_id)
+        ).scalar()
+        # confirm() only matches this offset, so nothing needs to stay open while the chunk is read
+        _release_connection()
+        return offset
+
+    def confirm(offset, new_offset):
+        db.session.execute(update(AttachmentUpload)
+                           .where(AttachmentUpload.upload_id == upload_id, AttachmentUpload.received == offset)
+                           .values(received=new_offset, updated_at=datetime.utcnow()))
+        db.session.commit()
+
+    try:
+        offset = attachment_store.append(upload_id, request.stream, start, end - start + 1, received, confirm)
+    except Busy:
+        return jsonify({'error': 'Another chunk of this upload is being written'}), 409
+    except TooLarge:
+        return jsonify({'error': 'The chunk is longer than its Content-Range'}), 400
+    except ClientDisconnected:
+        return jsonify({'error': 'The upload was interrupted'}), 400
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if offset is None:
+        db.session.rollback()
+        response = jsonify({'error': 'The chunk does not start at the current offset',
+                            'offset': received()})
+        return response, 409
+    if offset < upload.size:
+        return jsonify({'upload_id': upload_id, 'offset': offset, 'size': upload.size}), 200
+
+    try:
+        sha256 = attachment_store.finish_upload(upload_id, upload.size)
+    except FileNotFoundError:
+        # Cancelled or expired after its last chunk was written
+        return jsonify({'error': 'Upload not found'}), 404
+    attachment = _attach(upload.note_id, upload.patient_id, upload.doctor_id, upload.filename,
+                         upload.content_type, sha256, upload.size)
+    db.session.execute(delete(AttachmentUpload).where(AttachmentUpload.upload_id == upload_id))
+    db.session.commit()
+    return jsonify({
+        'message': 'Attachment uploaded successfully',
+        'attachment': attachment
+    }), 201
+
+@attachments_bp.route('/attachments/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_attachment_upload(upload_id):
+    """Abandon a resumable upload"""
+    upload = _own_upload(upload_id, get_jwt_identity())
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    db.session.delete(upload)
+    db.session.commit()
+    attachment_store.discard_upload(upload_id)
+    return jsonify({'message': 'Upload cancelled'}), 200
+
+@attachments_bp.route('/medical-notes/<int:note_id>/attachments', methods=['GET'])
+@jwt_required()
+def get_note_attachments(note_id):
+    """Metadata of a medical note's attachments"""
+    current_user = get_jwt_identity()
+
+    attachments = NoteAttachment.query.filter_by(note_id=note_id).order_by(NoteAttachment.attachment_id).all()
+    # Attachments are kept after their note is deleted
+    owner = db.session.get(MedicalNote, note_id) or (attachments[0] if attachments else None)
+    if not owner:
+        return jsonify({'error': 'Medical note not found'}), 404
+    if not _can_read(owner, current_user):
+        return jsonify({'error': 'Access denied'}), 403
+    return jsonify(attachments), 200
+
+@attachments_bp.route('/attachments/<int:attachment_id>', methods=['GET'])
+@jwt_required()
+def download_attachment(attachment_id):
+    """Download an attachment, with Range and If-None-Match support"""
+    current_user = get_jwt_identity()
+
+    attachment = db.session.get(NoteAttachment, attachment_id)
+    if not attachment:
+        return jsonify({'error': 'Attachment not found'}), 404
+    if not _can_read(attachment, current_user):
+        return jsonify({'error': 'Access denied'}), 403
+
+    path = attachment_store.object_path(attachment.sha256)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Attachment not found'}), 404
+    # Served from the file by the WSGI server (sendfile where available)
+    response = send_file(os.path.abspath(path), mimetype=attachment.content_type, as_attachment=True,
+                         download_name=attachment.filename, conditional=True, etag=attachment.sha256,
+                         last_modified=attachment.created_at)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@attachments_bp.route('/attachments/<int:attachment_id>', methods=['DELETE'])
+@jwt_required()
+def delete_attachment(attachment_id):
+    """Delete an attachment (doctors only)"""
+    current_user = get_jwt_identity()
+
+    if current_user['type'] != 'doctor':
+        return jsonify({'error': 'Only doctors can delete attachments'}), 403
+
+    attachment = db.session.get(NoteAttachment, attachment_id)
+    if not attachment:
+        return jsonify({'error': 'Attachment not found'}), 404
+    if attachment.doctor_id != current_user['id']:
+        return jsonify({'error': 'Access denied'}), 403
+
+    attachment_store.release([attachment.sha256])
+    db.session.delete(attachment)
+    db.session.commit()
+    return jsonify({'message': 'Attachment deleted successfully'}), 200
@@ -1,16 +1,27 @@
+from datetime import datetime
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-import bcrypt
+from flask_jwt_extended import (
+    create_access_token, create_refresh_token, decode_token, jwt_required, get_jwt, get_jwt_identity
+)
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
 from src.models.user import db, Patient, Doctor
 from src.security_config import (
     rate_limit, validate_input, validate_password_strength, 
-    sanitize_input, log_security_event, check_suspicious_activity
+    sanitize_input, log_security_event, check_suspicious_activity,
+    hash_password, verify_password
 )
+from src.email_filter import patient_emails, doctor_emails
+from src.fieldsets import requested_fields, select_fields, only
+from src.db_utils import etag_response, integrity_error_kind
+from src.token_revocation import revoked_tokens
+from src.idempotency import idempotent
 
 auth_bp = Blueprint('auth', __name__)
 
 @auth_bp.route('/register/patient', methods=['POST'])
 @rate_limit(max_requests=5, window_minutes=15)  # Limit registration attempts
+@idempotent
 def register_patient():
     data = request.get_json()
     
@@ -37,42 +48,47 @@ def register_patient():
     if password_errors:
         return jsonify({'error': password_errors}), 400
     
-    # Check if patient already exists
-    existing_patient = Patient.query.filter_by(email=data['email']).first()
-    if existing_patient:
-        log_security_event('duplicate_registration_attempt', {
-            'email': data['email'],
-            'user_type': 'patient'
-        })
-        return jsonify({'error': 'Patient with this email already exists'}), 400
+    try:
+        date_of_birth = data.get('date_of_birth')
+        if date_of_birth:
+            date_of_birth = datetime.strptime(date_of_birth, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
     
     # Hash password
-    password_hash = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    password_hash = hash_password(data['password'])
     
-    # Create new patient
-    new_patient = Patient(
+    # Create new patient; the unique email constraint rejects duplicates
+    statement = insert(Patient.__table__).values(
         first_name=data['first_name'],
         last_name=data['last_name'],
         email=data['email'],
         password_hash=password_hash,
-        date_of_birth=data.get('date_of_birth'),
+        date_of_birth=date_of_birth or None,
         gender=data.get('gender'),
         address=data.get('address'),
         phone=data.get('phone')
-    )
+    ).returning(Patient.__table__.c.patient_id)
     
     try:
-        db.session.add(new_patient)
+        patient_id = db.session.execute(statement).scalar()
         db.session.commit()
+        patient_emails.add(data['email'], patient_id)
         
         log_security_event('successful_registration', {
             'user_type': 'patient',
-            'user_id': new_patient.patient_id
+            'user_id': patient_id
         })
         
         return jsonify({'message': 'Patient registered successfully'}), 201
     except Exception as e:
         db.session.rollback()
+        if isinstance(e, IntegrityError) and integrity_error_kind(e) == 'unique':
+            log_security_event('duplicate_registration_attempt', {
+                'email': data['email'],
+                'user_type': 'patient'
+            })
+            return jsonify({'error': 'Patient with this email already exists'}), 400
         log_security_event('registration_error', {
             'error': str(e),
             'user_type': 'patient'
@@ -80,6 +96,7 @@ def register_patient():
         return jsonify({'error': 'Registration failed'}), 500
 
 @auth_bp.route('/register/doctor', methods=['POST'])
+@idempotent
 def register_doctor():
     data = request.get_json()
     
@@ -89,30 +106,28 @@ def register_doctor():
         if field not in data:
             return jsonify({'error': f'{field} is required'}), 400
     
-    # Check if doctor already exists
-    existing_doctor = Doctor.query.filter_by(email=data['email']).first()
-    if existing_doctor:
-        return jsonify({'error': 'Doctor with this email already exists'}), 400
-    
     # Hash password
-    password_hash = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    password_hash = hash_password(data['password'])
     
-    # Create new doctor
-    new_doctor = Doctor(
+    # Create new doctor; the unique email constraint rejects duplicates
+    statement = insert(Doctor.__table__).values(
         first_name=data['first_name'],
         last_name=data['last_name'],
         email=data['email'],
         password_hash=password_hash,
         specialty=data.get('specialty'),
         phone=data.get('phone')
-    )
+    ).returning(Doctor.__table__.c.doctor_id)
     
     try:
-        db.session.add(new_doctor)
+        doctor_id = db.session.execute(statement).scalar()
         db.session.commit()
+        doctor_emails.add(data['email'], doctor_id)
         return jsonify({'message': 'Doctor registered successfully'}), 201
     except Exception as e:
         db.session.rollback()
+        if isinstance(e, IntegrityError) and integrity_error_kind(e) == 'unique':
+            return jsonify({'error': 'Doctor with this email already exists'}), 400
         return jsonify({'error': 'Registration failed'}), 500
 
 @auth_bp.route('/login/patient', methods=['POST'])
@@ -137,10 +152,12 @@ def login_patient():
         })
         return jsonify({'error': validation_errors}), 400
     
-    patient = Patient.query.filter_by(email=data['email']).first()
+    # Unknown emails skip the query; verify_password still burns a bcrypt check
+    patient = patient_emails.lookup(data['email'])
     
-    if patient and bcrypt.checkpw(data['password'].encode('utf-8'), patient.password_hash.encode('utf-8')):
-        access_token = create_access_token(identity={'id': patient.patient_id, 'type': 'patient'})
+    if verify_password(data['password'], patient.password_hash if patient else None):
+        identity = {'id': patient.patient_id, 'type': 'patient'}
+        access_token = create_access_token(identity=identity)
         
         log_security_event('successful_login', {
             'user_type': 'patient',
@@ -151,6 +168,7 @@ def login_patient():
         
         return jsonify({
             'access_token': access_token,
+            'refresh_token': create_refresh_token(identity=identity),
             'user': patient.to_dict()
         }), 200
     else:
@@ -170,29 +188,90 @@ def login_doctor():
     if 'email' not in data or 'password' not in data:
         return jsonify({'error': 'Email and password are required'}), 400
     
-    doctor = Doctor.query.filter_by(email=data['email']).first()
+    doctor = doctor_emails.lookup(data['email'])
     
-    if doctor and bcrypt.checkpw(data['password'].encode('utf-8'), doctor.password_hash.encode('utf-8')):
-        access_token = create_access_token(identity={'id': doctor.doctor_id, 'type': 'doctor'})
+    if verify_password(data['password'], doctor.password_hash if doctor else None):
+        identity = {'id': doctor.doctor_id, 'type': 'doctor'}
         return jsonify({
-            'access_token': access_token,
+            'access_token': create_access_token(identity=identity),
+            'refresh_token': create_refresh_token(identity=identity),
             'user': doctor.to_dict()
         }), 200
     else:
         return jsonify({'error': 'Invalid credentials'}), 401
 
+@auth_bp.route('/token/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh_tokens():
+    """Exchange a refresh token for a new access token and refresh token.
+
+    The presented refresh token is revoked, so each one can be used once.
+    """
+    identity = get_jwt_identity()
+    revoked_tokens.revoke(get_jwt())
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request already rotated this refresh token
+        db.session.rollback()
+        log_security_event('refresh_token_reuse', {'user_type': identity['type'], 'user_id': identity['id']})
+        return jsonify({'error': 'Token has been revoked'}), 401
+    
+    return jsonify({
+        'access_token': create_access_token(identity=identity),
+        'refresh_token': create_refresh_token(identity=identity)
+    }), 200
+
+@auth_bp.route('/logout', methods=['POST'])
+@jwt_required(verify_type=False)
+def logout():
+    """Revoke the presented token and, if given, the refresh token in the body"""
+    tokens = [get_jwt()]
+    
+    data = request.get_json(silent=True) or {}
+    if data.get('refresh_token'):
+        try:
+            tokens.append(decode_token(data['refresh_token'], allow_expired=True))
+        except Exception:
+            return jsonify({'error': 'Invalid refresh token'}), 400
+    
+    for payload in tokens:
+        if not revoked_tokens.is_revoked(payload['jti']):
+            revoked_tokens.revoke(payload)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Revoked concurrently by another request
+        db.session.rollback()
+    
+    return jsonify({'message': 'Logged out successfully'}), 200
+
 @auth_bp.route('/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
     current_user = get_jwt_identity()
     
     if current_user['type'] == 'patient':
+        resource, id_column = 'patients', Patient.patient_id
+    elif current_user['type'] == 'doctor':
+        resource, id_column = 'doctors', Doctor.doctor_id
+    else:
+        return jsonify({'error': 'Invalid user type'}), 400
+    
+    fields, error = requested_fields(resource)
+    if error:
+        return jsonify({'error': error}), 400
+    if fields:
+        rows = select_fields(resource, fields, id_column == current_user['id'], include=('version',))
+        if rows:
+            return etag_response(only(rows[0], fields), rows[0].version)
+    elif current_user['type'] == 'patient':
         patient = Patient.query.get(current_user['id'])
         if patient:
-            return jsonify(patient.to_dict()), 200
-    elif current_user['type'] == 'doctor':
+            return etag_response(patient.to_dict(), patient.version)
+    else:
         doctor = Doctor.query.get(current_user['id'])
         if doctor:
-            return jsonify(doctor.to_dict()), 200
+            return etag_response(doctor.to_dict(), doctor.version)
     
     return jsonify({'error': 'User not found'}), 404
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Concurrent-connection capacity of the async read path against the threaded
+sync path.
+
+Starts the app twice against the same kind of database:
+
+- sync:  run.py, the threaded WSGI server (one thread per connection)
+- async: uvicorn src.asgi:application (reads run as coroutines)
+
+Both servers get the same data. Then --clients keep-alive connections are
+opened at once and each sends --requests GETs to --path. Reports
+throughput, p50/p95/p99 latency and failed requests. Memory per in-flight
+request is the server's peak RSS growth over idle, divided by --clients.
+The thread count is reported alongside.
+
+    python benchmarks/bench_async_reads.py --clients 1000 --requests 5
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchutil import compare, environment, load_results, print_regressions, save_results, summarize_latencies
+from load_test import PASSWORD, start_server
+
+SERVERS = {
+    'sync': lambda port: None,
+    'async': lambda port: [sys.executable, '-m', 'uvicorn', 'src.asgi:application', '--host', '127.0.0.1',
+                           '--port', str(port), '--log-level', 'warning', '--backlog', '4096']
+}
+
+
+def raise_file_limit():
+    # Each connection is a descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def prepare(base_url, appointments):
+    """A doctor and a patient with some appointments; returns the patient's token"""
+    session = requests.Session()
+    session.post(f'{base_url}/api/register/doctor', json={
+        'first_name': 'Bench', 'last_name': 'Doctor', 'email': 'bench-doctor@example.com', 'password': PASSWORD
+    }).raise_for_status()
+    session.post(f'{base_url}/api/register/patient', json={
+        'first_name': 'Bench', 'last_name': 'Patient', 'email': 'bench-patient@example.com', 'password': PASSWORD
+    }).raise_for_status()
+    doctor_id = session.post(f'{base_url}/api/login/doctor', json={
+        'email': 'bench-doctor@example.com', 'password': PASSWORD
+    }).json()['user']['doctor_id']
+    token = session.post(f'{base_url}/api/login/patient', json={
+        'email': 'bench-patient@example.com', 'password': PASSWORD
+    }).json()['access_token']
+    for i in range(appointments):
+        session.post(f'{base_url}/api/appointments', headers={'Authorization': f'Bearer {token}'}, json={
+            'doctor_id': doctor_id, 'appointment_date': f'2031-{1 + i // 28:02d}-{1 + i % 28:02d}',
+            'appointment_time': '09:00', 'reason': 'Benchmark'
+        }).raise_for_status()
+    return token
+
+
+def process_status(pid):
+    """``(rss_kb, threads)`` of a process from /proc"""
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+class Sampler(threading.Thread):
+    """Peak RSS and thread count of the server while the load runs"""
+
+    def __init__(self, pid, interval=0.02):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self.peak_threads = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                rss, threads = process_status(self.pid)
+            except OSError:
+                return
+            self.peak_rss_kb = max(self.peak_rss_kb, rss)
+            self.peak_threads = max(self.peak_threads, threads)
+            time.sleep(self.interval)
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('connection closed')
+    status = int(status_line.split()[1])
+    length, close = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            close = True
+    await reader.readexactly(length)
+    return status, close
+
+
+async def run_client(host, port, request, count, start, latencies, errors, timeout):
+    await start.wait()
+    writer = None
+    try:
+        for _ in range(count):
+            started = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            writer.write(request)
+            await writer.drain()
+            status, close = await asyncio.wait_for(read_response(reader), timeout)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors[f'status_{status}'] += 1
+            if close:
+                writer.close()
+                writer = None
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+        errors[type(e).__name__] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(base_url, path, token, clients, count, timeout):
+    host, port = base_url.rsplit('//', 1)[1].split(':')
+    request = (f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+               f'Authorization: Bearer {token}\r\n\r\n').encode()
+    latencies, errors = [], Counter()
+    start = asyncio.Event()
+    tasks = [asyncio.create_task(run_client(host, int(port), request, count, start, latencies, errors, timeout))
+             for _ in range(clients)]
+    started = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    return latencies, errors, time.perf_counter() - started
+
+
+def bench_server(name, args, port):
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), f'{name}.db')
+    process, base_url = start_server(port, database_url, command=SERVERS[name](port))
+    try:
+        token = prepare(base_url, args.appointments)
+        # Warm up the pools before taking the idle baseline
+        for _ in range(20):
+            requests.get(f'{base_url}{args.path}', headers={'Authorization': f'Bearer {token}'}).raise_for_status()
+        idle_rss_kb, idle_threads = process_status(process.pid)
+
+        sampler = Sampler(process.pid)
+        sampler.start()
+        latencies, errors, wall = asyncio.run(run_load(base_url, args.path, token, args.clients,
+                                                       args.requests, args.timeout))
+        sampler.stopped.set()
+        sampler.join()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    summary = summarize_latencies(latencies, wall)
+    summary.update({
+        'failed': sum(errors.values()),
+        'errors': dict(errors),
+        'idle_rss_mb': idle_rss_kb / 1024,
+        'peak_rss_mb': sampler.peak_rss_kb / 1024,
+        'memory_per_request_kb': max(sampler.peak_rss_kb - idle_rss_kb, 0) / args.clients,
+        'idle_threads': idle_threads,
+        'peak_threads': sampler.peak_threads
+    })
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5, help='Requests per client connection')
+    parser.add_argument('--path', default='/api/appointments')
+    parser.add_argument('--appointments', type=int, default=20, help='Appointments returned per request')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite database per server')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--servers', default='sync,async')
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    raise_file_limit()
+    results = {}
+    for offset, name in enumerate(args.servers.split(',')):
+        results[name] = bench_server(name, args, args.port + offset)
+
+    print(f"{'server':<8} {'ok':>6} {'failed':>7} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} "
+          f"{'peak rss':>10} {'per req':>9} {'threads':>8}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['count']:>6} {r['failed']:>7} {r.get('throughput_rps', 0):>8.1f} "
+              f"{r['p50_ms'] or 0:>7.1f}ms {r['p95_ms'] or 0:>7.1f}ms {r['p99_ms'] or 0:>7.1f}ms "
+              f"{r['peak_rss_mb']:>8.1f}MB {r['memory_per_request_kb']:>7.1f}KB {r['peak_threads']:>8}")
+        if r['errors']:
+            print(f"         errors: {r['errors']}")
+
+    if args.output:
+        save_results(args.output, {'environment': environment(), 'clients': args.clients, 'servers': results})
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline)['servers'],
+                              {'p95_ms': 'lower', 'p99_ms': 'lower', 'throughput_rps': 'higher',
+                               'memory_per_request_kb': 'lower'}, args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
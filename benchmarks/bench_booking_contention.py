@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for appointment booking.
+
+Starts the application (or targets --base-url, which must run with
+RATE_LIMIT_ENABLED=0), then releases --clients threads at once, all booking
+the same --slots slots with one doctor. Each round uses a fresh date. After every round the doctor's appointments are
+read back and the run fails if any slot was booked twice, or if the number
+of 201 responses differs from the number of stored bookings.
+
+Reports throughput and p50/p95/p99 latency per round and overall.
+
+    python benchmarks/bench_booking_contention.py --clients 500 --slots 10 --rounds 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchutil import compare, environment, load_results, print_regressions, save_results, summarize_latencies
+from load_test import PASSWORD, start_server
+
+
+def prepare(base_url, patients, run_tag):
+    """Register a doctor and ``patients`` patients; returns their tokens"""
+    session = requests.Session()
+    doctor = {'first_name': 'Storm', 'last_name': 'Doctor', 'email': f'storm-doctor-{run_tag}@bench.example',
+              'password': PASSWORD, 'specialty': 'General Practice'}
+    session.post(f'{base_url}/api/register/doctor', json=doctor).raise_for_status()
+    response = session.post(f'{base_url}/api/login/doctor', json={'email': doctor['email'], 'password': PASSWORD})
+    response.raise_for_status()
+    fixtures = {'doctor_token': response.json()['access_token'],
+                'doctor_id': response.json()['user']['doctor_id'], 'patient_tokens': []}
+
+    for index in range(patients):
+        email = f'storm-patient-{run_tag}-{index}@bench.example'
+        session.post(f'{base_url}/api/register/patient', json={
+            'first_name': 'Storm', 'last_name': f'Patient{index}', 'email': email, 'password': PASSWORD
+        }).raise_for_status()
+        response = session.post(f'{base_url}/api/login/patient', json={'email': email, 'password': PASSWORD})
+        response.raise_for_status()
+        fixtures['patient_tokens'].append(response.json()['access_token'])
+    return fixtures
+
+
+def run_round(base_url, fixtures, clients, slots, day):
+    """Race ``clients`` bookings for ``slots`` slots on ``day``; returns (latencies, statuses, wall)"""
+    barrier = threading.Barrier(clients)
+    times = [f'{9 + minute // 60:02d}:{minute % 60:02d}' for minute in range(0, slots * 15, 15)]
+    tokens = fixtures['patient_tokens']
+
+    def book(client):
+        headers = {'Authorization': f'Bearer {tokens[client % len(tokens)]}'}
+        body = {'doctor_id': fixtures['doctor_id'], 'appointment_date': day,
+                'appointment_time': times[client % slots], 'reason': 'Contention benchmark'}
+        barrier.wait()
+        started = time.perf_counter()
+        try:
+            status = requests.post(f'{base_url}/api/appointments', json=body, headers=headers,
+                                   timeout=120).status_code
+        except requests.RequestException:
+            status = 0
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(book, range(clients)))
+    wall_seconds = time.perf_counter() - started
+    return [seconds for seconds, _ in results], Counter(status for _, status in results), wall_seconds
+
+
+def stored_bookings(base_url, fixtures, day):
+    response = requests.get(f'{base_url}/api/appointments',
+                            headers={'Authorization': f"Bearer {fixtures['doctor_token']}"},
+                            params={'fields': 'appointment_date,appointment_time'})
+    response.raise_for_status()
+    return Counter(row['appointment_time'] for row in response.json() if row['appointment_date'] == day)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', help='Target a running server instead of starting run.py')
+    parser.add_argument('--database-url', help='DATABASE_URL for the started server (default: temporary SQLite file)')
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--clients', type=int, default=500, help='Concurrent booking clients per round')
+    parser.add_argument('--slots', type=int, default=10, help='Distinct slots the clients race for')
+    parser.add_argument('--patients', type=int, default=10, help='Patient accounts shared by the clients')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression as a fraction')
+    args = parser.parse_args(argv)
+
+    process = None
+    database_url = args.database_url
+    if args.base_url:
+        base_url = args.base_url.rstrip('/')
+    else:
+        if not database_url:
+            database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='booking-'), 'booking.db')}"
+        process, base_url = start_server(args.port, database_url)
+
+    run_tag = str(int(time.time()))
+    rounds = []
+    all_latencies = []
+    failures = []
+    try:
+        fixtures = prepare(base_url, args.patients, run_tag)
+        total_wall = 0.0
+        for index in range(args.rounds):
+            # A fresh future date per round so every round starts with free slots
+            day = (date.today() + timedelta(days=3650 + int(run_tag) % 3650 + index)).isoformat()
+            latencies, statuses, wall_seconds = run_round(base_url, fixtures, args.clients, args.slots, day)
+            stored = stored_bookings(base_url, fixtures, day)
+            double_booked = sum(count - 1 for count in stored.values() if count > 1)
+            summary = summarize_latencies(latencies, wall_seconds)
+            summary.update({
+                'statuses': {str(status): n for status, n in sorted(statuses.items())},
+                'slots_filled': len(stored),
+                'double_bookings': double_booked
+            })
+            rounds.append(summary)
+            all_latencies.extend(latencies)
+            total_wall += wall_seconds
+
+            if double_booked:
+                failures.append(f'round {index + 1}: {double_booked} double bookings')
+            if statuses[201] != sum(stored.values()):
+                failures.append(f'round {index + 1}: {statuses[201]} bookings confirmed '
+                                f'but {sum(stored.values())} stored')
+            print(f"round {index + 1}: {summary['throughput_rps']:.1f} req/s, p50 {summary['p50_ms']:.1f}ms, "
+                  f"p95 {summary['p95_ms']:.1f}ms, p99 {summary['p99_ms']:.1f}ms, "
+                  f"{len(stored)}/{args.slots} slots filled, statuses {summary['statuses']}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    overall = summarize_latencies(all_latencies, total_wall)
+    print(f"overall: {overall['throughput_rps']:.1f} req/s, p95 {overall['p95_ms']:.1f}ms, "
+          f"p99 {overall['p99_ms']:.1f}ms")
+    results = {
+        'environment': environment(),
+        'config': {'clients': args.clients, 'slots': args.slots, 'rounds': args.rounds,
+                   'database': (database_url or 'external').split(':', 1)[0]},
+        'rounds': rounds,
+        'overall': {'booking': overall}
+    }
+    if args.output:
+        save_results(args.output, results)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if failures:
+        return 1
+    print('No double bookings')
+
+    if args.baseline:
+        regressions = compare(results['overall'], load_results(args.baseline)['overall'],
+                              {'p95_ms': 'lower', 'throughput_rps': 'higher'}, args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Storage benchmark for the medical note revision history.
+
+Builds --notes synthetic notes of about --words words and edits each one
+--versions times the way clinicians do (a sentence appended, a word or
+two changed, medication swapped), then stores the replaced versions three
+ways (no database needed):
+
+- full:         a plain JSON copy of every replaced version
+- full_zlib:    a zlib-compressed copy of every replaced version
+- revisions:    src.note_revisions, a snapshot every --interval versions
+                and compressed reverse deltas in between
+
+Reports payload bytes per path and, for the revision store, the time to
+rebuild the worst-placed version (the one furthest from a snapshot).
+
+    python benchmarks/bench_note_revisions.py --notes 200 --versions 30 --output revisions.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import compare, environment, load_results, print_regressions, save_results
+
+from src.note_revisions import diff, pack, patch, unpack
+
+WORDS = ('patient reports persistent mild moderate severe headache nausea fever cough fatigue pain '
+         'lower back chest abdominal since three days weeks examination unremarkable blood pressure '
+         'elevated normal advised rest fluids review follow-up referral physiotherapy imaging bloods '
+         'ordered results pending stable improving worsening history allergy none known').split()
+MEDICATIONS = ['Paracetamol 500mg', 'Ibuprofen 400mg', 'Amoxicillin 500mg', 'Omeprazole 20mg',
+               'Sertraline 50mg', 'Amlodipine 5mg', '']
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 14))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def note_versions(rng, versions, words):
+    """Successive contents of one note, oldest first"""
+    details = []
+    while sum(len(s.split()) for s in details) < words:
+        details.append(sentence(rng))
+    content = {'note_date': '2031-03-04', 'note_details': '\n'.join(details),
+               'medication': rng.choice(MEDICATIONS), 'treatment': sentence(rng)}
+    history = [content]
+    for _ in range(versions - 1):
+        content = dict(content)
+        roll = rng.random()
+        lines = content['note_details'].split('\n')
+        if roll < 0.4:
+            lines.append(sentence(rng))
+        elif roll < 0.8:
+            line = rng.randrange(len(lines))
+            tokens = lines[line].split(' ')
+            tokens[rng.randrange(len(tokens))] = rng.choice(WORDS)
+            lines[line] = ' '.join(tokens)
+        elif roll < 0.9:
+            content['medication'] = rng.choice(MEDICATIONS)
+        else:
+            content['treatment'] = sentence(rng)
+        content['note_details'] = '\n'.join(lines)
+        history.append(content)
+    return history
+
+
+def store(history, interval):
+    """Revision rows ``(version, kind, payload)`` for every replaced version, as record() writes them"""
+    rows = []
+    for index, old in enumerate(history[:-1]):
+        version = index + 1
+        if version % interval == 0:
+            rows.append((version, 'snapshot', pack(old)))
+        else:
+            rows.append((version, 'delta', pack(diff(history[index + 1], old))))
+    return rows
+
+
+def rebuild(current, rows, version):
+    """Content of ``version`` from the nearest snapshot above it, or the current version"""
+    by_version = {row[0]: row for row in rows}
+    top = version
+    while top in by_version and by_version[top][1] != 'snapshot':
+        top += 1
+    content = unpack(by_version[top][2]) if top in by_version else current
+    for number in range(top - 1, version - 1, -1):
+        content = patch(content, unpack(by_version[number][2]))
+    return content
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--versions', type=int, default=30)
+    parser.add_argument('--words', type=int, default=150, help='Approximate words in a new note')
+    parser.add_argument('--interval', type=int, default=10, help='NOTE_REVISION_SNAPSHOT_INTERVAL')
+    parser.add_argument('--seed', type=int, default=48)
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    sizes = {'full': 0, 'full_zlib': 0, 'revisions': 0}
+    snapshots = deltas = 0
+    rebuild_times = []
+    # Version interval + 1 is the furthest below the next snapshot
+    worst = args.interval + 1 if args.versions > args.interval + 1 else 1
+    for _ in range(args.notes):
+        history = note_versions(rng, args.versions, args.words)
+        replaced = history[:-1]
+        sizes['full'] += sum(len(json.dumps(old, separators=(',', ':')).encode('utf-8')) for old in replaced)
+        sizes['full_zlib'] += sum(len(pack(old)) for old in replaced)
+        rows = store(history, args.interval)
+        sizes['revisions'] += sum(len(row[2]) for row in rows)
+        snapshots += sum(1 for row in rows if row[1] == 'snapshot')
+        deltas += sum(1 for row in rows if row[1] == 'delta')
+
+        for version in range(1, args.versions):
+            if rebuild(history[-1], rows, version) != history[version - 1]:
+                raise AssertionError(f'version {version} did not rebuild')
+        started = time.perf_counter()
+        rebuild(history[-1], rows, worst)
+        rebuild_times.append(time.perf_counter() - started)
+
+    revisions = args.notes * (args.versions - 1)
+    results = {name: {'bytes': size, 'bytes_per_revision': size / revisions if revisions else 0,
+                      'ratio_to_full': size / sizes['full'] if sizes['full'] else None}
+               for name, size in sizes.items()}
+    results['revisions'].update({
+        'snapshots': snapshots,
+        'deltas': deltas,
+        'rebuild_median_ms': statistics.median(rebuild_times) * 1000,
+        'rebuild_max_ms': max(rebuild_times) * 1000
+    })
+
+    print(f"{'path':<12} {'bytes':>12} {'per revision':>14} {'vs full':>9}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['bytes']:>12,} {result['bytes_per_revision']:>14.0f} "
+              f"{result['ratio_to_full']:>8.1%}")
+    print(f"{snapshots} snapshots, {deltas} deltas; rebuilding version {worst}: "
+          f"median {results['revisions']['rebuild_median_ms']:.2f}ms, "
+          f"max {results['revisions']['rebuild_max_ms']:.2f}ms")
+
+    if args.output:
+        save_results(args.output, {'environment': environment(), 'notes': args.notes, 'versions': args.versions,
+                                   'words': args.words, 'interval': args.interval, 'paths': results})
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline)['paths'],
+                              {'bytes': 'lower', 'rebuild_median_ms': 'lower'}, args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
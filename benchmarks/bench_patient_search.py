@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Patient typeahead latency at scale.
+
+Loads --patients synthetic patients into a temporary SQLite database (or
+the database named by --database-url), then times patient_search.search
+for random name and email prefixes of one to four characters. Reports
+p50/p95/p99 per prefix length. The run fails if overall p99 exceeds
+--budget-ms.
+
+    python benchmarks/bench_patient_search.py --patients 1000000 --queries 2000
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import (
+    compare, environment, load_results, print_regressions, save_results, summarize_latencies
+)
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'Anna', 'Zoë', 'José', 'Aisha', 'Wei', 'Olga', 'Sean', 'Chloé', 'Ravi', 'Ingrid']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'García', 'Miller', 'Davis', 'Müller',
+              'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore', 'Martin', 'Lee', 'Nguyen', 'Okafor',
+              'Kowalski', 'Ålander']
+BATCH_SIZE = 10000
+
+
+def synthetic_patient(i, rng):
+    # A numeric suffix keeps names varied enough for prefixes to be selective
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES) + ('' if i % 3 else str(rng.randrange(1000)))
+    return {'first_name': first, 'last_name': last, 'email': f'{first.lower()}.{last.lower()}.{i}@example.com',
+            'password_hash': 'x'}
+
+
+def load_patients(db, count, rng):
+    from sqlalchemy import insert
+    from src.models.user import Patient
+
+    existing = db.session.query(Patient).count()
+    started = time.perf_counter()
+    for start in range(existing, count, BATCH_SIZE):
+        rows = [synthetic_patient(i, rng) for i in range(start, min(start + BATCH_SIZE, count))]
+        db.session.execute(insert(Patient), rows)
+        db.session.commit()
+    return existing, time.perf_counter() - started
+
+
+def random_prefix(rng, length):
+    source = rng.choice([rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES).lower() + '.'])
+    return source[:length]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite database')
+    parser.add_argument('--budget-ms', type=float, default=20.0, help='Maximum overall p99')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'patient_search.db')
+    from src.main import app
+    from src.models.user import db
+    from src import patient_search
+    # The bulk-load batches are expected to be slow
+    logging.getLogger('src.slow_query').setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    fields = patient_search.TYPEAHEAD_FIELDS
+    with app.app_context():
+        existing, load_seconds = load_patients(db, args.patients, rng)
+        print(f'Loaded {args.patients - existing} patients in {load_seconds:.1f}s '
+              f'({db.engine.dialect.name})')
+
+        latencies = {length: [] for length in (1, 2, 3, 4)}
+        results_found = 0
+        for _ in range(args.queries):
+            length = rng.choice(list(latencies))
+            query = random_prefix(rng, length)
+            started = time.perf_counter()
+            rows = patient_search.search(query, fields, args.limit)
+            latencies[length].append(time.perf_counter() - started)
+            results_found += len(rows)
+            db.session.rollback()
+
+    results = {f'prefix_{length}': summarize_latencies(values) for length, values in latencies.items()}
+    results['overall'] = summarize_latencies([value for values in latencies.values() for value in values])
+    print(f"{'query':<10} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, summary in results.items():
+        print(f"{name:<10} {summary['count']:>6} {summary['p50_ms']:>7.2f}ms {summary['p95_ms']:>7.2f}ms "
+              f"{summary['p99_ms']:>7.2f}ms")
+    print(f'Average results per query: {results_found / args.queries:.1f}')
+
+    if args.output:
+        save_results(args.output, {'environment': environment(), 'patients': args.patients, 'results': results})
+    status = 0
+    if results['overall']['p99_ms'] > args.budget_ms:
+        print(f"FAIL p99 {results['overall']['p99_ms']:.2f}ms exceeds the {args.budget_ms:.0f}ms budget")
+        status = 1
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline)['results'],
+                              {'p95_ms': 'lower', 'p99_ms': 'lower'}, args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the per-request helpers in security_config.
+
+Each case is calibrated so one timing repeat lasts at least --min-time
+seconds, then timed over --repeats repeats with the garbage collector
+disabled. Reported per call: median, interquartile range and a bootstrap 95%
+confidence interval of the median. With --baseline the run fails when a
+case's confidence interval lies entirely above the baseline median plus
+--threshold. Needs Flask installed but no database.
+
+    python benchmarks/bench_security_config.py --output bench.json
+    python benchmarks/bench_security_config.py --baseline bench.json --threshold 0.1
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import environment, load_results, percentile, save_results
+
+from flask import Flask, Response
+from src.json_provider import AppJSONProvider
+from src.security_config import (
+    add_security_headers, anonymize_data, sanitize_input,
+    validate_input, validate_password_strength
+)
+
+
+# Payload generators ---------------------------------------------------------
+
+def small_form(rng):
+    """A realistic patient registration form"""
+    return {
+        'first_name': 'Margaret', 'last_name': "O'Connor", 'email': 'margaret.oconnor@example.com',
+        'password': 'Str0ng!Passw0rd', 'date_of_birth': '1984-03-17', 'gender': 'Female',
+        'address': '12 Harbour View, Dublin 4', 'phone': '+353 1 555 0199'
+    }
+
+
+def adversarial_fields(rng, count=1000):
+    """A flat body with many fields full of markup and SQL-looking text"""
+    fragments = ['<script>alert(1)</script>', "' OR '1'='1", 'SELECT * FROM patients', '"quoted"',
+                 'plain text value', "1 OR 1=1 -- comment", 'a' * 200]
+    return {f'field_{i}': rng.choice(fragments) + ''.join(rng.choices(string.ascii_letters, k=20))
+            for i in range(count)}
+
+
+def nested_json(rng, depth=100, width=3):
+    """Deeply nested dicts and lists, as in a JSON bomb"""
+    node = {'leaf': '<b>"value"</b>'}
+    for level in range(depth):
+        node = {f'k{level}': node, 'items': [f"<i>'{j}'</i>" for j in range(width)]}
+    return node
+
+
+def long_strings(rng, count=20, length=50000):
+    """Few fields, each much longer than the 1000 character cap"""
+    return {f'text_{i}': ''.join(rng.choices(string.ascii_letters + '<>"\' ', k=length)) for i in range(count)}
+
+
+def rejected_body(loads, body):
+    try:
+        loads(body)
+    except ValueError:
+        return
+    raise AssertionError('Body was not rejected')
+
+
+def build_cases(seed):
+    rng = random.Random(seed)
+    form = small_form(rng)
+    wide = adversarial_fields(rng)
+    nested = nested_json(rng)
+    long_body = long_strings(rng)
+    bench_app = Flask(__name__)
+    bench_app.json = AppJSONProvider(bench_app)
+    loads = lambda body: bench_app.json.loads(body)
+    wide_bytes = json.dumps(wide).encode()
+    too_deep = b'[' * 100000 + b']' * 100000
+    too_many_keys = json.dumps({f'k{i}': i for i in range(50000)}).encode()
+    passwords = ['Str0ng!Passw0rd', 'weak', 'password', 'NoDigitsHere!', 'x' * 64 + 'A1!']
+    export_row = dict(form, patient_id=1)
+
+    return {
+        'sanitize_input/small_form': lambda: sanitize_input(form),
+        'sanitize_input/adversarial_1000_fields': lambda: sanitize_input(wide),
+        'sanitize_input/nested_depth_100': lambda: sanitize_input(nested),
+        'sanitize_input/long_strings': lambda: sanitize_input(long_body),
+        'json_loads/small_form': lambda: loads(json.dumps(form)),
+        'json_loads/adversarial_1000_fields': lambda: loads(wide_bytes),
+        'json_loads/reject_depth_100000': lambda: rejected_body(loads, too_deep),
+        'json_loads/reject_50000_keys': lambda: rejected_body(loads, too_many_keys),
+        'validate_input/small_form': lambda: validate_input(
+            form, required_fields=['first_name', 'last_name', 'email', 'password'],
+            email_fields=['email'], phone_fields=['phone']),
+        'validate_input/adversarial_1000_fields': lambda: validate_input(wide, required_fields=['field_0']),
+        'validate_password_strength/mixed': lambda: [validate_password_strength(p) for p in passwords],
+        'add_security_headers/response': lambda: add_security_headers(Response('{}', mimetype='application/json')),
+        'anonymize_data/patient_row': lambda: anonymize_data(
+            export_row, ['first_name', 'last_name', 'email', 'phone', 'address', 'date_of_birth'])
+    }
+
+
+# Timing ---------------------------------------------------------------------
+
+def calibrate(func, min_time):
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        if time.perf_counter() - started >= min_time:
+            return loops
+        loops *= 2
+
+
+def bootstrap_median_ci(samples, rng, resamples=2000):
+    medians = sorted(statistics.median(rng.choices(samples, k=len(samples))) for _ in range(resamples))
+    return percentile(medians, 2.5), percentile(medians, 97.5)
+
+
+def time_case(func, repeats, min_time, rng):
+    func()  # warm up caches and compiled regexes
+    loops = calibrate(func, min_time)
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            for _ in range(loops):
+                func()
+            samples.append((time.perf_counter() - started) / loops * 1e6)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    ordered = sorted(samples)
+    ci_low, ci_high = bootstrap_median_ci(samples, rng)
+    return {
+        'loops': loops,
+        'repeats': repeats,
+        'median_us': statistics.median(samples),
+        'iqr_us': percentile(ordered, 75) - percentile(ordered, 25),
+        'min_us': ordered[0],
+        'ci95_low_us': ci_low,
+        'ci95_high_us': ci_high
+    }
+
+
+def find_regressions(current, baseline, threshold):
+    regressions = []
+    for name, result in current.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        limit = base['median_us'] * (1 + threshold)
+        if result['ci95_low_us'] > limit:
+            regressions.append((name, base['median_us'], result['median_us']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=15)
+    parser.add_argument('--min-time', type=float, default=0.05, help='Minimum seconds per repeat')
+    parser.add_argument('--filter', default='', help='Only run cases containing this text')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown as a fraction')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    results = {}
+    print(f"{'case':<42} {'median':>10} {'iqr':>9} {'95% CI':>22}")
+    for name, func in build_cases(args.seed).items():
+        if args.filter not in name:
+            continue
+        result = time_case(func, args.repeats, args.min_time, rng)
+        results[name] = result
+        print(f"{name:<42} {result['median_us']:>8.1f}us {result['iqr_us']:>7.1f}us "
+              f"[{result['ci95_low_us']:>8.1f}, {result['ci95_high_us']:>8.1f}]us")
+
+    if args.output:
+        save_results(args.output, {'environment': environment(), 'cases': results})
+
+    if args.baseline:
+        regressions = find_regressions(results, load_results(args.baseline)['cases'], args.threshold)
+        for name, base_median, median in regressions:
+            print(f'REGRESSION {name}: {base_median:.1f}us -> {median:.1f}us '
+                  f'({100.0 * (median - base_median) / base_median:+.1f}%)')
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
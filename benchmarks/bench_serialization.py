@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Serialization benchmark for large list responses.
+
+Builds --rows transient MedicalNote objects (no database needed) and times
+encoding them as a JSON response three ways:
+
+- legacy:          to_dict() with isoformat() strings, then stdlib json
+- provider_stdlib: AppJSONProvider with the stdlib fallback encoder
+- provider_orjson: AppJSONProvider with orjson (skipped if not installed)
+
+Reports best/median wall time and peak traced memory per path.
+
+    python benchmarks/bench_serialization.py --rows 10000 --output serialization.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchutil import compare, environment, load_results, print_regressions, save_results
+
+from flask import Flask
+from src import json_provider
+from src.json_provider import AppJSONProvider
+from src.models.user import Patient, Doctor, MedicalNote
+
+
+def build_notes(rows):
+    doctors = [Doctor(doctor_id=i, first_name=f'Doc{i}', last_name='Smith', email=f'd{i}@example.com',
+                      password_hash='x') for i in range(1, 21)]
+    patients = [Patient(patient_id=i, first_name=f'Pat{i}', last_name='Jones', email=f'p{i}@example.com',
+                        password_hash='x') for i in range(1, 501)]
+    created = datetime(2024, 1, 1, 9, 30, 15, 123456)
+    notes = []
+    for i in range(rows):
+        notes.append(MedicalNote(
+            note_id=i + 1, patient_id=patients[i % 500].patient_id, doctor_id=doctors[i % 20].doctor_id,
+            patient=patients[i % 500], doctor=doctors[i % 20],
+            note_date=date(2020, 1, 1) + timedelta(days=i % 1500),
+            note_details='Patient reports mild headache; advised rest and hydration. ' * 3,
+            medication='Paracetamol 500mg', treatment='Rest', created_at=created + timedelta(minutes=i)
+        ))
+    return notes
+
+
+def legacy_to_dict(note):
+    """MedicalNote.to_dict as it was before the JSON provider encoded dates natively"""
+    return {
+        'note_id': note.note_id,
+        'patient_id': note.patient_id,
+        'doctor_id': note.doctor_id,
+        'note_date': note.note_date.isoformat() if note.note_date else None,
+        'note_details': note.note_details,
+        'medication': note.medication,
+        'treatment': note.treatment,
+        'created_at': note.created_at.isoformat() if note.created_at else None,
+        'version': note.version,
+        'patient_name': f"{note.patient.first_name} {note.patient.last_name}" if note.patient else None,
+        'doctor_name': f"{note.doctor.first_name} {note.doctor.last_name}" if note.doctor else None
+    }
+
+
+def measure(func, repeats):
+    func()
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'best_ms': min(timings) * 1000,
+        'median_ms': statistics.median(timings) * 1000,
+        'peak_memory_kb': peak / 1024
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--output', help='Write results JSON here')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    app = Flask(__name__)
+    app.config['JSON_SORT_KEYS'] = True
+    provider = AppJSONProvider(app)
+    notes = build_notes(args.rows)
+
+    def legacy():
+        return json.dumps([legacy_to_dict(note) for note in notes], sort_keys=True,
+                          separators=(',', ':')).encode('utf-8')
+
+    orjson_module = json_provider.orjson
+
+    def provider_stdlib():
+        json_provider.orjson = None
+        try:
+            return provider.dump_bytes(notes)
+        finally:
+            json_provider.orjson = orjson_module
+
+    paths = {'legacy': legacy, 'provider_stdlib': provider_stdlib}
+    if orjson_module is not None:
+        paths['provider_orjson'] = lambda: provider.dump_bytes(notes)
+
+    # All paths must produce the same document
+    expected = json.loads(legacy())
+    for name, func in paths.items():
+        if json.loads(func()) != expected:
+            raise AssertionError(f'{name} output differs from the legacy encoder')
+
+    results = {name: measure(func, args.repeats) for name, func in paths.items()}
+    print(f"{'path':<18} {'best':>10} {'median':>10} {'peak mem':>12}")
+    for name, result in results.items():
+        print(f"{name:<18} {result['best_ms']:>8.1f}ms {result['median_ms']:>8.1f}ms "
+              f"{result['peak_memory_kb']:>9.0f} KB")
+
+    if args.output:
+        save_results(args.output, {'environment': environment(), 'rows': args.rows, 'paths': results})
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline)['paths'],
+                              {'median_ms': 'lower', 'peak_memory_kb': 'lower'}, args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Shared helpers for the benchmark scripts: percentiles, summaries and
+baseline comparison of saved JSON results.
+"""
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+
+
+def percentile(sorted_values, q):
+    """Linear-interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100.0
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return sorted_values[int(position)]
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize_latencies(latencies, wall_seconds=None):
+    """Throughput and latency percentiles (milliseconds) for one endpoint"""
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'mean_ms': statistics.fmean(values) * 1000 if values else None,
+        'p50_ms': percentile(values, 50) * 1000 if values else None,
+        'p95_ms': percentile(values, 95) * 1000 if values else None,
+        'p99_ms': percentile(values, 99) * 1000 if values else None,
+        'max_ms': values[-1] * 1000 if values else None
+    }
+    if wall_seconds:
+        summary['throughput_rps'] = len(values) / wall_seconds
+    return summary
+
+
+def environment():
+    """Metadata stored with every result file"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'timestamp': datetime.utcnow().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current, baseline, checks, tolerance):
+    """Compare nested result dicts against a baseline.
+
+    ``checks`` maps a metric name to 'lower' (lower is better, e.g. p95_ms)
+    or 'higher' (e.g. throughput_rps). Leaf dicts present in both results are
+    compared; a regression is reported when a metric is worse than the
+    baseline by more than ``tolerance`` (a fraction).
+    """
+    regressions = []
+
+    def walk(cur, base, path):
+        for key, base_value in base.items():
+            if key not in cur:
+                continue
+            cur_value = cur[key]
+            if isinstance(base_value, dict) and isinstance(cur_value, dict):
+                walk(cur_value, base_value, path + [key])
+            elif key in checks and isinstance(base_value, (int, float)) and isinstance(cur_value, (int, float)):
+                if checks[key] == 'lower':
+                    worse = cur_value > base_value * (1 + tolerance)
+                else:
+                    worse = cur_value < base_value * (1 - tolerance)
+                if worse and base_value:
+                    regressions.append({
+                        'metric': '/'.join(path + [key]),
+                        'baseline': base_value,
+                        'current': cur_value,
+                        'change_pct': round(100.0 * (cur_value - base_value) / base_value, 1)
+                    })
+
+    walk(current, baseline, [])
+    return regressions
+
+
+def print_regressions(regressions):
+    for regression in regressions:
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']:.3f} -> "
+              f"{regression['current']:.3f} ({regression['change_pct']:+.1f}%)")
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Synthetic dataset generator for scale testing.
+
+Fills patients, doctors, appointments and medical_notes directly, without the
+API, so production-sized data can be loaded locally:
+
+- doctor popularity follows a Zipf distribution (--skew), for appointments
+  and notes alike
+- every doctor's appointments are distinct weekday slots between 09:00 and
+  17:00, so uq_appointments_doctor_slot always holds
+- appointments span the last APPOINTMENT_ARCHIVE_AFTER_MONTHS months (older
+  ones would be archived at the next startup) and --months-ahead months ahead
+- medical notes span --years years; a minority of patients has most of them
+
+All accounts share one pre-hashed password (PASSWORD below), so nothing is
+hashed with bcrypt while loading. PostgreSQL is loaded with COPY, other
+databases with batched multi-row inserts. The same --seed and --today give
+the same data; tables that already hold rows are appended to.
+
+    python benchmarks/generate_dataset.py --database-url postgresql://localhost/medical_app \\
+        --patients 1000000 --doctors 2000 --appointments 2000000 --notes 10000000
+"""
+import argparse
+import bisect
+import csv
+import io
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+import unicodedata
+from datetime import date, datetime, timedelta
+from datetime import time as time_of_day
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MAX_NOTES = 10000000
+
+PASSWORD = 'Synthetic1!pass'
+# bcrypt (12 rounds) of PASSWORD
+PASSWORD_HASH = '$2b$12$Z9wRKFILh0wiYMKg3KNIX.q9Cg8GA.NowHmO592yGJ630wv82PTWq'
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'Anna', 'Zoë', 'José', 'Aisha', 'Wei', 'Olga', 'Sean', 'Chloé', 'Ravi', 'Ingrid',
+               'Oliver', 'Amelia', 'Mohammed', 'Fatima', 'Lucas', 'Sofia', 'Kenji', 'Priya', 'Tomasz', 'Nia']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'García', 'Miller', 'Davis', 'Müller',
+              'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore', 'Martin', 'Lee', 'Nguyen', 'Okafor',
+              'Kowalski', 'Ålander', 'Patel', 'Khan', 'Rossi', 'Novak', 'Silva', 'Tanaka', 'Murphy']
+STREETS = ['High Street', 'Station Road', 'Church Lane', 'Park Avenue', 'Mill Road', 'Victoria Street',
+           'Green Lane', 'Manor Road', 'Queens Road', 'The Crescent']
+TOWNS = ['London', 'Leeds', 'Bristol', 'Manchester', 'Cardiff', 'Glasgow', 'Norwich', 'York', 'Bath', 'Derby']
+GENDERS = ['Female', 'Male', 'Other']
+SPECIALTIES = ['General Practice', 'Cardiology', 'Dermatology', 'Paediatrics', 'Orthopaedics', 'Neurology',
+               'Psychiatry', 'Oncology', 'Endocrinology', 'Gastroenterology', 'Ophthalmology', 'Radiology']
+REASONS = ['Routine check-up', 'Follow-up visit', 'Blood test results', 'Persistent cough', 'Back pain',
+           'Medication review', 'Skin rash', 'Headaches', 'Vaccination', 'Chest pain', 'Joint pain', None]
+FINDINGS = ['Blood pressure {0}/{1} mmHg', 'Heart rate {0} bpm, regular', 'Temperature 37.{0} C',
+            'BMI {0}.{1}', 'HbA1c {0} mmol/mol', 'Reports symptoms for {0} days']
+MEDICATIONS = ['Amoxicillin 500 mg three times daily', 'Ibuprofen 400 mg as needed', 'Metformin 500 mg twice daily',
+               'Atorvastatin 20 mg nightly', 'Lisinopril 10 mg daily', 'Salbutamol inhaler as needed',
+               'Sertraline 50 mg daily', 'Levothyroxine 75 mcg daily', None, None]
+TREATMENTS = ['Rest and fluids', 'Physiotherapy referral', 'Lifestyle advice', 'Review in two weeks',
+              'Specialist referral', 'Blood test ordered', 'X-ray requested', 'No further action']
+
+# Weekday slots every 15 minutes from 09:00 to 16:45
+SLOT_TIMES = [time_of_day(9 + minutes // 60, minutes % 60) for minutes in range(0, 8 * 60, 15)]
+# A doctor's appointments fill at most this share of their slots
+MAX_UTILISATION = 0.9
+# Share of patients that have most of the medical notes
+FREQUENT_PATIENTS = 0.2
+
+TABLES = {
+    'doctors': ['doctor_id', 'first_name', 'last_name', 'specialty', 'phone', 'email', 'password_hash', 'version'],
+    'patients': ['patient_id', 'first_name', 'last_name', 'date_of_birth', 'gender', 'address', 'phone', 'email',
+                 'password_hash', 'version'],
+    'appointments': ['appointment_id', 'patient_id', 'doctor_id', 'appointment_date', 'appointment_time', 'reason',
+                     'created_at', 'version'],
+    'medical_notes': ['note_id', 'patient_id', 'doctor_id', 'note_date', 'note_details', 'medication', 'treatment',
+                      'created_at', 'version']
+}
+
+
+def zipf_weights(count, skew, rng):
+    """Popularity per doctor index; ranks are shuffled so ids don't give them away"""
+    ranks = list(range(1, count + 1))
+    rng.shuffle(ranks)
+    return [1.0 / rank ** skew for rank in ranks]
+
+
+def weighted_picker(weights, rng):
+    cumulative = list(itertools.accumulate(weights))
+    total = cumulative[-1]
+    return lambda: bisect.bisect_left(cumulative, rng.random() * total)
+
+
+def working_days(start, end):
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)
+            if (start + timedelta(days=offset)).weekday() < 5]
+
+
+def appointments_per_doctor(total, weights, capacity):
+    """Split ``total`` by weight, moving the excess of fully booked doctors to the others"""
+    limit = int(capacity * MAX_UTILISATION)
+    if total > limit * len(weights):
+        raise SystemExit(f'{total} appointments do not fit: {len(weights)} doctors have room for '
+                         f'{limit * len(weights)}. Add doctors or months.')
+    counts = [0] * len(weights)
+    open_doctors = list(range(len(weights)))
+    remaining = total
+    while remaining:
+        weight = sum(weights[d] for d in open_doctors)
+        shares = {d: int(remaining * weights[d] / weight) for d in open_doctors}
+        # Whatever rounding leaves over goes to the most popular open doctors
+        for d in sorted(open_doctors, key=lambda d: -weights[d])[:remaining - sum(shares.values())]:
+            shares[d] += 1
+        remaining = 0
+        for d, share in shares.items():
+            granted = min(share, limit - counts[d])
+            counts[d] += granted
+            remaining += share - granted
+        open_doctors = [d for d in open_doctors if counts[d] < limit]
+    return counts
+
+
+def email_part(name):
+    return unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+
+
+def doctors(first_id, count, rng):
+    for doctor_id in range(first_id, first_id + count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield (doctor_id, first, last, rng.choice(SPECIALTIES), f'+44 20 {rng.randrange(10 ** 8):08d}',
+               f'dr.{email_part(last)}.{doctor_id}@synthetic.example', PASSWORD_HASH, 1)
+
+
+def patients(first_id, count, today, rng):
+    for patient_id in range(first_id, first_id + count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        age_days = int(rng.triangular(0, 95, 45) * 365.25)
+        yield (patient_id, first, last, today - timedelta(days=age_days), rng.choice(GENDERS),
+               f'{rng.randrange(1, 300)} {rng.choice(STREETS)}, {rng.choice(TOWNS)}',
+               f'+44 7{rng.randrange(10 ** 9):09d}',
+               f'{email_part(first)}.{email_part(last)}.{patient_id}@synthetic.example', PASSWORD_HASH, 1)
+
+
+def appointments(first_id, counts, doctor_ids, patient_ids, days, today, rng):
+    appointment_id = first_id
+    for index, count in enumerate(counts):
+        # Distinct slot numbers, so no doctor is double-booked
+        for slot in sorted(rng.sample(range(len(days) * len(SLOT_TIMES)), count)):
+            day, slot_time = days[slot // len(SLOT_TIMES)], SLOT_TIMES[slot % len(SLOT_TIMES)]
+            booked = datetime.combine(min(day, today), time_of_day(8)) - timedelta(
+                days=rng.randrange(1, 60), minutes=rng.randrange(12 * 60))
+            yield (appointment_id, rng.choice(patient_ids), doctor_ids[index], day, slot_time,
+                   rng.choice(REASONS), booked, 1)
+            appointment_id += 1
+
+
+def finding(rng):
+    return rng.choice(FINDINGS).format(rng.randrange(60, 160), rng.randrange(10))
+
+
+def medical_notes(first_id, count, pick_doctor, doctor_ids, patient_ids, years, today, rng):
+    frequent = max(1, int(len(patient_ids) * FREQUENT_PATIENTS))
+    span = int(years * 365.25)
+    for note_id in range(first_id, first_id + count):
+        # Most notes belong to frequent attenders, spread over the whole history
+        if rng.random() < 0.8:
+            patient_id = patient_ids[rng.randrange(frequent)]
+        else:
+            patient_id = rng.choice(patient_ids)
+        note_date = today - timedelta(days=rng.randrange(span))
+        written = datetime.combine(note_date, time_of_day(9)) + timedelta(minutes=rng.randrange(9 * 60))
+        yield (note_id, patient_id, doctor_ids[pick_doctor()], note_date,
+               f'{finding(rng)}. {finding(rng)}.', rng.choice(MEDICATIONS), rng.choice(TREATMENTS), written, 1)
+
+
+def batches(rows, size):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def copy_rows(connection, table, columns, rows, batch_size):
+    """COPY ... FROM STDIN through the raw psycopg2 or psycopg connection"""
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    count = 0
+    with connection.cursor() as cursor:
+        for batch in batches(rows, batch_size):
+            buffer = io.StringIO()
+            # None is written as an unquoted empty field, which CSV COPY reads as NULL
+            csv.writer(buffer).writerows(batch)
+            buffer.seek(0)
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(statement, buffer)
+            else:
+                with cursor.copy(statement) as copy:
+                    copy.write(buffer.getvalue())
+            count += len(batch)
+    connection.commit()
+    return count
+
+
+def insert_rows(db, table, columns, rows, batch_size):
+    from sqlalchemy import insert
+    target = db.metadata.tables[table]
+    count = 0
+    for batch in batches(rows, batch_size):
+        db.session.execute(insert(target), [dict(zip(columns, row)) for row in batch])
+        db.session.commit()
+        count += len(batch)
+    return count
+
+
+def next_id(db, table, column):
+    from sqlalchemy import func, select
+    target = db.metadata.tables[table]
+    return (db.session.execute(select(func.max(target.c[column]))).scalar() or 0) + 1
+
+
+def reset_sequences(db):
+    from sqlalchemy import text
+    for table, columns in TABLES.items():
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', '{columns[0]}'), "
+                                f"(SELECT MAX({columns[0]}) FROM {table}))"))
+    db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite database')
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--doctors', type=int, default=500)
+    parser.add_argument('--appointments', type=int, default=500000)
+    parser.add_argument('--notes', type=int, default=1000000, help=f'At most {MAX_NOTES}')
+    parser.add_argument('--years', type=float, default=5.0, help='Length of the medical note history')
+    parser.add_argument('--months-ahead', type=int, default=3, help='How far ahead appointments are booked')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of doctor popularity')
+    parser.add_argument('--today', type=date.fromisoformat, default=date.today(),
+                        help='Reference date (YYYY-MM-DD); defaults to today')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args(argv)
+    if not 0 <= args.notes <= MAX_NOTES:
+        parser.error(f'--notes must be between 0 and {MAX_NOTES}')
+    if args.patients < 1 or args.doctors < 1:
+        parser.error('--patients and --doctors must be positive')
+
+    os.environ['DATABASE_URL'] = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'dataset.db')
+    from src.main import app
+    from src.models.user import db
+    from src import partitions
+    from sqlalchemy import text
+    # The bulk-load batches are expected to be slow
+    logging.getLogger('src.slow_query').setLevel(logging.ERROR)
+
+    # Separate generators, so changing one table's size leaves the others alone
+    rngs = {table: Random(f'{args.seed}-{table}') for table in TABLES}
+    months_back = app.config.get('APPOINTMENT_ARCHIVE_AFTER_MONTHS', 12)
+    first_month = partitions._add_months(args.today.replace(day=1), 1 - months_back)
+    days = working_days(first_month, partitions._add_months(args.today.replace(day=1), args.months_ahead + 1)
+                        - timedelta(days=1))
+
+    with app.app_context():
+        postgres = db.engine.dialect.name == 'postgresql'
+        first_ids = {table: next_id(db, table, columns[0]) for table, columns in TABLES.items()}
+        doctor_ids = list(range(first_ids['doctors'], first_ids['doctors'] + args.doctors))
+        patient_ids = list(range(first_ids['patients'], first_ids['patients'] + args.patients))
+        weights = zipf_weights(args.doctors, args.skew, rngs['doctors'])
+        counts = appointments_per_doctor(args.appointments, weights, len(days) * len(SLOT_TIMES))
+
+        if postgres and partitions.is_partitioned():
+            # Every generated month gets its partition instead of landing in the default one
+            partitions.ensure_partitions(args.months_ahead, today=args.today, since=first_month)
+
+        sources = {
+            'doctors': doctors(first_ids['doctors'], args.doctors, rngs['doctors']),
+            'patients': patients(first_ids['patients'], args.patients, args.today, rngs['patients']),
+            'appointments': appointments(first_ids['appointments'], counts, doctor_ids, patient_ids, days,
+                                         args.today, rngs['appointments']),
+            'medical_notes': medical_notes(first_ids['medical_notes'], args.notes,
+                                           weighted_picker(weights, rngs['medical_notes']), doctor_ids,
+                                           patient_ids, args.years, args.today, rngs['medical_notes'])
+        }
+
+        print(f"Loading into {db.engine.url.render_as_string(hide_password=True)} "
+              f"({'COPY' if postgres else 'batched inserts'}, seed {args.seed}, today {args.today})")
+        for table, rows in sources.items():
+            started = time.perf_counter()
+            if postgres:
+                connection = db.engine.raw_connection()
+                try:
+                    count = copy_rows(connection, table, TABLES[table], rows, args.batch_size)
+                finally:
+                    connection.close()
+            else:
+                count = insert_rows(db, table, TABLES[table], rows, args.batch_size)
+            elapsed = time.perf_counter() - started
+            print(f'  {table:<14} {count:>10} rows in {elapsed:8.1f}s ({count / max(elapsed, 1e-9):,.0f} rows/s)')
+
+        if postgres:
+            reset_sequences(db)
+            db.session.execute(text('ANALYZE'))
+            db.session.commit()
+
+    busiest = max(counts) if counts else 0
+    print(f'Busiest doctor has {busiest} appointments; every account\'s password is {PASSWORD!r}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Load-testing harness for the medical application.
+
+Starts the application (or targets --base-url), prepares accounts, then runs
+scripted scenarios with multi-process clients and reports throughput and
+p50/p95/p99 latency per endpoint. Results are saved as JSON and can be
+compared against a baseline file; the exit status is non-zero on regression.
+The started application runs with RATE_LIMIT_ENABLED=0; a server given with
+--base-url needs the same setting or its limits will skew the results.
+
+    python benchmarks/load_test.py --processes 8 --requests 200 \\
+        --output results.json --baseline baseline.json
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchutil import compare, environment, print_regressions, save_results, load_results, summarize_latencies
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'LoadTest1!pass'
+SCENARIOS = ('register', 'login', 'booking_storm', 'notes_list', 'gdpr_export')
+STORM_SLOTS = [f'{hour:02d}:{minute:02d}' for hour in (9, 10, 11, 12, 14) for minute in (0, 30)]
+
+
+def start_server(port, database_url, command=None, env=None):
+    """Start the app (``run.py`` unless ``command`` is given) and wait until it answers"""
+    # Every client connects from 127.0.0.1, so rate limiting is switched off
+    env = dict(os.environ, PORT=str(port), DATABASE_URL=database_url, FLASK_ENV='development',
+               RATE_LIMIT_ENABLED='0', **(env or {}))
+    # The request log goes to a file: an unread pipe fills up and blocks the server
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen(command or [sys.executable, 'run.py'], cwd=PROJECT_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=log)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f'Application exited early: {log.read().decode()[-2000:]}')
+        try:
+            requests.get(f'{base_url}/api/gdpr/privacy-policy', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Application did not start within 60 seconds')
+
+
+def prepare(base_url, processes, run_tag):
+    """Create one patient per client process, a doctor, and some notes to list"""
+    session = requests.Session()
+    doctor = {
+        'first_name': 'Load', 'last_name': 'Doctor', 'email': f'lt-doctor-{run_tag}@loadtest.example',
+        'password': PASSWORD, 'specialty': 'General Practice'
+    }
+    session.post(f'{base_url}/api/register/doctor', json=doctor).raise_for_status()
+    response = session.post(f'{base_url}/api/login/doctor', json={'email': doctor['email'], 'password': PASSWORD})
+    response.raise_for_status()
+    doctor_token = response.json()['access_token']
+    doctor_id = response.json()['user']['doctor_id']
+
+    patients = []
+    for worker in range(processes):
+        email = f'lt-patient-{run_tag}-{worker}@loadtest.example'
+        session.post(f'{base_url}/api/register/patient', json={
+            'first_name': 'Load', 'last_name': f'Patient{worker}', 'email': email, 'password': PASSWORD
+        }).raise_for_status()
+        response = session.post(f'{base_url}/api/login/patient', json={'email': email, 'password': PASSWORD})
+        response.raise_for_status()
+        patients.append({'email': email, 'token': response.json()['access_token'],
+                         'patient_id': response.json()['user']['patient_id']})
+
+    auth = {'Authorization': f'Bearer {doctor_token}'}
+    for patient in patients:
+        for day in range(1, 6):
+            session.post(f'{base_url}/api/medical-notes', headers=auth, json={
+                'patient_id': patient['patient_id'], 'note_date': f'2024-01-{day:02d}',
+                'note_details': 'Routine follow-up', 'medication': 'None', 'treatment': 'Rest'
+            }).raise_for_status()
+    return {'doctor_token': doctor_token, 'doctor_id': doctor_id, 'patients': patients}
+
+
+def run_worker(job):
+    """Run one scenario for one client process; returns (endpoint, seconds, status) samples"""
+    scenario, worker, count, base_url, fixtures, run_tag, seed = job
+    rng = random.Random(seed * 1000 + worker)
+    session = requests.Session()
+    patient = fixtures['patients'][worker]
+    patient_auth = {'Authorization': f"Bearer {patient['token']}"}
+    doctor_auth = {'Authorization': f"Bearer {fixtures['doctor_token']}"}
+    samples = []
+
+    for sequence in range(count):
+        headers = {}
+        if scenario == 'register':
+            endpoint, method, url = 'POST /api/register/patient', 'post', '/api/register/patient'
+            body = {'first_name': 'Reg', 'last_name': 'Patient', 'password': PASSWORD,
+                    'email': f'lt-reg-{run_tag}-{worker}-{sequence}@loadtest.example'}
+        elif scenario == 'login':
+            endpoint, method, url = 'POST /api/login/patient', 'post', '/api/login/patient'
+            # One in four attempts uses an unknown email, as in a credential-stuffing mix
+            email = patient['email'] if rng.random() < 0.75 else f'unknown-{rng.getrandbits(48):x}@loadtest.example'
+            body = {'email': email, 'password': PASSWORD}
+        elif scenario == 'booking_storm':
+            endpoint, method, url = 'POST /api/appointments', 'post', '/api/appointments'
+            headers.update(patient_auth)
+            body = {'doctor_id': fixtures['doctor_id'], 'appointment_date': '2031-06-02',
+                    'appointment_time': rng.choice(STORM_SLOTS), 'reason': 'Load test'}
+        elif scenario == 'notes_list':
+            use_doctor = sequence % 2 == 0
+            endpoint = 'GET /api/medical-notes (doctor)' if use_doctor else 'GET /api/medical-notes (patient)'
+            method, url, body = 'get', '/api/medical-notes', None
+            headers.update(doctor_auth if use_doctor else patient_auth)
+        elif scenario == 'gdpr_export':
+            endpoint, method, url, body = 'GET /api/gdpr/data-export', 'get', '/api/gdpr/data-export', None
+            headers.update(patient_auth)
+        else:
+            raise ValueError(f'Unknown scenario {scenario}')
+
+        started = time.perf_counter()
+        try:
+            response = session.request(method, base_url + url, json=body, headers=headers, timeout=60)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        samples.append((endpoint, time.perf_counter() - started, status))
+    return samples
+
+
+def run_scenario(pool, scenario, processes, count, base_url, fixtures, run_tag, seed):
+    jobs = [(scenario, worker, count, base_url, fixtures, run_tag, seed) for worker in range(processes)]
+    started = time.perf_counter()
+    results = pool.map(run_worker, jobs)
+    wall_seconds = time.perf_counter() - started
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    for samples in results:
+        for endpoint, seconds, status in samples:
+            latencies[endpoint].append(seconds)
+            statuses[endpoint][status] += 1
+
+    report = {}
+    for endpoint, values in latencies.items():
+        summary = summarize_latencies(values, wall_seconds)
+        summary['statuses'] = {str(status): n for status, n in sorted(statuses[endpoint].items())}
+        # Status 0 marks a connection error or timeout
+        summary['errors'] = sum(n for status, n in statuses[endpoint].items() if status == 0 or status >= 500)
+        report[endpoint] = summary
+    return {'wall_seconds': wall_seconds, 'endpoints': report}
+
+
+def print_report(results):
+    print(f"{'scenario':<14} {'endpoint':<36} {'count':>6} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for scenario, result in results['scenarios'].items():
+        for endpoint, summary in result['endpoints'].items():
+            print(f"{scenario:<14} {endpoint:<36} {summary['count']:>6} {summary['throughput_rps']:>8.1f} "
+                  f"{summary['p50_ms']:>8.1f} {summary['p95_ms']:>8.1f} {summary['p99_ms']:>8.1f} {summary['errors']:>5}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', help='Target a running server instead of starting run.py')
+    parser.add_argument('--database-url', help='DATABASE_URL for the started server (default: temporary SQLite file)')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--processes', type=int, default=4, help='Concurrent client processes')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per client per scenario')
+    parser.add_argument('--register-requests', type=int, default=5,
+                        help='Requests per client for the bcrypt-bound registration scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='load_test_results.json')
+    parser.add_argument('--baseline', help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression as a fraction')
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    process = None
+    tmp_dir = None
+    database_url = args.database_url
+    if args.base_url:
+        base_url = args.base_url.rstrip('/')
+    else:
+        if not database_url:
+            tmp_dir = tempfile.mkdtemp(prefix='loadtest-')
+            database_url = f"sqlite:///{os.path.join(tmp_dir, 'loadtest.db')}"
+        process, base_url = start_server(args.port, database_url)
+
+    run_tag = f'{args.seed}-{int(time.time())}'
+    try:
+        fixtures = prepare(base_url, args.processes, run_tag)
+        results = {
+            'environment': environment(),
+            'config': {
+                'processes': args.processes, 'requests': args.requests, 'seed': args.seed,
+                'database': (database_url or 'external').split(':', 1)[0]
+            },
+            'scenarios': {}
+        }
+        with multiprocessing.Pool(args.processes) as pool:
+            for scenario in scenarios:
+                count = args.register_requests if scenario == 'register' else args.requests
+                results['scenarios'][scenario] = run_scenario(
+                    pool, scenario, args.processes, count, base_url, fixtures, run_tag, args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(results)
+    save_results(args.output, results)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        regressions = compare(results['scenarios'], load_results(args.baseline)['scenarios'],
+                              {'p95_ms': 'lower', 'p99_ms': 'lower', 'throughput_rps': 'higher'},
+                              args.tolerance)
+        print_regressions(regressions)
+        if regressions:
+            return 1
+        print('No regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
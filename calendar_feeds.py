@@ -0,0 +1,296 @@
+"""
+iCalendar feeds of a doctor's or patient's appointments.
+
+Calendar apps poll a subscription URL every few minutes, so each worker
+keeps the rendered feeds in a bounded LRU. A feed holds one pre-rendered
+VEVENT per appointment. When ``book_appointment``, ``update_appointment`` or
+``cancel_appointment`` commit, the VEVENT is patched in the patient's and the
+doctor's cached feeds, and the body is joined again on the next poll
+without reading appointments. Responses carry an ETag of the body, so an
+unchanged feed is a 304.
+
+Writes in other workers reach this one's cache through a check against
+the database at most every ``CALENDAR_SYNC_SECONDS`` per feed. The check
+reads the count, highest id and version total of the owner's
+appointments, which changes on every booking, update and cancellation.
+Only if it differs from the cached events is the feed rebuilt. Feeds are
+also rebuilt after ``CALENDAR_REBUILD_SECONDS``, which picks up renamed
+patients and doctors.
+
+Calendar apps cannot send a bearer token, so the URL carries a random
+secret stored with the user (``calendar_secret``), which is the same in
+every worker and survives restarts. Every poll compares it with the stored
+one by primary key, cached or not, so a rotated URL or an erased account
+stops being served in every worker at once. Events name the other party
+and the time, never the reason.
+"""
+import hashlib
+import hmac
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+
+from sqlalchemy import func, select, update
+from src.models.user import db, Appointment, Doctor, Patient
+from src.fieldsets import fields_statement
+
+EVENT_FIELDS = ('appointment_id', 'patient_id', 'doctor_id', 'appointment_date', 'appointment_time',
+                'created_at', 'version', 'patient_name', 'doctor_name')
+
+_OWNER_TYPES = {'p': 'patient', 'd': 'doctor'}
+_TOKEN = re.compile(r'^([pd])(\d+)-([A-Za-z0-9_-]+)$')
+
+_HEADER = ('BEGIN:VCALENDAR\r\n'
+           'VERSION:2.0\r\n'
+           'PRODID:-//Secure Medical Web Application//Appointments//EN\r\n'
+           'CALSCALE:GREGORIAN\r\n'
+           'METHOD:PUBLISH\r\n'
+           'X-WR-CALNAME:Appointments\r\n')
+_FOOTER = 'END:VCALENDAR\r\n'
+
+
+def _account(user_type):
+    model = Patient if user_type == 'patient' else Doctor
+    return model, getattr(model, f'{user_type}_id')
+
+
+def feed_secret(user_type, user_id, rotate=False):
+    """Secret of a user's feed URL, created on first use or replaced with ``rotate``
+
+    None if the account does not exist. The caller commits.
+    """
+    model, id_column = _account(user_type)
+    current = select(model.calendar_secret).where(id_column == user_id)
+    if not rotate:
+        secret = db.session.execute(current).scalar()
+        if secret is not None:
+            return secret
+    secret = secrets.token_urlsafe(24)
+    statement = update(model).where(id_column == user_id).values(calendar_secret=secret)
+    if not rotate:
+        # Two first requests racing each other settle on one secret
+        statement = statement.where(model.calendar_secret.is_(None))
+    if db.session.execute(statement).rowcount == 0:
+        return db.session.execute(current).scalar()
+    return secret
+
+
+def feed_token(user_type, user_id, secret):
+    """Token for the ``/calendar/<token>.ics`` URL of a user's feed"""
+    return f'{user_type[0]}{user_id}-{secret}'
+
+
+def parse_token(token):
+    """``((user_type, user_id), secret)`` of a well-formed token, or None"""
+    match = _TOKEN.match(token)
+    if not match:
+        return None
+    return (_OWNER_TYPES[match.group(1)], int(match.group(2))), match.group(3)
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """RFC 5545 line folding at 75 octets, without splitting a character"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Back off to the start of a UTF-8 character
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode('utf-8'))
+        start, limit = end, 74
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def render_event(appointment, owner_type, minutes):
+    """VEVENT for an appointment mapping with the ``EVENT_FIELDS``"""
+    if owner_type == 'patient':
+        summary = f"Appointment with Dr. {appointment['doctor_name'] or 'unknown'}"
+    else:
+        summary = f"Appointment: {appointment['patient_name'] or 'unknown patient'}"
+    start = f"{appointment['appointment_date']:%Y%m%d}T{appointment['appointment_time']:%H%M%S}"
+    # created_at is naive UTC from the models, aware from a schema.sql database
+    created = appointment['created_at']
+    if created is not None and created.tzinfo is not None:
+        created = created.astimezone(timezone.utc)
+    stamp = f'{created:%Y%m%dT%H%M%S}Z' if created is not None else f'{start}Z'
+    lines = (
+        'BEGIN:VEVENT',
+        f"UID:appointment-{appointment['appointment_id']}@secure-medical-app",
+        f'DTSTAMP:{stamp}',
+        f"SEQUENCE:{appointment['version'] - 1}",
+        f'DTSTART:{start}',
+        f'DURATION:PT{minutes}M',
+        f'SUMMARY:{_escape(summary)}',
+        'END:VEVENT'
+    )
+    return ''.join(_fold(line) for line in lines)
+
+
+class _Feed:
+    def __init__(self, events, now):
+        # appointment_id -> (sort key, version, VEVENT)
+        self.events = events
+        self.body = None
+        self.etag = None
+        self.checked_at = now
+        self.built_at = now
+        # Bumped by every patch so a concurrent rebuild does not overwrite one
+        self.generation = 0
+
+    def fingerprint(self):
+        if not self.events:
+            return (0, None, 0)
+        return (len(self.events), max(self.events), sum(version for _, version, _ in self.events.values()))
+
+    def rendered(self):
+        if self.body is None:
+            ordered = sorted(self.events.values(), key=lambda event: event[0])
+            self.body = _HEADER + ''.join(event[2] for event in ordered) + _FOOTER
+            self.etag = hashlib.sha256(self.body.encode('utf-8')).hexdigest()[:32]
+        return self.body, self.etag
+
+
+class FeedCache:
+    """Rendered feeds of this worker, patched by its own writes"""
+
+    def __init__(self):
+        self.max_entries = 10000
+        self.sync_seconds = 300.0
+        self.rebuild_seconds = 3600.0
+        self.event_minutes = 30
+        self._feeds = OrderedDict()  # (user_type, user_id) -> _Feed
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries=10000, sync_seconds=300.0, rebuild_seconds=3600.0, event_minutes=30):
+        self.max_entries = max_entries
+        self.sync_seconds = sync_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.event_minutes = event_minutes
+
+    def _event(self, appointment, owner_type):
+        key = (appointment['appointment_date'], appointment['appointment_time'], appointment['appointment_id'])
+        return key, appointment['version'], render_event(appointment, owner_type, self.event_minutes)
+
+    def _criterion(self, owner):
+        column = Appointment.patient_id if owner[0] == 'patient' else Appointment.doctor_id
+        return column == owner[1]
+
+    def _build(self, owner):
+        rows = db.session.execute(fields_statement('appointments', EVENT_FIELDS, self._criterion(owner))).all()
+        return {row.appointment_id: self._event(row._mapping, owner[0]) for row in rows}
+
+    def _stored_secret(self, owner):
+        """The owner's feed secret, None for a deleted account"""
+        model, id_column = _account(owner[0])
+        return db.session.execute(select(model.calendar_secret).where(id_column == owner[1])).scalar()
+
+    def _stored_state(self, owner):
+        """The owner's feed secret and appointment fingerprint"""
+        model, id_column = _account(owner[0])
+        row = db.session.execute(select(select(model.calendar_secret).where(id_column == owner[1]).scalar_subquery(),
+                                        func.count(), func.max(Appointment.appointment_id),
+                                        func.coalesce(func.sum(Appointment.version), 0))
+                                 .where(self._criterion(owner))).first()
+        return row[0], (row[1], row[2], row[3])
+
+    def render(self, owner, secret):
+        """``(body, etag)`` of a feed, or None if ``secret`` is not the owner's
+
+        Always reads the stored secret, which may have been rotated or erased
+        in another worker; appointments are read only when a check or rebuild
+        is due.
+        """
+        now = time.monotonic()
+        with self._lock:
+            feed = self._feeds.get(owner)
+            if feed is not None:
+                self._feeds.move_to_end(owner)
+                fresh = now - feed.checked_at < self.sync_seconds
+                generation, fingerprint = feed.generation, feed.fingerprint()
+
+        if feed is not None and fresh:
+            stored_secret = self._stored_secret(owner)
+        else:
+            stored_secret, stored_fingerprint = self._stored_state(owner)
+        if stored_secret is None or not hmac.compare_digest(stored_secret, secret):
+            return None
+        if feed is not None and (fresh or (now - feed.built_at < self.rebuild_seconds
+                                           and stored_fingerprint == fingerprint)):
+            with self._lock:
+                if not fresh:
+                    feed.checked_at = now
+                return feed.rendered()
+
+        events = self._build(owner)
+        with self._lock:
+            current = self._feeds.get(owner)
+            if current is not None and current is feed and current.generation != generation:
+                # Patched while building; keep the patch and check again next poll
+                current.checked_at = 0
+                return current.rendered()
+            feed = _Feed(events, now)
+            self._feeds[owner] = feed
+            self._feeds.move_to_end(owner)
+            while len(self._feeds) > self.max_entries:
+                self._feeds.popitem(last=False)
+            return feed.rendered()
+
+    def _patch(self, owner, appointment_id, event):
+        feed = self._feeds.get(owner)
+        if feed is None:
+            return
+        if event is None:
+            feed.events.pop(appointment_id, None)
+        else:
+            feed.events[appointment_id] = event
+        feed.body = None
+        feed.generation += 1
+
+    def appointment_saved(self, appointment):
+        """Patch the cached feeds after a booking or update commits"""
+        with self._lock:
+            for owner_type in ('patient', 'doctor'):
+                owner = (owner_type, appointment[f'{owner_type}_id'])
+                if owner in self._feeds:
+                    self._patch(owner, appointment['appointment_id'], self._event(appointment, owner_type))
+
+    def appointment_removed(self, appointment_id, patient_id, doctor_id):
+        """Drop the appointment from the cached feeds after a cancellation commits"""
+        with self._lock:
+            self._patch(('patient', patient_id), appointment_id, None)
+            self._patch(('doctor', doctor_id), appointment_id, None)
+
+    def forget(self, owner):
+        """Drop a feed after its secret was rotated or the account erased"""
+        with self._lock:
+            self._feeds.pop(owner, None)
+
+    def clear(self):
+        with self._lock:
+            self._feeds.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'feeds': len(self._feeds), 'max_entries': self.max_entries,
+                    'sync_seconds': self.sync_seconds}
+
+
+feeds = FeedCache()
+
+
+def init_app(app):
+    feeds.configure(max_entries=app.config.get('CALENDAR_CACHE_SIZE', 10000),
+                    sync_seconds=app.config.get('CALENDAR_SYNC_SECONDS', 300.0),
+                    rebuild_seconds=app.config.get('CALENDAR_REBUILD_SECONDS', 3600.0),
+                    event_minutes=app.config.get('CALENDAR_EVENT_MINUTES', 30))
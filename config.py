@@ -1,5 +1,6 @@
 import os
 import secrets
+from datetime import timedelta
 
 class Config:
     """Base configuration"""
@@ -13,9 +14,133 @@ class Config:
     SESSION_COOKIE_SAMESITE = 'Lax'
     
     # JWT configurations
-    JWT_ACCESS_TOKEN_EXPIRES = False  # Set to timedelta for expiration
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)
+    JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=7)
     JWT_COOKIE_SECURE = True
     JWT_COOKIE_CSRF_PROTECT = True
+    
+    # bcrypt work factor for new password hashes; existing hashes keep theirs
+    BCRYPT_ROUNDS = 12
+    
+    # Revoked token ids are synced from the database at most this often per worker
+    TOKEN_REVOCATION_SYNC_SECONDS = 1.0
+    # Rows of expired tokens are deleted by revocations at most this often per worker
+    TOKEN_REVOCATION_PURGE_SECONDS = 300.0
+    
+    # JSON request body limits, enforced before parsing
+    MAX_JSON_BODY_BYTES = 1024 * 1024
+    MAX_JSON_DEPTH = 32
+    MAX_JSON_KEYS = 2000
+    
+    # Proxies in front of the app that append to X-Forwarded-For; with 0 the
+    # header is ignored and rate limits and security logs use the peer address
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', '0'))
+    
+    # Per-address request limits; benchmarks turn them off with RATE_LIMIT_ENABLED=0
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+    
+    # Async read endpoints served by src.asgi, with their own connection pool;
+    # ASYNC_DATABASE_URL defaults to DATABASE_URL with the async driver
+    ASYNC_READS_ENABLED = os.environ.get('ASYNC_READS_ENABLED', '1') != '0'
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    ASYNC_DB_POOL_SIZE = 20
+    ASYNC_DB_MAX_OVERFLOW = 30
+    ASYNC_DB_POOL_TIMEOUT = 30
+    ASGI_SYNC_THREADS = 32
+    
+    # Bounded retries for transient write failures (lock timeouts, deadlocks)
+    DB_RETRY_ATTEMPTS = 3
+    DB_RETRY_BASE_DELAY = 0.02
+    
+    # Monthly appointment partitions (PostgreSQL) and archival of old months.
+    # Archival runs with `python -m src.partitions maintain`; set
+    # APPOINTMENT_ARCHIVE_AT_STARTUP=1 to also run it whenever the app starts
+    APPOINTMENT_PARTITION_MONTHS_AHEAD = 12
+    APPOINTMENT_ARCHIVE_AFTER_MONTHS = 12
+    APPOINTMENT_ARCHIVE_AT_STARTUP = os.environ.get('APPOINTMENT_ARCHIVE_AT_STARTUP', '0') == '1'
+    
+    # iCalendar feeds, cached per worker and checked against the database at
+    # most every CALENDAR_SYNC_SECONDS for writes made by other workers
+    CALENDAR_CACHE_SIZE = 10000
+    CALENDAR_SYNC_SECONDS = 300.0
+    CALENDAR_REBUILD_SECONDS = 3600.0
+    CALENDAR_EVENT_MINUTES = 30
+    
+    # Appointment reminders sent by `python -m src.reminders run`
+    REMINDER_LEAD_HOURS = 24
+    REMINDER_INTERVAL_SECONDS = 60
+    REMINDER_BATCH_SIZE = 100
+    REMINDER_MAX_CONCURRENCY = 4
+    REMINDER_MAX_ATTEMPTS = 3
+    REMINDER_RETENTION_DAYS = 30
+    REMINDER_TRANSPORT = os.environ.get('REMINDER_TRANSPORT', 'file')
+    REMINDER_FILE_DIR = os.environ.get('REMINDER_FILE_DIR') or os.path.join('instance', 'reminders')
+    REMINDER_SENDER = os.environ.get('REMINDER_SENDER', 'reminders@localhost')
+    REMINDER_SMTP_HOST = os.environ.get('REMINDER_SMTP_HOST', 'localhost')
+    REMINDER_SMTP_PORT = int(os.environ.get('REMINDER_SMTP_PORT', 25))
+    REMINDER_SMTP_USERNAME = os.environ.get('REMINDER_SMTP_USERNAME')
+    REMINDER_SMTP_PASSWORD = os.environ.get('REMINDER_SMTP_PASSWORD')
+    REMINDER_SMTP_STARTTLS = os.environ.get('REMINDER_SMTP_STARTTLS') == '1'
+    
+    # Per-doctor daily rollups kept by `python -m src.doctor_stats refresh`
+    DOCTOR_STATS_REFRESH_SECONDS = 60
+    DOCTOR_STATS_BATCH_SIZE = 500
+    ANALYTICS_MAX_DAYS = 366
+    
+    # Medical note history: a full copy every N versions, deltas in between
+    NOTE_REVISION_SNAPSHOT_INTERVAL = 10
+    
+    # Medical note attachments, stored by content hash on local disk
+    ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR') or os.path.join('instance', 'attachments')
+    ATTACHMENT_MAX_BYTES = 2 * 1024 ** 3
+    ATTACHMENT_CONTENT_TYPES = ['application/pdf', 'image/jpeg', 'image/png', 'image/tiff', 'application/dicom']
+    ATTACHMENT_UPLOAD_EXPIRY_HOURS = 24
+    # Released files are deleted by a job once unreferenced and untouched this long
+    ATTACHMENT_GC_GRACE_SECONDS = 600
+    
+    # Background jobs run by `python -m src.job_queue work`
+    JOB_WORKER_PROCESSES = 2
+    JOB_POLL_SECONDS = 1.0
+    JOB_VISIBILITY_TIMEOUT_SECONDS = 300
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_BASE_SECONDS = 10
+    JOB_RETRY_MAX_SECONDS = 3600
+    JOB_RETENTION_HOURS = 24
+    # Most jobs of a queue running at once across all workers; other queues are uncapped
+    JOB_QUEUE_CONCURRENCY = {'gdpr': 2}
+    
+    # Negative-lookup filter for login/registration emails
+    EMAIL_FILTER_ENABLED = True
+    EMAIL_FILTER_ERROR_RATE = 0.01
+    EMAIL_FILTER_SYNC_SECONDS = 1.0
+    
+    # Idempotency-Key replay for POST endpoints
+    IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+    IDEMPOTENCY_CACHE_SIZE = 10000
+    IDEMPOTENCY_WAIT_SECONDS = 10.0
+    IDEMPOTENCY_LOCK_SECONDS = 60.0
+    # Each worker deletes expired keys, and the responses stored with them, at most this often
+    IDEMPOTENCY_PURGE_SECONDS = 300.0
+    
+    # Prometheus metrics; set METRICS_MULTIPROC_DIR to aggregate across workers.
+    # Scrapes must send "Authorization: Bearer <METRICS_TOKEN>"; unset disables /metrics
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR')
+    METRICS_FLUSH_SECONDS = 5.0
+    
+    # Slow-query capture; plans are only sampled on PostgreSQL
+    SLOW_QUERY_ENABLED = True
+    SLOW_QUERY_THRESHOLD_MS = 200
+    SLOW_QUERY_EXPLAIN_SAMPLE_RATE = 0.1
+    SLOW_QUERY_LOG_DIR = os.environ.get('SLOW_QUERY_LOG_DIR')
+    SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+    SLOW_QUERY_LOG_BACKUPS = 5
+    
+    # On-demand request profiling; no hooks are installed unless one of these is set
+    PROFILING_ADMIN_TOKENS = [t for t in os.environ.get('PROFILING_ADMIN_TOKENS', '').split(',') if t]
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+    PROFILING_INTERVAL_MS = 1
+    PROFILING_OUTPUT_DIR = os.environ.get('PROFILING_OUTPUT_DIR')
 
 class DevelopmentConfig(Config):
     """Development configuration"""
@@ -36,8 +161,16 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    # One in-memory database per process; TEST_DATABASE_URL (set by
+    # `pytest --postgres`) points the tests at PostgreSQL instead
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    SESSION_COOKIE_SECURE = False
+    
+    # The cheapest work factor bcrypt allows
+    BCRYPT_ROUNDS = 4
+    
+    METRICS_TOKEN = 'test-metrics-token'
 
 config = {
     'development': DevelopmentConfig,
@@ -0,0 +1,172 @@
+"""
+Helpers for contended writes.
+
+Uniqueness is enforced by the database: inserts use the dialect's
+``ON CONFLICT DO NOTHING`` so a losing writer gets no row back instead of
+an error, and transient failures (lock timeouts, serialization failures,
+deadlocks) are retried a bounded number of times with jittered backoff.
+
+Updates are optimistic: every row carries a ``version`` that is exposed as
+its ETag, and an update is a single compare-and-swap
+``UPDATE ... WHERE version IN (If-Match) RETURNING``. Only when that
+matches nothing is the row read, to tell 404, 403 and 412 apart.
+
+Existence checks are left to foreign keys and unique constraints;
+``integrity_error_kind`` tells the resulting errors apart so views can keep
+their 404/400 responses. SQLite enforces foreign keys only when asked, so
+every SQLite connection turns them on.
+"""
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, jsonify, request
+from sqlalchemy import delete, event, insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from src.models.user import db
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 0.02
+
+# Striped in-process locks standing in for advisory locks on SQLite
+_LOCK_STRIPES = 64
+_slot_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def integrity_error_kind(error):
+    """``'foreign_key'``, ``'unique'`` or None for an IntegrityError"""
+    orig = error.orig
+    # psycopg2 exposes pgcode, psycopg 3 sqlstate
+    code = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    message = str(orig)
+    if code == '23503' or 'FOREIGN KEY constraint failed' in message:
+        return 'foreign_key'
+    if code == '23505' or 'UNIQUE constraint failed' in message:
+        return 'unique'
+    return None
+
+
+def insert_ignoring_conflicts(table, index_elements):
+    """INSERT that does nothing when it would violate the unique index on ``index_elements``.
+
+    Supported on PostgreSQL and SQLite (3.24+). Other dialects get a plain
+    INSERT, so callers must still treat IntegrityError as a conflict.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert(table)
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+
+@contextmanager
+def slot_lock(key):
+    """Serialize writers for ``key`` within this process when the database is SQLite.
+
+    SQLite has no advisory locks and allows one writer at a time, so
+    contenders for the same slot queue here instead of spinning on the
+    database lock. PostgreSQL relies on the unique constraint alone.
+    """
+    if db.session.get_bind().dialect.name != 'sqlite':
+        yield
+        return
+    lock = _slot_locks[hash(key) % _LOCK_STRIPES]
+    with lock:
+        yield
+
+
+def run_with_retry(operation, attempts=None, base_delay=None):
+    """Call ``operation`` and retry it on transient database errors.
+
+    The session is rolled back between attempts. The last error is raised
+    once ``attempts`` is exhausted.
+    """
+    config = current_app.config
+    attempts = attempts or config.get('DB_RETRY_ATTEMPTS', DEFAULT_RETRY_ATTEMPTS)
+    base_delay = base_delay if base_delay is not None else config.get('DB_RETRY_BASE_DELAY', DEFAULT_RETRY_BASE_DELAY)
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except OperationalError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            # Full jitter keeps retrying writers from colliding again in lockstep
+            time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+
+
+def etag(version):
+    """Strong ETag for a row version"""
+    return f'"{version}"'
+
+
+def etag_response(payload, version, status=200):
+    response = jsonify(payload)
+    response.headers['ETag'] = etag(version)
+    return response, status
+
+
+def if_match_versions():
+    """Versions accepted by the request's If-Match header.
+
+    None when the header is absent or ``*`` (update unconditionally),
+    otherwise a list that is empty when no tag names a version.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+
+def versioned_update(model, key_criterion, values, *criteria, versions=None):
+    """Compare-and-swap UPDATE applying ``values`` and bumping ``version``.
+
+    It matches only when the key, the extra ``criteria`` (e.g. ownership)
+    and, unless ``versions`` is None, one of the expected versions hold.
+    Run it with ``write_returning`` to get the updated row back.
+    """
+    table = model.__table__
+    statement = update(table).where(key_criterion, *criteria)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    return statement.values(version=table.c.version + 1, **values)
+
+
+def versioned_delete(model, key_criterion, *criteria, versions=None):
+    """DELETE with the same matching rules as ``versioned_update``"""
+    table = model.__table__
+    statement = delete(table).where(key_criterion, *criteria)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    return statement
+
+
+def missed_write(model, key_criterion, name, owner=None):
+    """Response for a versioned update or delete that matched no row.
+
+    ``owner`` is an optional ``(column, expected value)`` ownership check.
+    """
+    owner_column = owner[0] if owner else model.version
+    row = db.session.query(owner_column, model.version).filter(key_criterion).first()
+    db.session.rollback()
+    if row is None:
+        return jsonify({'error': f'{name} not found'}), 404
+    if owner and row[0] != owner[1]:
+        return jsonify({'error': 'Access denied'}), 403
+    response = jsonify({'error': f'{name} was modified by another request; fetch it again and retry'})
+    response.headers['ETag'] = etag(row[1])
+    return response, 412
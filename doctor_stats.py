@@ -0,0 +1,311 @@
+"""
+Per-doctor daily rollups: appointments, attendance and medical notes.
+
+    python -m src.doctor_stats refresh          # every DOCTOR_STATS_REFRESH_SECONDS
+    python -m src.doctor_stats refresh --once
+    python -m src.doctor_stats rebuild --from 2025-01-01 --to 2025-12-31
+
+Triggers on ``appointments`` and ``medical_notes`` append the doctor and day
+of every inserted, updated or deleted row to ``doctor_stats_changes``, so the
+write paths run no extra statements. ``refresh`` takes the highest change id
+as its watermark and reads the changes up to it in pages of
+``DOCTOR_STATS_BATCH_SIZE``. For each page it recounts the changed (doctor,
+day) pairs from the base tables, writes them to ``doctor_daily_stats`` and
+deletes the page's changes, in one transaction. Changes made meanwhile wait
+for the next pass. Recounting is idempotent, so a pass that fails part way
+is simply repeated.
+
+An appointment counts as attended when the doctor wrote a medical note for
+that patient on that day; past appointments without one are no-shows.
+Appointments carry no attendance of their own.
+
+Days before ``partitions.archive_cutoff`` are frozen: their appointments
+leave the live table when they are archived, so their counts are kept as
+they were rather than recounted.
+
+``rebuild`` marks every (doctor, day) in a date range as changed and runs a
+refresh, for backfills and after restoring data.
+"""
+import argparse
+import logging
+import sys
+import time as time_module
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import and_, case, delete, exists, func, insert, or_, select, text, union
+from src.models.user import db, Appointment, DoctorDailyStats, DoctorStatsChange, MedicalNote
+from src import partitions
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the advisory lock that keeps workers from creating the triggers at once
+_LOCK_KEY = 7302047
+
+# (table, date column, columns whose change moves a row to another doctor, day or patient)
+_SOURCES = (
+    ('appointments', 'appointment_date', 'doctor_id, appointment_date, patient_id'),
+    ('medical_notes', 'note_date', 'doctor_id, note_date, patient_id')
+)
+
+
+_NOTES_INDEX = 'CREATE INDEX IF NOT EXISTS ix_medical_notes_doctor_date ON medical_notes (doctor_id, note_date)'
+
+
+def _sqlite_ddl():
+    statements = []
+    for source, day, columns in _SOURCES:
+        mark = 'INSERT INTO doctor_stats_changes (doctor_id, day) VALUES ({row}.doctor_id, {row}.' + day + ');'
+        statements += [
+            f"""CREATE TRIGGER IF NOT EXISTS {source}_stats_insert AFTER INSERT ON {source} BEGIN
+                {mark.format(row='NEW')}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {source}_stats_update AFTER UPDATE OF {columns} ON {source} BEGIN
+                {mark.format(row='OLD')}
+                {mark.format(row='NEW')}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {source}_stats_delete AFTER DELETE ON {source} BEGIN
+                {mark.format(row='OLD')}
+            END"""
+        ]
+    return statements
+
+
+def _postgresql_ddl(source, day, columns):
+    """The trigger function and the trigger for one table"""
+    return (
+        f"""CREATE OR REPLACE FUNCTION {source}_stats_mark() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO doctor_stats_changes (doctor_id, day) VALUES (OLD.doctor_id, OLD.{day});
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO doctor_stats_changes (doctor_id, day) VALUES (NEW.doctor_id, NEW.{day});
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""",
+        # On the partitioned appointments table this applies to every partition
+        f"""CREATE TRIGGER {source}_stats AFTER INSERT OR UPDATE OF {columns} OR DELETE ON {source}
+        FOR EACH ROW EXECUTE FUNCTION {source}_stats_mark()"""
+    )
+
+
+def create_triggers():
+    """Create the triggers, and the notes index the recounts need on databases that predate it"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        db.session.execute(text(_NOTES_INDEX))
+        for statement in _sqlite_ddl():
+            db.session.execute(text(statement))
+    elif dialect == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _LOCK_KEY})
+        db.session.execute(text(_NOTES_INDEX))
+        existing = set(db.session.execute(text(
+            "SELECT tgname FROM pg_trigger WHERE tgname IN ('appointments_stats', 'medical_notes_stats')"
+        )).scalars())
+        for source, day, columns in _SOURCES:
+            if f'{source}_stats' not in existing:
+                for statement in _postgresql_ddl(source, day, columns):
+                    db.session.execute(text(statement))
+    db.session.commit()
+
+
+def frozen_before(config, today=None):
+    """First day still recounted; older days are archived"""
+    return partitions.archive_cutoff(config.get('APPOINTMENT_ARCHIVE_AFTER_MONTHS', 12), today)
+
+
+def _keyed(doctor_column, day_column, keys):
+    """Rows for any of the (doctor, day) ``keys``, as index lookups per doctor"""
+    days = defaultdict(list)
+    for doctor_id, day in keys:
+        days[doctor_id].append(day)
+    return or_(*(and_(doctor_column == doctor_id, day_column.in_(doctor_days))
+                 for doctor_id, doctor_days in days.items()))
+
+
+def _counts(keys):
+    """``{(doctor_id, day): [appointments, attended, notes]}`` recounted from the base tables"""
+    counts = {}
+    attended = exists().where(MedicalNote.doctor_id == Appointment.doctor_id,
+                              MedicalNote.patient_id == Appointment.patient_id,
+                              MedicalNote.note_date == Appointment.appointment_date)
+    appointment_rows = db.session.execute(
+        select(Appointment.doctor_id, Appointment.appointment_date, func.count(),
+               func.sum(case((attended, 1), else_=0)))
+        .where(_keyed(Appointment.doctor_id, Appointment.appointment_date, keys))
+        .group_by(Appointment.doctor_id, Appointment.appointment_date)
+    )
+    for doctor_id, day, appointments, attended_count in appointment_rows:
+        counts[(doctor_id, day)] = [appointments, attended_count or 0, 0]
+    note_rows = db.session.execute(
+        select(MedicalNote.doctor_id, MedicalNote.note_date, func.count())
+        .where(_keyed(MedicalNote.doctor_id, MedicalNote.note_date, keys))
+        .group_by(MedicalNote.doctor_id, MedicalNote.note_date)
+    )
+    for doctor_id, day, notes in note_rows:
+        counts.setdefault((doctor_id, day), [0, 0, 0])[2] = notes
+    return counts
+
+
+def _recount(keys, now):
+    counts = _counts(keys)
+    db.session.execute(delete(DoctorDailyStats)
+                       .where(_keyed(DoctorDailyStats.doctor_id, DoctorDailyStats.day, keys)))
+    if counts:
+        db.session.execute(insert(DoctorDailyStats), [
+            {'doctor_id': doctor_id, 'day': day, 'appointments': appointments, 'attended': attended,
+             'notes': notes, 'refreshed_at': now}
+            for (doctor_id, day), (appointments, attended, notes) in counts.items()
+        ])
+
+
+def refresh(batch_size=500, frozen_before=None):
+    """Recount the days changed up to the current watermark; returns the number of doctor-days recounted"""
+    watermark = db.session.execute(select(func.max(DoctorStatsChange.id))).scalar()
+    recounted = 0
+    while watermark is not None:
+        changes = db.session.execute(
+            select(DoctorStatsChange.id, DoctorStatsChange.doctor_id, DoctorStatsChange.day)
+            .where(DoctorStatsChange.id <= watermark)
+            .order_by(DoctorStatsChange.id)
+            .limit(batch_size)
+        ).all()
+        if not changes:
+            break
+        keys = list({(change.doctor_id, change.day) for change in changes
+                     if frozen_before is None or change.day >= frozen_before})
+        if keys:
+            _recount(keys, datetime.utcnow())
+        # Only the changes read: one committed after the watermark was taken stays for the next pass
+        db.session.execute(delete(DoctorStatsChange)
+                           .where(DoctorStatsChange.id.in_([change.id for change in changes])))
+        db.session.commit()
+        recounted += len(keys)
+    db.session.rollback()
+    return recounted
+
+
+def rebuild(start=None, end=None, batch_size=500, frozen_before=None):
+    """Recount every (doctor, day) between ``start`` and ``end``, inclusive"""
+    start = max(filter(None, (start, frozen_before)), default=None)
+    sources = []
+    for model, day in ((Appointment, Appointment.appointment_date), (MedicalNote, MedicalNote.note_date),
+                       (DoctorDailyStats, DoctorDailyStats.day)):
+        statement = select(model.doctor_id, day)
+        if start:
+            statement = statement.where(day >= start)
+        if end:
+            statement = statement.where(day <= end)
+        sources.append(statement)
+    db.session.execute(insert(DoctorStatsChange).from_select(['doctor_id', 'day'], union(*sources)))
+    db.session.commit()
+    return refresh(batch_size, frozen_before)
+
+
+def daily(doctor_id, start, end, today=None):
+    """One dict per day with activity, read from the rollup only"""
+    today = today or date.today()
+    rows = db.session.execute(
+        select(DoctorDailyStats.day, DoctorDailyStats.appointments, DoctorDailyStats.attended,
+               DoctorDailyStats.notes)
+        .where(DoctorDailyStats.doctor_id == doctor_id, DoctorDailyStats.day.between(start, end))
+        .order_by(DoctorDailyStats.day)
+    )
+    return [{
+        'date': day,
+        'appointments': appointments,
+        'attended': attended,
+        # Not known until the day is over
+        'no_shows': appointments - attended if day < today else None,
+        'notes': notes
+    } for day, appointments, attended, notes in rows]
+
+
+def _no_show_rate(no_shows, past_appointments):
+    return round(no_shows / past_appointments, 4) if past_appointments else None
+
+
+def summarize(days):
+    past = [day for day in days if day['no_shows'] is not None]
+    no_shows = sum(day['no_shows'] for day in past)
+    past_appointments = sum(day['appointments'] for day in past)
+    return {
+        'appointments': sum(day['appointments'] for day in days),
+        'past_appointments': past_appointments,
+        'no_shows': no_shows,
+        'no_show_rate': _no_show_rate(no_shows, past_appointments),
+        'notes': sum(day['notes'] for day in days)
+    }
+
+
+def doctors_summary(start, end, today=None):
+    """Totals per doctor between ``start`` and ``end``, busiest first"""
+    today = today or date.today()
+    stats = DoctorDailyStats
+    past = stats.day < today
+    rows = db.session.execute(
+        select(stats.doctor_id,
+               func.sum(stats.appointments).label('appointments'),
+               func.sum(case((past, stats.appointments), else_=0)).label('past_appointments'),
+               func.sum(case((past, stats.appointments - stats.attended), else_=0)).label('no_shows'),
+               func.sum(stats.notes).label('notes'),
+               func.count().label('active_days'))
+        .where(stats.day.between(start, end))
+        .group_by(stats.doctor_id)
+        .order_by(func.sum(stats.appointments).desc(), stats.doctor_id)
+    )
+    return [{
+        'doctor_id': row.doctor_id,
+        'appointments': row.appointments,
+        'past_appointments': row.past_appointments,
+        'no_shows': row.no_shows,
+        'no_show_rate': _no_show_rate(row.no_shows, row.past_appointments),
+        'notes': row.notes,
+        'active_days': row.active_days
+    } for row in rows]
+
+
+def init_app(app):
+    """Create the change-marking triggers; runs after ``db.create_all``"""
+    with app.app_context():
+        create_triggers()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Doctor utilization rollups')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('refresh', help='Recount changed days')
+    run.add_argument('--once', action='store_true', help='Refresh once and exit')
+    backfill = subparsers.add_parser('rebuild', help='Recount every day in a range')
+    backfill.add_argument('--from', dest='start', type=date.fromisoformat, help='YYYY-MM-DD')
+    backfill.add_argument('--to', dest='end', type=date.fromisoformat, help='YYYY-MM-DD')
+    args = parser.parse_args(argv)
+
+    from src.main import app
+    with app.app_context():
+        batch_size = app.config.get('DOCTOR_STATS_BATCH_SIZE', 500)
+        if args.command == 'rebuild':
+            count = rebuild(args.start, args.end, batch_size, frozen_before(app.config))
+            print(f'Recounted {count} doctor-days')
+            return 0
+        interval = app.config.get('DOCTOR_STATS_REFRESH_SECONDS', 60)
+        while True:
+            started = time_module.monotonic()
+            try:
+                count = refresh(batch_size, frozen_before(app.config))
+                if count:
+                    print(f'Recounted {count} doctor-days')
+            except Exception:
+                db.session.rollback()
+                logger.exception('Doctor stats refresh failed')
+                if args.once:
+                    return 1
+            if args.once:
+                return 0
+            time_module.sleep(max(interval - (time_module.monotonic() - started), 0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Per-worker negative-lookup filter of registered account emails.
+
+Login and registration floods mostly use emails that were never registered.
+A counting Bloom filter answers "definitely not registered" without touching
+the database; anything the filter might contain still goes to the database,
+so a false positive only costs the query we would have made anyway.
+
+Other workers' registrations are pulled in by an indexed primary-key range
+query per sync interval. Ids are assigned at insert but become visible at
+commit, and SQLite hands the id of a deleted newest row to the next one, so
+each sync also rereads ``_SYNC_OVERLAP`` ids below the watermark; the ids
+and emails in that window are remembered so none is added twice.
+
+Lookups, negatives and false positives are counted in ``/metrics``, with the
+expected false positive rate and one measured by probing the filter with
+random emails: at startup, and in a background thread after the filter
+outgrows its capacity and is rebuilt.
+"""
+import hashlib
+import math
+import secrets
+import threading
+import time
+import uuid
+from collections import deque
+
+from src.models.user import db, Patient, Doctor
+from src.metrics import registry
+
+# Counters saturate instead of wrapping so a hot slot can never drop to zero
+_COUNTER_MAX = 255
+
+# Random emails probed to measure the false positive rate after a rebuild
+FALSE_POSITIVE_PROBES = 10000
+
+# Ids below the watermark reread by every sync, as in token_revocation
+_SYNC_OVERLAP = 100
+
+
+class CountingBloomFilter:
+    """Bloom filter with 8-bit counters so entries can also be removed"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.counters = bytearray(self.size)
+        self.count = 0
+        # Per-process key so the slot layout cannot be precomputed by an attacker
+        self._key = secrets.token_bytes(16)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16, key=self._key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hash_count)]
+
+    def add(self, item):
+        counters = self.counters
+        for position in self._positions(item):
+            if counters[position] < _COUNTER_MAX:
+                counters[position] += 1
+        self.count += 1
+
+    def discard(self, item):
+        positions = self._positions(item)
+        counters = self.counters
+        # Only remove items that are (probably) present, otherwise we would
+        # decrement slots owned by other entries and create false negatives
+        if not all(counters[position] for position in positions):
+            return
+        for position in positions:
+            if 0 < counters[position] < _COUNTER_MAX:
+                counters[position] -= 1
+        self.count = max(self.count - 1, 0)
+
+    def __contains__(self, item):
+        counters = self.counters
+        for position in self._positions(item):
+            if not counters[position]:
+                return False
+        return True
+
+    def expected_false_positive_rate(self):
+        """Theoretical false positive rate at the current fill level"""
+        if not self.count:
+            return 0.0
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class RegisteredEmailFilter:
+    """Tracks the registered emails of one account table for this worker"""
+
+    def __init__(self, model, id_attr, min_capacity=1024):
+        self.model = model
+        self.id_column = getattr(model, id_attr)
+        self.min_capacity = min_capacity
+        self.enabled = False
+        self.error_rate = 0.01
+        self.sync_seconds = 1.0
+        self._filter = None
+        self._watermark = 0
+        # Id -> email of the accounts in the filter with ids in the overlap window
+        # or above the watermark, so rereading them does not add them twice
+        self._seen = {}
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+        self._labels = (('table', model.__tablename__),)
+
+    def configure(self, enabled=True, error_rate=0.01, sync_seconds=1.0):
+        self.enabled = enabled
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+
+    def rebuild(self, batch_size=1000):
+        """Rebuild the filter from a streaming query over the whole table"""
+        if not self.enabled:
+            return
+        total = db.session.query(db.func.count(self.id_column)).scalar() or 0
+        new_filter = CountingBloomFilter(max(total * 2, self.min_capacity), self.error_rate)
+        watermark = 0
+        # Ids are ascending, so the overlap window is among the last rows
+        newest = deque(maxlen=_SYNC_OVERLAP)
+        rows = (db.session.query(self.id_column, self.model.email)
+                .order_by(self.id_column)
+                .yield_per(batch_size))
+        for user_id, email in rows:
+            new_filter.add(email)
+            watermark = max(watermark, user_id)
+            newest.append((user_id, email))
+
+        with self._lock:
+            self._filter = new_filter
+            self._watermark = watermark
+            self._seen = {user_id: email for user_id, email in newest if user_id > watermark - _SYNC_OVERLAP}
+            self._last_sync = time.monotonic()
+        self._record_fill()
+
+    def _record_fill(self):
+        current = self._filter
+        registry.set('email_filter_entries', self._labels, current.count)
+        registry.set('email_filter_false_positive_rate', self._labels + (('estimate', 'expected'),),
+                     current.expected_false_positive_rate())
+
+    def record_measured_rate(self):
+        registry.set('email_filter_false_positive_rate', self._labels + (('estimate', 'measured'),),
+                     self.measure_false_positive_rate())
+
+    def sync(self):
+        """Pull in accounts registered by other workers since the last sync.
+
+        Runs at most once per ``sync_seconds`` so a flood costs one indexed
+        primary-key range query per interval rather than one query per request.
+        """
+        now = time.monotonic()
+        if now - self._last_sync < self.sync_seconds or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sync = now
+            rows = (db.session.query(self.id_column, self.model.email)
+                    .filter(self.id_column > self._watermark - _SYNC_OVERLAP)
+                    .order_by(self.id_column)
+                    .all())
+            added = False
+            for user_id, email in rows:
+                if self._seen.get(user_id) != email:
+                    self._filter.add(email)
+                    self._seen[user_id] = email
+                    added = True
+                self._watermark = max(self._watermark, user_id)
+            self._seen = {user_id: email for user_id, email in self._seen.items()
+                          if user_id > self._watermark - _SYNC_OVERLAP}
+            needs_rebuild = self._filter.count > self._filter.capacity
+        finally:
+            self._lock.release()
+
+        if needs_rebuild:
+            self.rebuild()
+            # Probing takes a while; keep it off the request that triggered the rebuild
+            threading.Thread(target=self.record_measured_rate, name='email-filter-probe', daemon=True).start()
+        elif added:
+            self._record_fill()
+
+    def might_exist(self, email):
+        """False means the email is definitely not registered"""
+        if not self.enabled or self._filter is None or not isinstance(email, str):
+            return True
+        self.sync()
+        registry.increment('email_filter_lookups_total', self._labels)
+        if email in self._filter:
+            return True
+        registry.increment('email_filter_negatives_total', self._labels)
+        return False
+
+    def lookup(self, email):
+        """Return the account for ``email``, skipping the query for unknown emails"""
+        if not self.might_exist(email):
+            return None
+        account = self.model.query.filter_by(email=email).first()
+        if account is None and self.enabled and self._filter is not None:
+            registry.increment('email_filter_false_positives_total', self._labels)
+        return account
+
+    def add(self, email, user_id):
+        """Add an account registered by this worker; the next sync will not add it again"""
+        if self._filter is None:
+            return
+        with self._lock:
+            if self._seen.get(user_id) == email:
+                return
+            self._filter.add(email)
+            if user_id > self._watermark - _SYNC_OVERLAP:
+                self._seen[user_id] = email
+
+    def discard(self, email, user_id):
+        if self._filter is None:
+            return
+        with self._lock:
+            # Accounts in the overlap window or newer may not be in the filter yet;
+            # removing them would decrement slots owned by other emails
+            if user_id <= self._watermark - _SYNC_OVERLAP or self._seen.get(user_id) == email:
+                self._filter.discard(email)
+                self._seen.pop(user_id, None)
+
+    def measure_false_positive_rate(self, samples=FALSE_POSITIVE_PROBES):
+        """Probe the filter with emails that cannot be registered"""
+        current = self._filter
+        if current is None or samples <= 0:
+            return None
+        hits = sum(1 for _ in range(samples) if f'{uuid.uuid4().hex}@fp-probe.invalid' in current)
+        return hits / samples
+
+
+patient_emails = RegisteredEmailFilter(Patient, 'patient_id')
+doctor_emails = RegisteredEmailFilter(Doctor, 'doctor_id')
+
+
+def init_app(app):
+    """Configure and build the email filters for this worker"""
+    for email_filter in (patient_emails, doctor_emails):
+        email_filter.configure(
+            enabled=app.config.get('EMAIL_FILTER_ENABLED', True),
+            error_rate=app.config.get('EMAIL_FILTER_ERROR_RATE', 0.01),
+            sync_seconds=app.config.get('EMAIL_FILTER_SYNC_SECONDS', 1.0)
+        )
+    with app.app_context():
+        for email_filter in (patient_emails, doctor_emails):
+            email_filter.rebuild()
+            if email_filter.enabled:
+                email_filter.record_measured_rate()
@@ -0,0 +1,153 @@
+"""
+Sparse fieldsets (``?fields=a,b,c``) pushed down into SQL.
+
+Each resource has an allow-list mapping public field names to column
+expressions. Only the requested columns are selected, and the joins to
+patients/doctors for ``patient_name``/``doctor_name`` are only added when
+one of those fields is requested.
+
+The same allow-lists shape the ``RETURNING`` clause of writes, so an insert
+or update returns the public representation without reloading the row.
+"""
+from flask import request
+from sqlalchemy import select
+from src.models.user import db, Patient, Doctor, Appointment, MedicalNote
+
+
+class Resource:
+    def __init__(self, model, fields, joins=None):
+        self.model = model
+        # field name -> (column expression, join name or None)
+        self.fields = fields
+        # join name -> (model, foreign key column shared by both tables)
+        self.joins = joins or {}
+
+    def join(self, join_name, source):
+        """``(model, onclause)`` joining ``source`` (a table or CTE) for ``join_name``"""
+        model, column = self.joins[join_name]
+        return model, getattr(model, column) == source.c[column]
+
+
+def _full_name(model):
+    return model.first_name + ' ' + model.last_name
+
+
+def _record_resource(model, id_column, own_fields):
+    fields = {id_column: (getattr(model, id_column), None)}
+    fields['patient_id'] = (model.patient_id, None)
+    fields['doctor_id'] = (model.doctor_id, None)
+    for name in own_fields:
+        fields[name] = (getattr(model, name), None)
+    fields['patient_name'] = (_full_name(Patient), 'patient')
+    fields['doctor_name'] = (_full_name(Doctor), 'doctor')
+    joins = {'patient': (Patient, 'patient_id'), 'doctor': (Doctor, 'doctor_id')}
+    return Resource(model, fields, joins)
+
+
+RESOURCES = {
+    'patients': Resource(Patient, {
+        name: (getattr(Patient, name), None)
+        for name in ('patient_id', 'first_name', 'last_name', 'date_of_birth',
+                     'gender', 'address', 'phone', 'email', 'version')
+    }),
+    'doctors': Resource(Doctor, {
+        name: (getattr(Doctor, name), None)
+        for name in ('doctor_id', 'first_name', 'last_name', 'specialty', 'phone', 'email', 'version')
+    }),
+    'appointments': _record_resource(Appointment, 'appointment_id', (
+        'appointment_date', 'appointment_time', 'reason', 'created_at', 'version')),
+    'medical_notes': _record_resource(MedicalNote, 'note_id', (
+        'note_date', 'note_details', 'medication', 'treatment', 'created_at', 'version'))
+}
+
+
+def requested_fields(resource_name):
+    """Parse ``?fields=``.
+
+    Returns ``(fields, error)``: ``fields`` is None when the parameter is
+    absent, and ``error`` is a message for a 400 response when it names
+    fields outside the resource's allow-list.
+    """
+    raw = request.args.get('fields')
+    if raw is None:
+        return None, None
+    fields = list(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    if not fields:
+        return None, 'fields must name at least one field'
+    allowed = RESOURCES[resource_name].fields
+    unknown = [name for name in fields if name not in allowed]
+    if unknown:
+        return None, f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}"
+    return fields, None
+
+
+def all_fields(resource_name):
+    """Every public field of a resource, in ``to_dict`` order"""
+    return list(RESOURCES[resource_name].fields)
+
+
+def fields_statement(resource_name, fields, *criteria, include=()):
+    """SELECT of only ``fields`` (plus ``include``) for rows matching ``criteria``"""
+    resource = RESOURCES[resource_name]
+    names = list(dict.fromkeys(list(fields) + list(include)))
+    columns = [resource.fields[name][0].label(name) for name in names]
+    statement = select(*columns).select_from(resource.model)
+    for join_name in dict.fromkeys(resource.fields[name][1] for name in names):
+        if join_name is not None:
+            statement = statement.join(*resource.join(join_name, resource.model.__table__))
+    return statement.where(*criteria)
+
+
+def select_fields(resource_name, fields, *criteria, include=()):
+    """Query only ``fields`` (plus ``include``) for rows matching ``criteria``.
+
+    Returns result rows, which support attribute access like the models, so
+    access checks such as ``row.patient_id`` work unchanged.
+    """
+    return db.session.execute(fields_statement(resource_name, fields, *criteria, include=include)).all()
+
+
+def only(row, fields):
+    """The requested fields of a row, without columns selected only for access checks"""
+    mapping = row._mapping
+    return {name: mapping[name] for name in fields}
+
+
+def write_returning(statement, resource_name):
+    """Execute an INSERT/UPDATE/DELETE and return the affected row's public fields.
+
+    Returns a dict shaped like the model's ``to_dict``, or None when no row
+    was written. On PostgreSQL the statement runs in a CTE joined to
+    patients/doctors for the names, so this is a single round trip; other
+    databases cannot put DML in a CTE and read the names with one more
+    SELECT.
+    """
+    resource = RESOURCES[resource_name]
+    table = resource.model.__table__
+    own = [name for name, (_, join_name) in resource.fields.items() if join_name is None]
+    joined = [name for name, (_, join_name) in resource.fields.items() if join_name is not None]
+    statement = statement.returning(*(table.c[name] for name in own))
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        written = statement.cte('written')
+        query = select(*(written.c[name] for name in own),
+                       *(resource.fields[name][0].label(name) for name in joined))
+        query = query.select_from(written)
+        for join_name in dict.fromkeys(resource.fields[name][1] for name in joined):
+            query = query.outerjoin(*resource.join(join_name, written))
+        row = db.session.execute(query).first()
+        return dict(row._mapping) if row else None
+
+    row = db.session.execute(statement).first()
+    if row is None:
+        return None
+    result = dict(row._mapping)
+    if joined:
+        names = []
+        for name in joined:
+            expression, join_name = resource.fields[name]
+            model, column = resource.joins[join_name]
+            names.append(select(expression).where(getattr(model, column) == result[column])
+                         .scalar_subquery().label(name))
+        result.update(db.session.execute(select(*names)).first()._mapping)
+    return result
@@ -1,63 +1,191 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime, timedelta
-from src.models.user import db, Patient, Doctor, Appointment, MedicalNote
+from sqlalchemy import delete, select
+from src.models.user import (
+    db, Patient, Doctor, Appointment, AppointmentArchive, MedicalNote, MedicalNoteRevision, NoteAttachment,
+    IdempotencyKey, Job
+)
+from src.email_filter import patient_emails, doctor_emails
+from src.db_utils import etag_response, if_match_versions, missed_write, versioned_update
+from src.fieldsets import RESOURCES, all_fields, fields_statement, only, write_returning
+from src.partitions import archived_statement, unpack as unpack_archive
+from src.note_revisions import export_statements as note_export_statements, superseded
+from src import attachment_store
+from src.calendar_feeds import feeds
+from src.job_queue import Fail, accepted, enqueue, pending, respond_async, task
 import json
 
 gdpr_bp = Blueprint('gdpr', __name__)
 
+# User type -> (fieldset resource, owner column)
+_SUBJECTS = {'patient': ('patients', 'patient_id'), 'doctor': ('doctors', 'doctor_id')}
+
+# Sections read as ORM objects or single values rather than rows
+_SCALAR_SECTIONS = ('archived_appointments', 'note_attachments', 'revisions')
+
+def export_statements(current_user):
+    """The SELECTs behind the export of ``current_user``, by section; None for an unknown user type.
+
+    Shared by this view and the async one in ``src.asgi``: run each
+    statement, pass its result through ``export_result`` and the results
+    to ``build_export``.
+    """
+    if current_user['type'] not in _SUBJECTS:
+        return None
+    resource, owner = _SUBJECTS[current_user['type']]
+    user_id = current_user['id']
+    statements = {
+        'account': fields_statement(resource, all_fields(resource), RESOURCES[resource].fields[owner][0] == user_id),
+        'appointments': fields_statement('appointments', all_fields('appointments'),
+                                         getattr(Appointment, owner) == user_id),
+        # Appointments from months moved to the archive
+        'archived_appointments': archived_statement(owner, user_id),
+        'medical_notes': fields_statement('medical_notes', all_fields('medical_notes'),
+                                          getattr(MedicalNote, owner) == user_id),
+        # Attachment metadata; the files are downloaded separately
+        'note_attachments': select(NoteAttachment).where(getattr(NoteAttachment, owner) == user_id)
+    }
+    # Earlier versions of the notes, including deleted ones
+    statements['current_notes'], statements['revisions'] = note_export_statements(owner, user_id)
+    return statements
+
+def export_result(section, result):
+    """The rows of one section's result, as ``build_export`` expects them"""
+    return result.scalars().all() if section in _SCALAR_SECTIONS else result.all()
+
+def build_export(current_user, results):
+    """The export document from the results of ``export_statements``, or None if the account is gone"""
+    if not results['account']:
+        return None
+    resource, _ = _SUBJECTS[current_user['type']]
+    data = only(results['account'][0], all_fields(resource))
+    data['appointments'] = [only(row, all_fields('appointments')) for row in results['appointments']]
+    data['archived_appointments'] = unpack_archive(results['archived_appointments'])
+    data['medical_notes'] = [only(row, all_fields('medical_notes')) for row in results['medical_notes']]
+    data['medical_note_revisions'] = superseded(results['current_notes'], results['revisions'])
+    data['note_attachments'] = [attachment.to_dict() for attachment in results['note_attachments']]
+    return {
+        'export_date': datetime.utcnow().isoformat(),
+        'data_subject': current_user['type'],
+        'data': data
+    }
+
+def _export(current_user):
+    """Everything held about ``current_user`` (a JWT identity), or None if the account is gone"""
+    statements = export_statements(current_user)
+    if statements is None:
+        return None
+    results = {section: export_result(section, db.session.execute(statement))
+               for section, statement in statements.items()}
+    return build_export(current_user, results)
+
+def _remove_from_feeds(current_user, appointments):
+    """Drop the erased account's feed and its appointments from this worker's cached feeds"""
+    feeds.forget((current_user['type'], current_user['id']))
+    for appointment in appointments:
+        feeds.appointment_removed(*appointment)
+
+def _erase(current_user):
+    """Delete everything held about ``current_user``; False if the account is gone"""
+    identity = f"{current_user['type']}:{current_user['id']}"
+    # Finished exports hold a copy of the data; the erasure's own job is kept so it can be followed
+    Job.query.filter(Job.owner == identity, Job.name != 'gdpr.erase').delete(synchronize_session=False)
+    
+    if current_user['type'] == 'patient':
+        patient = Patient.query.get(current_user['id'])
+        if not patient:
+            return False
+        
+        # Delete related data first (due to foreign key constraints)
+        MedicalNote.query.filter_by(patient_id=current_user['id']).delete()
+        MedicalNoteRevision.query.filter_by(patient_id=current_user['id']).delete()
+        attachment_store.erase('patient_id', current_user['id'])
+        removed = db.session.execute(delete(Appointment).where(Appointment.patient_id == current_user['id'])
+                                     .returning(Appointment.appointment_id, Appointment.patient_id,
+                                                Appointment.doctor_id)).all()
+        AppointmentArchive.query.filter_by(patient_id=current_user['id']).delete()
+        # Stored responses for retried requests contain personal data too
+        IdempotencyKey.query.filter_by(identity=identity).delete()
+        
+        # Delete patient record
+        email = patient.email
+        db.session.delete(patient)
+        db.session.commit()
+        patient_emails.discard(email, current_user['id'])
+        _remove_from_feeds(current_user, removed)
+        return True
+        
+    elif current_user['type'] == 'doctor':
+        doctor = Doctor.query.get(current_user['id'])
+        if not doctor:
+            return False
+        
+        # Note: In a real system, you might want to handle this differently
+        # as deleting a doctor might affect patient care continuity
+        # You might want to anonymize rather than delete
+        
+        # Delete related data first
+        MedicalNote.query.filter_by(doctor_id=current_user['id']).delete()
+        MedicalNoteRevision.query.filter_by(doctor_id=current_user['id']).delete()
+        attachment_store.erase('doctor_id', current_user['id'])
+        removed = db.session.execute(delete(Appointment).where(Appointment.doctor_id == current_user['id'])
+                                     .returning(Appointment.appointment_id, Appointment.patient_id,
+                                                Appointment.doctor_id)).all()
+        AppointmentArchive.query.filter_by(doctor_id=current_user['id']).delete()
+        IdempotencyKey.query.filter_by(identity=identity).delete()
+        
+        # Delete doctor record
+        email = doctor.email
+        db.session.delete(doctor)
+        db.session.commit()
+        doctor_emails.discard(email, current_user['id'])
+        _remove_from_feeds(current_user, removed)
+        return True
+    return False
+
+@task('gdpr.export', queue='gdpr')
+def export_job(user):
+    """Background export; the job's result is the export"""
+    export_data = _export(user)
+    if export_data is None:
+        raise Fail('Account not found')
+    return export_data
+
+@task('gdpr.erase', queue='gdpr')
+def erase_job(user):
+    """Background erasure; running it again after it succeeded does nothing"""
+    if not _erase(user):
+        return {'message': 'No data left to delete'}
+    return {'message': 'User data deleted successfully'}
+
+def _queue_job(name, current_user):
+    """202 for the caller's ``name`` job, reusing one that has not finished yet"""
+    identity = f"{current_user['type']}:{current_user['id']}"
+    job = pending(name, identity)
+    if job is None:
+        job = enqueue(name, {'user': current_user}, owner=identity)
+        db.session.commit()
+    return accepted(job)
+
 @gdpr_bp.route('/gdpr/data-export', methods=['GET'])
 @jwt_required()
 def export_user_data():
-    """Export all user data in JSON format (GDPR Article 20 - Right to data portability)"""
+    """Export all user data in JSON format (GDPR Article 20 - Right to data portability).
+
+    With ``Prefer: respond-async`` the export is built by a job instead.
+    """
     current_user = get_jwt_identity()
+    if current_user['type'] not in _SUBJECTS:
+        return jsonify({'error': 'Invalid user type'}), 400
     
     try:
-        if current_user['type'] == 'patient':
-            patient = Patient.query.get(current_user['id'])
-            if not patient:
-                return jsonify({'error': 'Patient not found'}), 404
-            
-            # Collect all patient data
-            patient_data = patient.to_dict()
-            
-            # Get appointments
-            appointments = Appointment.query.filter_by(patient_id=current_user['id']).all()
-            patient_data['appointments'] = [appointment.to_dict() for appointment in appointments]
-            
-            # Get medical notes
-            medical_notes = MedicalNote.query.filter_by(patient_id=current_user['id']).all()
-            patient_data['medical_notes'] = [note.to_dict() for note in medical_notes]
-            
-            # Add metadata
-            export_data = {
-                'export_date': datetime.utcnow().isoformat(),
-                'data_subject': 'patient',
-                'data': patient_data
-            }
-            
-        elif current_user['type'] == 'doctor':
-            doctor = Doctor.query.get(current_user['id'])
-            if not doctor:
-                return jsonify({'error': 'Doctor not found'}), 404
-            
-            # Collect all doctor data
-            doctor_data = doctor.to_dict()
-            
-            # Get appointments
-            appointments = Appointment.query.filter_by(doctor_id=current_user['id']).all()
-            doctor_data['appointments'] = [appointment.to_dict() for appointment in appointments]
-            
-            # Get medical notes created by doctor
-            medical_notes = MedicalNote.query.filter_by(doctor_id=current_user['id']).all()
-            doctor_data['medical_notes'] = [note.to_dict() for note in medical_notes]
-            
-            # Add metadata
-            export_data = {
-                'export_date': datetime.utcnow().isoformat(),
-                'data_subject': 'doctor',
-                'data': doctor_data
-            }
+        if respond_async():
+            return _queue_job('gdpr.export', current_user)
+        
+        export_data = _export(current_user)
+        if export_data is None:
+            return jsonify({'error': f"{current_user['type'].capitalize()} not found"}), 404
         
         return jsonify(export_data), 200
         
@@ -67,43 +195,21 @@ def export_user_data():
 @gdpr_bp.route('/gdpr/data-deletion', methods=['DELETE'])
 @jwt_required()
 def request_data_deletion():
-    """Request deletion of all user data (GDPR Article 17 - Right to erasure)"""
+    """Request deletion of all user data (GDPR Article 17 - Right to erasure).
+
+    With ``Prefer: respond-async`` the data is deleted by a job instead.
+    """
     current_user = get_jwt_identity()
     
     try:
-        if current_user['type'] == 'patient':
-            patient = Patient.query.get(current_user['id'])
-            if not patient:
-                return jsonify({'error': 'Patient not found'}), 404
-            
-            # Delete related data first (due to foreign key constraints)
-            MedicalNote.query.filter_by(patient_id=current_user['id']).delete()
-            Appointment.query.filter_by(patient_id=current_user['id']).delete()
-            
-            # Delete patient record
-            db.session.delete(patient)
-            db.session.commit()
-            
-            return jsonify({'message': 'Patient data deleted successfully'}), 200
-            
-        elif current_user['type'] == 'doctor':
-            doctor = Doctor.query.get(current_user['id'])
-            if not doctor:
-                return jsonify({'error': 'Doctor not found'}), 404
-            
-            # Note: In a real system, you might want to handle this differently
-            # as deleting a doctor might affect patient care continuity
-            # You might want to anonymize rather than delete
-            
-            # Delete related data first
-            MedicalNote.query.filter_by(doctor_id=current_user['id']).delete()
-            Appointment.query.filter_by(doctor_id=current_user['id']).delete()
-            
-            # Delete doctor record
-            db.session.delete(doctor)
-            db.session.commit()
-            
-            return jsonify({'message': 'Doctor data deleted successfully'}), 200
+        if respond_async():
+            return _queue_job('gdpr.erase', current_user)
+        
+        if not _erase(current_user):
+            db.session.rollback()
+            return jsonify({'error': f"{current_user['type'].capitalize()} not found"}), 404
+        
+        return jsonify({'message': f"{current_user['type'].capitalize()} data deleted successfully"}), 200
             
     except Exception as e:
         db.session.rollback()
@@ -118,39 +224,34 @@ def rectify_user_data():
     
     try:
         if current_user['type'] == 'patient':
-            patient = Patient.query.get(current_user['id'])
-            if not patient:
-                return jsonify({'error': 'Patient not found'}), 404
-            
-            # Update allowed fields
+            model, resource, name = Patient, 'patients', 'Patient'
+            key = Patient.patient_id == current_user['id']
             allowed_fields = ['first_name', 'last_name', 'date_of_birth', 'gender', 'address', 'phone']
-            for field in allowed_fields:
-                if field in data:
-                    setattr(patient, field, data[field])
-            
-            db.session.commit()
-            return jsonify({
-                'message': 'Patient data updated successfully',
-                'data': patient.to_dict()
-            }), 200
-            
         elif current_user['type'] == 'doctor':
-            doctor = Doctor.query.get(current_user['id'])
-            if not doctor:
-                return jsonify({'error': 'Doctor not found'}), 404
-            
-            # Update allowed fields
+            model, resource, name = Doctor, 'doctors', 'Doctor'
+            key = Doctor.doctor_id == current_user['id']
             allowed_fields = ['first_name', 'last_name', 'specialty', 'phone']
-            for field in allowed_fields:
-                if field in data:
-                    setattr(doctor, field, data[field])
-            
-            db.session.commit()
-            return jsonify({
-                'message': 'Doctor data updated successfully',
-                'data': doctor.to_dict()
-            }), 200
-            
+        else:
+            return jsonify({'error': 'Invalid user type'}), 400
+        
+        # Update allowed fields
+        values = {field: data[field] for field in allowed_fields if field in data}
+        if 'date_of_birth' in values:
+            dob = values['date_of_birth']
+            values['date_of_birth'] = datetime.strptime(dob, '%Y-%m-%d').date() if dob else None
+        
+        user = write_returning(versioned_update(model, key, values, versions=if_match_versions()), resource)
+        if user is None:
+            return missed_write(model, key, name)
+        
+        db.session.commit()
+        return etag_response({
+            'message': f'{name} data updated successfully',
+            'data': user
+        }, user['version'])
+        
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Failed to update data'}), 500
@@ -0,0 +1,57 @@
+from flask import Blueprint, Response, jsonify, request, url_for
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from src.models.user import db
+from src.calendar_feeds import feed_secret, feed_token, feeds, parse_token
+
+ical_feeds_bp = Blueprint('ical_feeds', __name__)
+
+def _feed_url(rotate):
+    current_user = get_jwt_identity()
+
+    if current_user['type'] not in ('patient', 'doctor'):
+        return jsonify({'error': 'Invalid user type'}), 400
+
+    try:
+        secret = feed_secret(current_user['type'], current_user['id'], rotate=rotate)
+        if secret is None:
+            return jsonify({'error': 'User not found'}), 404
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': 'Failed to get calendar feed'}), 500
+
+    if rotate:
+        feeds.forget((current_user['type'], current_user['id']))
+    token = feed_token(current_user['type'], current_user['id'], secret)
+    return jsonify({
+        'url': url_for('ical_feeds.get_calendar', token=token, _external=True)
+    }), 200
+
+@ical_feeds_bp.route('/calendar/feed', methods=['GET'])
+@jwt_required()
+def get_feed_url():
+    """Subscription URL of the current user's appointment calendar"""
+    return _feed_url(rotate=False)
+
+@ical_feeds_bp.route('/calendar/feed/rotate', methods=['POST'])
+@jwt_required()
+def rotate_feed_url():
+    """Replace the subscription URL; the old one stops working"""
+    return _feed_url(rotate=True)
+
+@ical_feeds_bp.route('/calendar/<token>.ics', methods=['GET'])
+def get_calendar(token):
+    """iCalendar feed of a doctor's or patient's appointments (the token authenticates it)"""
+    parsed = parse_token(token)
+    rendered = feeds.render(*parsed) if parsed is not None else None
+    if rendered is None:
+        return jsonify({'error': 'Calendar not found'}), 404
+
+    body, etag = rendered
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,293 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+A client that retries a POST with the same ``Idempotency-Key`` header gets
+the stored response of the first attempt instead of a second booking, note
+or account. Keys are scoped to the caller's identity and remembered for
+``IDEMPOTENCY_TTL_SECONDS``. Unauthenticated requests (registration) are
+scoped to the client address and the request itself, so only a client
+repeating the same request from the same address gets the stored response.
+
+The first request for a key claims it with a row in ``idempotency_keys``
+(the unique constraint decides between workers) and stores its response
+there when it finishes. Duplicates arriving meanwhile wait for that
+response rather than running the view again: in this worker they wait on
+an event, in other workers they poll the row. Completed responses are also
+kept in a bounded in-memory LRU so replays in the same worker skip the
+database. Server errors are not stored, so the client can retry them.
+
+Stored responses hold appointment and medical note data, so rows older
+than the TTL are deleted as keys are claimed: at most once every
+``IDEMPOTENCY_PURGE_SECONDS`` per worker and ``PURGE_BATCH_SIZE`` rows at
+a time.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from src.models.user import db, IdempotencyKey
+from src.db_utils import insert_ignoring_conflicts
+
+MAX_KEY_LENGTH = 255
+
+# Expired rows deleted by one purge during a request
+PURGE_BATCH_SIZE = 1000
+
+
+class IdempotencyStore:
+    """Completed responses and in-flight keys for this worker"""
+
+    def __init__(self):
+        self.ttl_seconds = 24 * 3600
+        self.max_entries = 10000
+        self.wait_seconds = 10.0
+        self.lock_seconds = 60.0
+        self.purge_seconds = 300.0
+        self._last_purge = 0.0
+        self._responses = OrderedDict()  # (identity, key) -> (request_hash, status, body, expires)
+        self._in_flight = {}  # (identity, key) -> threading.Event
+        self._lock = threading.Lock()
+
+    def configure(self, ttl_seconds=24 * 3600, max_entries=10000, wait_seconds=10.0, lock_seconds=60.0,
+                  purge_seconds=300.0):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.lock_seconds = lock_seconds
+        self.purge_seconds = purge_seconds
+
+    def cached(self, scope):
+        """Stored ``(request_hash, status, body)`` for ``scope``, or None"""
+        with self._lock:
+            entry = self._responses.get(scope)
+            if entry is None:
+                return None
+            if entry[3] <= time.monotonic():
+                del self._responses[scope]
+                return None
+            self._responses.move_to_end(scope)
+            return entry[:3]
+
+    def remember(self, scope, request_hash, status, body):
+        with self._lock:
+            self._responses[scope] = (request_hash, status, body, time.monotonic() + self.ttl_seconds)
+            self._responses.move_to_end(scope)
+            while len(self._responses) > self.max_entries:
+                self._responses.popitem(last=False)
+
+    def begin(self, scope):
+        """``(event, True)`` if this request owns ``scope``, else the owner's event and False"""
+        with self._lock:
+            event = self._in_flight.get(scope)
+            if event is not None:
+                return event, False
+            event = self._in_flight[scope] = threading.Event()
+            return event, True
+
+    def finish(self, scope):
+        with self._lock:
+            event = self._in_flight.pop(scope, None)
+        if event is not None:
+            event.set()
+
+    def purge_expired(self, limit=None):
+        """Delete stored responses older than the TTL, at most ``limit``; the caller commits"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        if limit is None:
+            return IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete()
+        expired = select(IdempotencyKey.id).where(IdempotencyKey.created_at < cutoff).limit(limit)
+        return db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired))).rowcount
+
+    def purge_due(self):
+        """Whether this worker should purge now; claims the turn if so"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < self.purge_seconds:
+                return False
+            self._last_purge = now
+            return True
+
+    def stats(self):
+        return {'cached': len(self._responses), 'in_flight': len(self._in_flight)}
+
+
+idempotency_store = IdempotencyStore()
+
+
+def _identity(request_hash):
+    try:
+        user = get_jwt_identity()
+    except RuntimeError:
+        # Not a JWT-protected endpoint (registration)
+        user = None
+    if not user:
+        # A shared scope would replay one client's account to another
+        client = hashlib.sha256(f'{request.remote_addr}\n{request_hash}'.encode('utf-8')).hexdigest()
+        return f'anonymous:{client[:48]}'
+    return f"{user['type']}:{user['id']}"
+
+
+def _request_hash():
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _replay(stored, request_hash):
+    if stored[0] != request_hash:
+        return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+    response = current_app.response_class(stored[2], status=stored[1], mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(identity, key, request_hash):
+    """Take ownership of the key in the database; False if another request holds it.
+
+    A claim whose owner never finished (e.g. the worker died) is taken over
+    after ``lock_seconds``, and an expired response after the TTL.
+    """
+    if idempotency_store.purge_due():
+        idempotency_store.purge_expired(limit=PURGE_BATCH_SIZE)
+    now = datetime.utcnow()
+    table = IdempotencyKey.__table__
+    statement = insert_ignoring_conflicts(table, ['identity', 'idempotency_key']).values(
+        identity=identity, idempotency_key=key, request_hash=request_hash, created_at=now
+    ).returning(table.c.id)
+    try:
+        claimed = db.session.execute(statement).first() is not None
+    except IntegrityError:
+        db.session.rollback()
+        claimed = False
+    if not claimed:
+        takeover = update(table).where(
+            table.c.identity == identity,
+            table.c.idempotency_key == key,
+            or_(
+                (table.c.status_code.is_(None)
+                 & (table.c.created_at < now - timedelta(seconds=idempotency_store.lock_seconds))),
+                table.c.created_at < now - timedelta(seconds=idempotency_store.ttl_seconds)
+            )
+        ).values(request_hash=request_hash, status_code=None, response_body=None, created_at=now)
+        claimed = db.session.execute(takeover).rowcount == 1
+    db.session.commit()
+    return claimed
+
+
+def _await_stored(identity, key):
+    """Poll for the response another worker is producing; None on timeout"""
+    deadline = time.monotonic() + idempotency_store.wait_seconds
+    delay = 0.02
+    while True:
+        row = (db.session.query(IdempotencyKey.request_hash, IdempotencyKey.status_code,
+                                IdempotencyKey.response_body)
+               .filter_by(identity=identity, idempotency_key=key)
+               .first())
+        db.session.rollback()
+        if row is None or row.status_code is not None:
+            return tuple(row) if row else None
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def _release(identity, key):
+    """Drop an unfinished claim so the client can retry"""
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey.__table__).where(
+        IdempotencyKey.identity == identity,
+        IdempotencyKey.idempotency_key == key,
+        IdempotencyKey.status_code.is_(None)
+    ))
+    db.session.commit()
+
+
+def _in_progress():
+    return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+
+
+def _execute(view, scope, request_hash, args, kwargs):
+    identity, key = scope
+    if not _claim(identity, key, request_hash):
+        stored = _await_stored(identity, key)
+        if stored is None:
+            return _in_progress()
+        idempotency_store.remember(scope, *stored)
+        return _replay(stored, request_hash)
+
+    try:
+        response = make_response(view(*args, **kwargs))
+    except Exception:
+        _release(identity, key)
+        raise
+
+    if response.status_code >= 500:
+        _release(identity, key)
+        return response
+
+    body = response.get_data(as_text=True)
+    db.session.execute(update(IdempotencyKey.__table__).where(
+        IdempotencyKey.identity == identity,
+        IdempotencyKey.idempotency_key == key
+    ).values(status_code=response.status_code, response_body=body))
+    db.session.commit()
+    idempotency_store.remember(scope, request_hash, response.status_code, body)
+    return response
+
+
+def idempotent(view):
+    """Replay the stored response for a repeated ``Idempotency-Key``.
+
+    Requests without the header run as usual. Apply it below ``jwt_required``
+    so the key is scoped to the authenticated user.
+    """
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+
+        request_hash = _request_hash()
+        scope = (_identity(request_hash), key)
+        stored = idempotency_store.cached(scope)
+        if stored is not None:
+            return _replay(stored, request_hash)
+
+        event, owner = idempotency_store.begin(scope)
+        if not owner:
+            # The same key is running in this worker: wait for its response
+            event.wait(idempotency_store.wait_seconds)
+            stored = idempotency_store.cached(scope)
+            return _replay(stored, request_hash) if stored is not None else _in_progress()
+
+        try:
+            return _execute(view, scope, request_hash, args, kwargs)
+        finally:
+            idempotency_store.finish(scope)
+
+    return decorated_function
+
+
+def init_app(app):
+    """Configure the store and drop expired responses"""
+    idempotency_store.configure(
+        ttl_seconds=app.config.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600),
+        max_entries=app.config.get('IDEMPOTENCY_CACHE_SIZE', 10000),
+        wait_seconds=app.config.get('IDEMPOTENCY_WAIT_SECONDS', 10.0),
+        lock_seconds=app.config.get('IDEMPOTENCY_LOCK_SECONDS', 60.0),
+        purge_seconds=app.config.get('IDEMPOTENCY_PURGE_SECONDS', 300.0)
+    )
+    with app.app_context():
+        idempotency_store.purge_expired()
+        db.session.commit()
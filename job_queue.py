@@ -0,0 +1,353 @@
+"""
+Durable background jobs, kept in the ``jobs`` table.
+
+    python -m src.job_queue work                    # JOB_WORKER_PROCESSES processes
+    python -m src.job_queue work --processes 4 --queues gdpr
+    python -m src.job_queue work --once             # run the jobs that are due and exit
+
+Work is registered with ``@task(name, queue=...)`` and queued with
+``enqueue``, which adds a row to the caller's transaction: the job exists
+exactly when the request that made it commits, and no broker is needed.
+
+A worker claims a job with one UPDATE ... WHERE job_id IN (SELECT ...
+FOR UPDATE SKIP LOCKED) RETURNING, so on PostgreSQL workers polling at once
+take different rows instead of waiting on the same one. SQLite has no row
+locks and leaves out FOR UPDATE; the single statement still claims
+atomically, since SQLite runs one writer at a time.
+
+A claimed job is leased for ``JOB_VISIBILITY_TIMEOUT_SECONDS``: its
+``run_at`` becomes the end of the lease, and if the worker dies the job is
+claimed again once that passes. Only the worker holding the current lease
+can record the outcome. A failed job is retried after
+``JOB_RETRY_BASE_SECONDS``, doubling each attempt up to
+``JOB_RETRY_MAX_SECONDS``, until it has run ``max_attempts`` times. A job
+may therefore run more than once, and tasks must allow for that.
+
+``JOB_QUEUE_CONCURRENCY`` caps the jobs of a queue running at once across
+every worker. Claims on a capped queue count its live leases under a lock
+held to the end of the claim: an advisory lock on PostgreSQL, the database
+write lock on SQLite. Finished jobs are deleted after ``JOB_RETENTION_HOURS``.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import time as time_module
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app, jsonify, request, url_for
+from sqlalchemy import delete, false, func, select, text, update
+from src.models.user import db, Job
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the advisory locks that serialise claims on capped queues
+_LOCK_KEY = 7302049
+
+# Idle workers delete old finished jobs at most this often
+PURGE_INTERVAL_SECONDS = 60
+
+Task = namedtuple('Task', ['function', 'queue', 'max_attempts'])
+
+TASKS = {}
+
+
+class Fail(Exception):
+    """Fails the job at once, with the message as its error; other exceptions are retried"""
+
+
+def task(name, queue='default', max_attempts=None):
+    """Register the decorated function as ``name``; it is called with the job's payload as keyword arguments"""
+    def decorator(function):
+        TASKS[name] = Task(function, queue, max_attempts)
+        return function
+    return decorator
+
+
+def enqueue(name, payload=None, owner=None, delay_seconds=0, max_attempts=None):
+    """Add a job to the current transaction; it can be claimed once that commits"""
+    registered = TASKS[name]
+    job = Job(queue=registered.queue, name=name, payload=json.dumps(payload or {}), owner=owner,
+              max_attempts=max_attempts or registered.max_attempts or current_app.config.get('JOB_MAX_ATTEMPTS', 5),
+              run_at=datetime.utcnow() + timedelta(seconds=delay_seconds))
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+def pending(name, owner):
+    """The queued or running ``name`` job of ``owner``, if there is one"""
+    return Job.query.filter(Job.name == name, Job.owner == owner, Job.status.in_(('queued', 'running'))) \
+        .order_by(Job.job_id.desc()).first()
+
+
+def respond_async():
+    """Whether the client sent ``Prefer: respond-async``"""
+    preferences = request.headers.get('Prefer', '')
+    return any(token.split('=')[0].strip().lower() == 'respond-async'
+               for token in preferences.replace(';', ',').split(','))
+
+
+def accepted(job):
+    """202 response pointing at the status of ``job``"""
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers['Location'] = url_for('jobs.get_job', job_id=job.job_id)
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+
+def _lock_queue(queue):
+    """Serialise claims on ``queue`` until the transaction ends"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key, hashtext(:queue))'),
+                           {'key': _LOCK_KEY, 'queue': queue})
+    else:
+        # Any UPDATE takes SQLite's write lock, even one that matches nothing
+        db.session.execute(update(Job).where(false()).values(queue=Job.queue))
+
+
+def claim(queue, lease_seconds, limit=1, concurrency=None):
+    """Lease up to ``limit`` due jobs of ``queue``; returns their rows.
+
+    Due jobs are queued ones whose ``run_at`` has passed and running ones
+    whose lease has run out. With ``concurrency``, no more jobs are claimed
+    than leave that many running in the queue.
+    """
+    now = datetime.utcnow()
+    if concurrency:
+        _lock_queue(queue)
+        running = db.session.execute(
+            select(func.count()).select_from(Job)
+            .where(Job.queue == queue, Job.status == 'running', Job.run_at > now)
+        ).scalar()
+        limit = min(limit, concurrency - running)
+        if limit <= 0:
+            db.session.commit()
+            return []
+
+    due = select(Job.job_id) \
+        .where(Job.queue == queue, Job.status.in_(('queued', 'running')), Job.run_at <= now) \
+        .order_by(Job.run_at, Job.job_id) \
+        .limit(limit) \
+        .with_for_update(skip_locked=True)
+    claimed = db.session.execute(
+        update(Job)
+        .where(Job.job_id.in_(due))
+        .values(status='running', attempts=Job.attempts + 1, lease=uuid.uuid4().hex,
+                run_at=now + timedelta(seconds=lease_seconds), started_at=now)
+        .returning(Job.job_id, Job.name, Job.payload, Job.attempts, Job.max_attempts, Job.lease)
+    ).all()
+    db.session.commit()
+    return claimed
+
+
+def _finish(job, **values):
+    """Record the outcome of a claimed job; False if its lease was lost"""
+    recorded = db.session.execute(
+        update(Job)
+        .where(Job.job_id == job.job_id, Job.lease == job.lease, Job.status == 'running')
+        .values(lease=None, **values)
+    ).rowcount
+    db.session.commit()
+    return recorded == 1
+
+
+class Worker:
+    """Claims and runs due jobs one at a time"""
+
+    def __init__(self, queues=None, visibility_timeout=300, concurrency=None, retry_base_seconds=10,
+                 retry_max_seconds=3600, retention_hours=24):
+        self.queues = list(queues) if queues else None
+        self.visibility_timeout = visibility_timeout
+        self.concurrency = concurrency or {}
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.retention_hours = retention_hours
+        self._turn = 0
+
+    @classmethod
+    def from_config(cls, config, queues=None):
+        return cls(queues,
+                   visibility_timeout=config.get('JOB_VISIBILITY_TIMEOUT_SECONDS', 300),
+                   concurrency=config.get('JOB_QUEUE_CONCURRENCY', {}),
+                   retry_base_seconds=config.get('JOB_RETRY_BASE_SECONDS', 10),
+                   retry_max_seconds=config.get('JOB_RETRY_MAX_SECONDS', 3600),
+                   retention_hours=config.get('JOB_RETENTION_HOURS', 24))
+
+    def _queues(self):
+        # Every queue with a registered task unless told otherwise
+        return self.queues or sorted({registered.queue for registered in TASKS.values()})
+
+    def run_next(self):
+        """Claim and run one due job; returns its outcome, or None when none was due"""
+        queues = self._queues()
+        if not queues:
+            return None
+        # Start from the next queue each time so a busy queue cannot starve the others
+        self._turn = (self._turn + 1) % len(queues)
+        for queue in queues[self._turn:] + queues[:self._turn]:
+            claimed = claim(queue, self.visibility_timeout, concurrency=self.concurrency.get(queue))
+            if claimed:
+                return self.run(claimed[0])
+        return None
+
+    def run(self, job):
+        """Run a claimed job; returns 'succeeded', 'retried', 'failed' or 'lost'"""
+        registered = TASKS.get(job.name)
+        if job.attempts > job.max_attempts:
+            # Its last attempt outlived the lease, most likely with its worker
+            return self._failed(job, 'Gave up after the lease expired', retry=False)
+        if registered is None:
+            return self._failed(job, f'Unknown task {job.name}', retry=False)
+
+        try:
+            result = registered.function(**json.loads(job.payload))
+        except Fail as e:
+            db.session.rollback()
+            return self._failed(job, str(e)[:500], retry=False)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception('Job %s (%s) failed on attempt %d', job.job_id, job.name, job.attempts)
+            # The type only: the status endpoint shows the error to the job's owner
+            return self._failed(job, type(e).__name__, retry=True)
+
+        body = current_app.json.dumps(result) if result is not None else None
+        if not _finish(job, status='succeeded', result=body, error=None, finished_at=datetime.utcnow()):
+            return 'lost'
+        return 'succeeded'
+
+    def _failed(self, job, error, retry):
+        now = datetime.utcnow()
+        if retry and job.attempts < job.max_attempts:
+            delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (job.attempts - 1))
+            recorded = _finish(job, status='queued', error=error, run_at=now + timedelta(seconds=delay))
+            return 'retried' if recorded else 'lost'
+        recorded = _finish(job, status='failed', error=error, finished_at=now)
+        return 'failed' if recorded else 'lost'
+
+    def run_once(self):
+        """Run jobs until none is due; returns counts by outcome"""
+        stats = {'succeeded': 0, 'retried': 0, 'failed': 0, 'lost': 0}
+        while True:
+            outcome = self.run_next()
+            if outcome is None:
+                break
+            stats[outcome] += 1
+        self.purge()
+        return stats
+
+    def purge(self, now=None):
+        """Delete jobs that finished more than the retention period ago"""
+        cutoff = (now or datetime.utcnow()) - timedelta(hours=self.retention_hours)
+        db.session.execute(delete(Job).where(Job.status.in_(('succeeded', 'failed')), Job.finished_at < cutoff))
+        db.session.commit()
+
+
+def work(queues=None, once=False):
+    """Run jobs in this process until SIGTERM or SIGINT; returns the exit status"""
+    stopping = []
+
+    def stop(signum, frame):
+        # The running job is finished first
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    from src.main import app
+    with app.app_context():
+        worker = Worker.from_config(app.config, queues)
+        poll_seconds = app.config.get('JOB_POLL_SECONDS', 1.0)
+        purged_at = time_module.monotonic()
+        while not stopping:
+            try:
+                if once:
+                    stats = worker.run_once()
+                    print(f"{stats['succeeded']} jobs succeeded, {stats['retried']} retried, {stats['failed']} failed")
+                    return 0
+                if worker.run_next() is None:
+                    if time_module.monotonic() - purged_at >= PURGE_INTERVAL_SECONDS:
+                        worker.purge()
+                        purged_at = time_module.monotonic()
+                    time_module.sleep(poll_seconds)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Job worker pass failed')
+                if once:
+                    return 1
+                time_module.sleep(poll_seconds)
+    return 0
+
+
+def _process(queues, once):
+    sys.exit(work(queues, once))
+
+
+def supervise(processes, queues=None, once=False):
+    """Run ``processes`` worker processes, restarting any that die, until SIGTERM or SIGINT"""
+    # Spawned rather than forked, so no process inherits another's connections
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+    stopping = []
+    status = 0
+
+    def start(slot):
+        process = context.Process(target=_process, args=(queues, once), name=f'jobs-{slot}')
+        process.start()
+        workers[slot] = process
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for slot in range(processes):
+        start(slot)
+    while workers:
+        multiprocessing.connection.wait([process.sentinel for process in workers.values()], timeout=1)
+        for slot, process in list(workers.items()):
+            if process.exitcode is None:
+                continue
+            del workers[slot]
+            if process.exitcode != 0:
+                status = 1
+                if not once and not stopping:
+                    logger.warning('Job worker %s exited with %s; restarting', process.name, process.exitcode)
+                    time_module.sleep(1)
+                    start(slot)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Background job workers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('work')
+    run.add_argument('--processes', type=int, help='Worker processes (default JOB_WORKER_PROCESSES)')
+    run.add_argument('--queues', help='Comma-separated queues to take jobs from (default all)')
+    run.add_argument('--once', action='store_true', help='Run the jobs that are due and exit')
+    args = parser.parse_args(argv)
+    queues = [queue for queue in (args.queues or '').split(',') if queue] or None
+
+    processes = args.processes
+    if processes is None:
+        from src.main import app
+        processes = app.config.get('JOB_WORKER_PROCESSES', 2)
+    if processes <= 1:
+        return work(queues, args.once)
+    return supervise(processes, queues, args.once)
+
+
+if __name__ == '__main__':
+    # Run as src.job_queue rather than __main__, so tasks registered by the
+    # app and the worker processes share this module's TASKS
+    from src.job_queue import main
+    sys.exit(main())
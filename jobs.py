@@ -0,0 +1,32 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from src.models.user import db, Job
+import json
+
+jobs_bp = Blueprint('jobs', __name__)
+
+def _owner(current_user):
+    return f"{current_user['type']}:{current_user['id']}"
+
+@jobs_bp.route('/jobs', methods=['GET'])
+@jwt_required()
+def get_jobs():
+    """The caller's background jobs, newest first"""
+    jobs = Job.query.filter_by(owner=_owner(get_jwt_identity())).order_by(Job.job_id.desc()).limit(50).all()
+    return jsonify(jobs), 200
+
+@jobs_bp.route('/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    """Status of one of the caller's background jobs, with its result once it has succeeded"""
+    job = db.session.get(Job, job_id)
+    # Other users' jobs are reported as missing, not forbidden
+    if not job or job.owner != _owner(get_jwt_identity()):
+        return jsonify({'error': 'Job not found'}), 404
+
+    body = job.to_dict()
+    if job.status == 'failed':
+        body['error'] = job.error
+    if job.status == 'succeeded' and job.result is not None:
+        body['result'] = json.loads(job.result)
+    return jsonify(body), 200
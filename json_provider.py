@@ -0,0 +1,86 @@
+"""
+JSON provider for the application.
+
+Request bodies are checked for nesting depth and key count on the raw bytes
+before they are parsed, so hostile bodies are rejected without building
+the object tree.
+
+Responses are encoded with orjson when it is installed, falling back to the
+standard library otherwise. Both paths encode ``date``, ``time`` and
+``datetime`` as ISO 8601 natively, and objects with a ``__json__`` method
+(the models) are serialized by the encoder as it reaches them, so a list
+endpoint can hand its query results straight to ``jsonify``.
+"""
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, datetime, time
+
+from flask.json.provider import DefaultJSONProvider
+from src.security_config import (
+    check_json_structure, DEFAULT_MAX_JSON_DEPTH, DEFAULT_MAX_JSON_KEYS
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    """Types the encoders do not handle natively"""
+    if hasattr(o, '__json__'):
+        return o.__json__()
+    if isinstance(o, (datetime, date, time)):
+        return o.isoformat()
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+class AppJSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+
+    def loads(self, s, **kwargs):
+        config = self._app.config
+        check_json_structure(
+            s,
+            max_depth=config.get('MAX_JSON_DEPTH', DEFAULT_MAX_JSON_DEPTH),
+            max_keys=config.get('MAX_JSON_KEYS', DEFAULT_MAX_JSON_KEYS)
+        )
+        return super().loads(s, **kwargs)
+
+    def _pretty(self):
+        return (self.compact is None and self._app.debug) or self.compact is False
+
+    def dump_bytes(self, obj, pretty=False):
+        """Serialize to UTF-8 bytes with the fastest available encoder"""
+        if orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=option)
+        if pretty:
+            dumped = json.dumps(obj, default=self.default, sort_keys=self.sort_keys,
+                                ensure_ascii=self.ensure_ascii, indent=2)
+        else:
+            dumped = json.dumps(obj, default=self.default, sort_keys=self.sort_keys,
+                                ensure_ascii=self.ensure_ascii, separators=(',', ':'))
+        return dumped.encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dump_bytes(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dump_bytes(obj, pretty=self._pretty()) + b'\n',
+                                        mimetype=self.mimetype)
@@ -3,51 +3,104 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+from flask import Flask, current_app, send_from_directory
 from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 from src.models.user import db
 from src.routes.user import user_bp
 from src.routes.auth import auth_bp
 from src.routes.appointments import appointments_bp
 from src.routes.medical_notes import medical_notes_bp
 from src.routes.gdpr import gdpr_bp
-from src.security_config import add_security_headers, rate_limit
-import secrets
-
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-
-# Load configuration
-config_name = os.environ.get('FLASK_ENV', 'development')
-if config_name == 'production':
-    from config import ProductionConfig
-    app.config.from_object(ProductionConfig)
-else:
-    from config import DevelopmentConfig
-    app.config.from_object(DevelopmentConfig)
-
-# Initialize JWT
-jwt = JWTManager(app)
-
-# Add security headers to all responses
-@app.after_request
-def after_request(response):
-    return add_security_headers(response)
-
-app.register_blueprint(user_bp, url_prefix='/api')
-app.register_blueprint(auth_bp, url_prefix='/api')
-app.register_blueprint(appointments_bp, url_prefix='/api')
-app.register_blueprint(medical_notes_bp, url_prefix='/api')
-app.register_blueprint(gdpr_bp, url_prefix='/api')
-
-# Database configuration is now handled in config.py
-db.init_app(app)
-with app.app_context():
-    db.create_all()
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+from src.routes.ical_feeds import ical_feeds_bp
+from src.routes.analytics import analytics_bp
+from src.routes.revisions import revisions_bp
+from src.routes.attachments import attachments_bp
+from src.routes.jobs import jobs_bp
+from src.security_config import add_security_headers, rate_limit, reject_oversized_json_body
+from src.json_provider import AppJSONProvider
+from src import (
+    attachment_store, calendar_feeds, doctor_stats, email_filter, idempotency, metrics, partitions, patient_search, profiling,
+    slow_query, token_revocation
+)
+
+
+def create_app(config_object=None):
+    """Build the application; ``config_object`` defaults to the one named by FLASK_ENV"""
+    if config_object is None:
+        from config import config
+        config_object = config.get(os.environ.get('FLASK_ENV', 'development'), config['default'])
+
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+    app.json = AppJSONProvider(app)
+    app.config.from_object(config_object)
+    if app.config.get('PROXY_FIX_X_FOR'):
+        # Only the configured number of proxies may set the client address
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    # Initialize JWT
+    jwt = JWTManager(app)
+
+    # Add security headers to all responses
+    app.after_request(add_security_headers)
+
+    app.register_blueprint(user_bp, url_prefix='/api')
+    app.register_blueprint(auth_bp, url_prefix='/api')
+    app.register_blueprint(appointments_bp, url_prefix='/api')
+    app.register_blueprint(medical_notes_bp, url_prefix='/api')
+    app.register_blueprint(gdpr_bp, url_prefix='/api')
+    app.register_blueprint(ical_feeds_bp, url_prefix='/api')
+    app.register_blueprint(analytics_bp, url_prefix='/api')
+    app.register_blueprint(revisions_bp, url_prefix='/api')
+    app.register_blueprint(attachments_bp, url_prefix='/api')
+    app.register_blueprint(jobs_bp, url_prefix='/api')
+
+    # Request/DB instrumentation and /metrics; must precede db.init_app for the timed pool
+    metrics.init_app(app)
+    slow_query.init_app(app)
+    profiling.init_app(app)
+
+    # Reject oversized JSON bodies before they are read
+    app.before_request(reject_oversized_json_body)
+
+    # Database configuration is now handled in config.py
+    db.init_app(app)
+    with app.app_context():
+        # Partitioned on PostgreSQL, so created before the other tables
+        partitions.create_partitioned_table()
+        db.create_all()
+
+    # Triggers that queue changed days for the doctor rollups
+    doctor_stats.init_app(app)
+
+    # Create upcoming appointment partitions and archive old months
+    partitions.init_app(app)
+
+    # Build the per-worker registered-email filters used by login and registration
+    email_filter.init_app(app)
+
+    # Load revoked token ids and check them on every protected request
+    token_revocation.init_app(app, jwt)
+
+    # Replay stored responses for repeated Idempotency-Key headers
+    idempotency.init_app(app)
+
+    # Indexes behind the patient typeahead
+    patient_search.init_app(app)
+
+    # Per-worker cache of rendered calendar feeds
+    calendar_feeds.init_app(app)
+
+    # Local storage for medical note attachments
+    attachment_store.init_app(app)
+
+    app.add_url_rule('/', 'serve', serve, defaults={'path': ''})
+    app.add_url_rule('/<path:path>', 'serve', serve)
+    return app
+
+
 def serve(path):
-    static_folder_path = app.static_folder
+    static_folder_path = current_app.static_folder
     if static_folder_path is None:
             return "Static folder not configured", 404
 
@@ -61,6 +114,16 @@ def serve(path):
             return "index.html not found", 404
 
 
+def __getattr__(name):
+    # ``from src.main import app`` builds the configured app on first use, so
+    # importing create_app (as the tests do) does not connect to a database
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    create_app().run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
 
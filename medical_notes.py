@@ -2,11 +2,26 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime, date
 from src.models.user import db, MedicalNote, Patient, Doctor
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from src.fieldsets import all_fields, requested_fields, select_fields, only, write_returning
+from src.idempotency import idempotent
+from src import note_revisions, patient_search
+from src.db_utils import (
+    etag_response, if_match_versions, integrity_error_kind, missed_write,
+    versioned_delete, versioned_update
+)
 
 medical_notes_bp = Blueprint('medical_notes', __name__)
 
+# Times an update without If-Match reads the note again after losing to another update
+UNCONDITIONAL_UPDATE_ATTEMPTS = 5
+# Seconds a client is asked to wait after losing all of those attempts
+UNCONDITIONAL_UPDATE_RETRY_AFTER = 1
+
 @medical_notes_bp.route('/medical-notes', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_medical_note():
     """Create a new medical note (doctors only)"""
     current_user = get_jwt_identity()
@@ -26,13 +41,9 @@ def create_medical_note():
         # Parse date
         note_date = datetime.strptime(data['note_date'], '%Y-%m-%d').date()
         
-        # Check if patient exists
-        patient = Patient.query.get(data['patient_id'])
-        if not patient:
-            return jsonify({'error': 'Patient not found'}), 404
-        
-        # Create new medical note
-        new_note = MedicalNote(
+        # Create new medical note; the patient's foreign key replaces a
+        # separate existence check
+        statement = insert(MedicalNote.__table__).values(
             patient_id=data['patient_id'],
             doctor_id=current_user['id'],
             note_date=note_date,
@@ -41,12 +52,18 @@ def create_medical_note():
             treatment=data.get('treatment', '')
         )
         
-        db.session.add(new_note)
+        try:
+            note = write_returning(statement, 'medical_notes')
+        except IntegrityError as error:
+            db.session.rollback()
+            if integrity_error_kind(error) == 'foreign_key':
+                return jsonify({'error': 'Patient not found'}), 404
+            raise
         db.session.commit()
         
         return jsonify({
             'message': 'Medical note created successfully',
-            'note': new_note.to_dict()
+            'note': note
         }), 201
         
     except ValueError as e:
@@ -61,16 +78,23 @@ def get_medical_notes():
     """Get medical notes for current user"""
     current_user = get_jwt_identity()
     
+    fields, error = requested_fields('medical_notes')
+    if error:
+        return jsonify({'error': error}), 400
+    
     if current_user['type'] == 'patient':
         # Patients can only see their own medical notes
-        notes = MedicalNote.query.filter_by(patient_id=current_user['id']).all()
+        criterion = MedicalNote.patient_id == current_user['id']
     elif current_user['type'] == 'doctor':
         # Doctors can see all notes they've created
-        notes = MedicalNote.query.filter_by(doctor_id=current_user['id']).all()
+        criterion = MedicalNote.doctor_id == current_user['id']
     else:
         return jsonify({'error': 'Invalid user type'}), 400
     
-    return jsonify([note.to_dict() for note in notes]), 200
+    # The full representation too, so the names come from one joined SELECT
+    fields = fields or all_fields('medical_notes')
+    rows = select_fields('medical_notes', fields, criterion)
+    return jsonify([only(row, fields) for row in rows]), 200
 
 @medical_notes_bp.route('/medical-notes/patient/<int:patient_id>', methods=['GET'])
 @jwt_required()
@@ -81,15 +105,18 @@ def get_patient_medical_notes(patient_id):
     if current_user['type'] != 'doctor':
         return jsonify({'error': 'Only doctors can access patient medical notes'}), 403
     
+    fields, error = requested_fields('medical_notes')
+    if error:
+        return jsonify({'error': error}), 400
+    
     # Check if patient exists
     patient = Patient.query.get(patient_id)
     if not patient:
         return jsonify({'error': 'Patient not found'}), 404
     
-    # Get all medical notes for this patient
-    notes = MedicalNote.query.filter_by(patient_id=patient_id).all()
-    
-    return jsonify([note.to_dict() for note in notes]), 200
+    fields = fields or all_fields('medical_notes')
+    rows = select_fields('medical_notes', fields, MedicalNote.patient_id == patient_id)
+    return jsonify([only(row, fields) for row in rows]), 200
 
 @medical_notes_bp.route('/medical-notes/<int:note_id>', methods=['GET'])
 @jwt_required()
@@ -97,7 +124,16 @@ def get_medical_note(note_id):
     """Get specific medical note details"""
     current_user = get_jwt_identity()
     
-    note = MedicalNote.query.get(note_id)
+    fields, error = requested_fields('medical_notes')
+    if error:
+        return jsonify({'error': error}), 400
+    
+    if fields:
+        rows = select_fields('medical_notes', fields, MedicalNote.note_id == note_id,
+                             include=('patient_id', 'doctor_id', 'version'))
+        note = rows[0] if rows else None
+    else:
+        note = MedicalNote.query.get(note_id)
     if not note:
         return jsonify({'error': 'Medical note not found'}), 404
     
@@ -107,43 +143,64 @@ def get_medical_note(note_id):
     elif current_user['type'] == 'doctor' and note.doctor_id != current_user['id']:
         return jsonify({'error': 'Access denied'}), 403
     
-    return jsonify(note.to_dict()), 200
+    if fields:
+        return etag_response(only(note, fields), note.version)
+    return etag_response(note.to_dict(), note.version)
 
 @medical_notes_bp.route('/medical-notes/<int:note_id>', methods=['PUT'])
 @jwt_required()
 def update_medical_note(note_id):
-    """Update medical note (doctors only)"""
+    """Update medical note (doctors only), honouring If-Match"""
     current_user = get_jwt_identity()
     
     if current_user['type'] != 'doctor':
         return jsonify({'error': 'Only doctors can update medical notes'}), 403
     
-    note = MedicalNote.query.get(note_id)
-    if not note:
-        return jsonify({'error': 'Medical note not found'}), 404
-    
-    # Check if doctor owns this note
-    if note.doctor_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
-    
     data = request.get_json()
     
     try:
         # Update fields if provided
+        values = {}
         if 'note_date' in data:
-            note.note_date = datetime.strptime(data['note_date'], '%Y-%m-%d').date()
-        if 'note_details' in data:
-            note.note_details = data['note_details']
-        if 'medication' in data:
-            note.medication = data['medication']
-        if 'treatment' in data:
-            note.treatment = data['treatment']
+            values['note_date'] = datetime.strptime(data['note_date'], '%Y-%m-%d').date()
+        for field in ('note_details', 'medication', 'treatment'):
+            if field in data:
+                values[field] = data[field]
+        
+        # Only the owning doctor's note, at the version the client last saw
+        key = MedicalNote.note_id == note_id
+        owner = (MedicalNote.doctor_id, current_user['id'])
+        
+        # The version being replaced goes to the revision history; the update
+        # only matches if nobody replaced it in between
+        versions = if_match_versions()
+        note = None
+        for _ in range(UNCONDITIONAL_UPDATE_ATTEMPTS):
+            replaced = db.session.execute(select(*note_revisions.columns())
+                                          .where(key, owner[0] == owner[1])).first()
+            if replaced is None:
+                break
+            statement = versioned_update(MedicalNote, key, values, owner[0] == owner[1],
+                                         MedicalNote.version == replaced.version, versions=versions)
+            note = write_returning(statement, 'medical_notes')
+            # Without If-Match a concurrent update is not a conflict; read the note again
+            if note is not None or versions is not None:
+                break
+        if note is None and replaced is not None and versions is None:
+            # Lost every attempt to other updates; nothing the client sent is stale
+            db.session.rollback()
+            response = jsonify({'error': 'Medical note is being updated by other requests; retry shortly'})
+            response.headers['Retry-After'] = str(UNCONDITIONAL_UPDATE_RETRY_AFTER)
+            return response, 503
+        if note is None:
+            return missed_write(MedicalNote, key, 'Medical note', owner)
+        note_revisions.record(replaced, note)
         
         db.session.commit()
-        return jsonify({
+        return etag_response({
             'message': 'Medical note updated successfully',
-            'note': note.to_dict()
-        }), 200
+            'note': note
+        }, note['version'])
         
     except ValueError as e:
         return jsonify({'error': 'Invalid date format'}), 400
@@ -154,22 +211,22 @@ def update_medical_note(note_id):
 @medical_notes_bp.route('/medical-notes/<int:note_id>', methods=['DELETE'])
 @jwt_required()
 def delete_medical_note(note_id):
-    """Delete medical note (doctors only)"""
+    """Delete medical note (doctors only), honouring If-Match"""
     current_user = get_jwt_identity()
     
     if current_user['type'] != 'doctor':
         return jsonify({'error': 'Only doctors can delete medical notes'}), 403
     
-    note = MedicalNote.query.get(note_id)
-    if not note:
-        return jsonify({'error': 'Medical note not found'}), 404
-    
-    # Check if doctor owns this note
-    if note.doctor_id != current_user['id']:
-        return jsonify({'error': 'Access denied'}), 403
-    
     try:
-        db.session.delete(note)
+        # Only the owning doctor can delete the note
+        key = MedicalNote.note_id == note_id
+        owner = (MedicalNote.doctor_id, current_user['id'])
+        statement = versioned_delete(MedicalNote, key, owner[0] == owner[1], versions=if_match_versions())
+        deleted = db.session.execute(statement.returning(*note_revisions.columns())).first()
+        if deleted is None:
+            return missed_write(MedicalNote, key, 'Medical note', owner)
+        # The history is kept after the note is gone
+        note_revisions.record(deleted)
         db.session.commit()
         return jsonify({'message': 'Medical note deleted successfully'}), 200
     except Exception as e:
@@ -185,5 +242,38 @@ def get_patients():
     if current_user['type'] != 'doctor':
         return jsonify({'error': 'Only doctors can access patient list'}), 403
     
+    fields, error = requested_fields('patients')
+    if error:
+        return jsonify({'error': error}), 400
+    if fields:
+        return jsonify([only(row, fields) for row in select_fields('patients', fields)]), 200
+    
     patients = Patient.query.all()
-    return jsonify([patient.to_dict() for patient in patients]), 200
+    return jsonify(patients), 200
+
+@medical_notes_bp.route('/patients/search', methods=['GET'])
+@jwt_required()
+def search_patients():
+    """Typeahead search of patients by name or email (doctors only)"""
+    current_user = get_jwt_identity()
+    
+    if current_user['type'] != 'doctor':
+        return jsonify({'error': 'Only doctors can search patients'}), 403
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    if len(query) > patient_search.MAX_QUERY_LENGTH:
+        return jsonify({'error': f'q must be at most {patient_search.MAX_QUERY_LENGTH} characters'}), 400
+    
+    limit = request.args.get('limit', patient_search.DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= patient_search.MAX_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {patient_search.MAX_LIMIT}'}), 400
+    
+    fields, error = requested_fields('patients')
+    if error:
+        return jsonify({'error': error}), 400
+    fields = fields or patient_search.TYPEAHEAD_FIELDS
+    
+    rows = patient_search.search(query, fields, limit)
+    return jsonify([only(row, fields) for row in rows]), 200
@@ -0,0 +1,336 @@
+"""
+Per-endpoint latency and database metrics exposed in Prometheus text format.
+
+Request timing is hooked into Flask's request start/teardown, SQL timing into
+SQLAlchemy's cursor execute events, and connection pool wait time into the
+pool itself. Everything is kept in plain in-process structures so recording
+a request costs a few microseconds; with several workers each one flushes a
+snapshot to a shared directory and ``/metrics`` merges them. A worker removes
+its snapshot when it exits, and snapshots left by workers that died are
+removed at startup.
+"""
+import atexit
+import bisect
+import contextvars
+import glob
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from time import perf_counter
+
+from flask import Response, abort, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STATEMENT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+BCRYPT_BUCKETS = (0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0)
+
+METRIC_HELP = {
+    'http_request_duration_seconds': 'Request latency by route',
+    'http_request_sql_statements': 'SQL statements executed per request',
+    'http_request_db_seconds': 'Time spent in the database per request',
+    'db_pool_wait_seconds': 'Time spent waiting for a pooled connection',
+    'bcrypt_seconds': 'Time spent hashing and verifying passwords',
+    'email_filter_lookups_total': 'Login and registration emails checked against the email filter',
+    'email_filter_negatives_total': 'Emails the filter ruled out without a query',
+    'email_filter_false_positives_total': 'Emails the filter let through to a query that found no account',
+    'email_filter_entries': 'Emails in the filter',
+    'email_filter_false_positive_rate': 'Filter false positive rate, expected from its fill or measured by probing'
+}
+
+
+class Histogram:
+    """Non-cumulative bucket counts; cumulated when rendered"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets, counts=None, total=0.0, count=0):
+        self.buckets = buckets
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.sum = total
+        self.count = count
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Histograms, counters and gauges of this worker, keyed by name and labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self.gauges[(name, labels)] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'histograms': [[name, list(labels), list(h.buckets), list(h.counts), h.sum, h.count]
+                               for (name, labels), h in self.histograms.items()],
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()]
+            }
+
+
+registry = Registry()
+# The current request's timing. A context variable rather than a thread-local:
+# the ASGI views interleave requests as coroutines on one thread
+_state = contextvars.ContextVar('metrics_request', default=None)
+
+
+class _RequestMetrics:
+    __slots__ = ('started', 'sql_count', 'db_time', 'status')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.sql_count = 0
+        self.db_time = 0.0
+        self.status = 500
+_settings = {'multiproc_dir': None, 'flush_seconds': 5.0, 'last_flush': 0.0}
+
+
+def record_bcrypt_time(operation, seconds):
+    registry.observe('bcrypt_seconds', (('operation', operation),), seconds, BCRYPT_BUCKETS)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            registry.observe('db_pool_wait_seconds', (), perf_counter() - started, POOL_WAIT_BUCKETS)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_start'] = perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _state.get()
+    if state is not None:
+        state.sql_count += 1
+        state.db_time += perf_counter() - conn.info['metrics_query_start']
+
+
+def _start_request():
+    _state.set(_RequestMetrics())
+
+
+def _capture_status(response):
+    state = _state.get()
+    if state is not None:
+        state.status = response.status_code
+    return response
+
+
+def _finish_request(exc):
+    state = _state.get()
+    if state is None:
+        return
+    _state.set(None)
+    elapsed = perf_counter() - state.started
+    rule = request.url_rule
+    route = rule.rule if rule is not None else 'unmatched'
+    registry.observe('http_request_duration_seconds',
+                     (('method', request.method), ('route', route), ('status', str(state.status))),
+                     elapsed, LATENCY_BUCKETS)
+    route_labels = (('route', route),)
+    registry.observe('http_request_sql_statements', route_labels, state.sql_count, STATEMENT_COUNT_BUCKETS)
+    registry.observe('http_request_db_seconds', route_labels, state.db_time, DB_TIME_BUCKETS)
+
+    if _settings['multiproc_dir'] and time.monotonic() - _settings['last_flush'] >= _settings['flush_seconds']:
+        flush()
+
+
+def flush():
+    """Write this worker's snapshot for the other workers to aggregate"""
+    directory = _settings['multiproc_dir']
+    if not directory:
+        return
+    _settings['last_flush'] = time.monotonic()
+    path = os.path.join(directory, f'metrics_{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _remove_snapshot():
+    directory = _settings['multiproc_dir']
+    if directory:
+        try:
+            os.remove(os.path.join(directory, f'metrics_{os.getpid()}.json'))
+        except OSError:
+            pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_dead_snapshots(directory):
+    """Delete snapshots of workers that are no longer running"""
+    removed = 0
+    for path in glob.glob(os.path.join(directory, 'metrics_*.json*')):
+        match = re.match(r'metrics_(\d+)\.json', os.path.basename(path))
+        if match and not _pid_alive(int(match.group(1))):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def _key(name, labels):
+    return name, tuple(tuple(label) for label in labels)
+
+
+def _collect():
+    """Merge snapshots from every worker (or just this one).
+
+    Histograms and counters are summed; gauges report the highest value
+    across workers.
+    """
+    directory = _settings['multiproc_dir']
+    if not directory:
+        snapshots = [registry.snapshot()]
+    else:
+        flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, 'metrics_*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    merged, counters, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = _key(name, labels)
+            histogram = merged.get(key)
+            if histogram is None:
+                merged[key] = Histogram(tuple(buckets), list(counts), total, count)
+            else:
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+        for name, labels, value in snapshot['counters']:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['gauges']:
+            key = _key(name, labels)
+            gauges[key] = max(gauges.get(key, value), value)
+    return merged, counters, gauges
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _render_values(lines, values, kind):
+    for name in sorted({name for name, _ in values}):
+        lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), value in sorted(values.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+
+def render_prometheus():
+    lines = []
+    merged, counters, gauges = _collect()
+    for name in sorted({name for name, _ in merged}):
+        lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), histogram in sorted(merged.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, ("le", repr(float(bound))))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, ("le", "+Inf"))} {histogram.count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+    _render_values(lines, counters, 'counter')
+    _render_values(lines, gauges, 'gauge')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_endpoint():
+    """Prometheus scrape endpoint, for requests bearing METRICS_TOKEN"""
+    # Not the client address: behind a same-host proxy every request is from 127.0.0.1
+    token = current_app.config.get('METRICS_TOKEN')
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if not token or scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+        abort(404)
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Register request hooks and the /metrics endpoint.
+
+    Must run before ``db.init_app`` so the timed pool is used for the engine.
+    """
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if not uri.startswith('sqlite'):
+        engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        engine_options.setdefault('poolclass', TimedQueuePool)
+
+    _settings['multiproc_dir'] = app.config.get('METRICS_MULTIPROC_DIR')
+    _settings['flush_seconds'] = app.config.get('METRICS_FLUSH_SECONDS', 5.0)
+    if _settings['multiproc_dir']:
+        os.makedirs(_settings['multiproc_dir'], exist_ok=True)
+        remove_dead_snapshots(_settings['multiproc_dir'])
+        atexit.register(_remove_snapshot)
+
+    app.before_request(_start_request)
+    app.after_request(_capture_status)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
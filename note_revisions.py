@@ -0,0 +1,228 @@
+"""
+Revision history for medical notes.
+
+The current version of a note stays in ``medical_notes``; every version an
+update or delete replaces is written to ``medical_note_revisions`` in the
+same transaction. Most revisions are reverse deltas: the edits that turn the
+version after them back into the replaced one, as word-level copy/insert
+operations. Every ``NOTE_REVISION_SNAPSHOT_INTERVAL``-th version, and the
+last version of a deleted note, is stored in full instead. Payloads are
+zlib-compressed JSON.
+
+Reconstructing a version therefore starts from the nearest snapshot above it,
+or from the live note, and applies fewer than the interval's worth of deltas.
+Notes edited before the history existed have no revisions for their older
+versions; those are not recoverable.
+"""
+import json
+import re
+import zlib
+from collections import defaultdict
+from datetime import date, datetime
+from difflib import SequenceMatcher
+
+from flask import current_app, has_app_context
+from sqlalchemy import func, insert, select
+
+from src.models.user import db, MedicalNote, MedicalNoteRevision
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+DEFAULT_SNAPSHOT_INTERVAL = 10
+
+# The fields a revision keeps; ownership and dates of the note do not change
+FIELDS = ('note_date', 'note_details', 'medication', 'treatment')
+
+# Whitespace and words; joined back together they give the original text
+_TOKENS = re.compile(r'\s+|\S+')
+
+
+def columns():
+    """Columns of ``medical_notes`` a revision is made from, for SELECT or RETURNING"""
+    table = MedicalNote.__table__
+    return [table.c[name] for name in ('note_id', 'patient_id', 'doctor_id', 'version') + FIELDS]
+
+
+def content(row):
+    """The revisioned fields of a note row or dict, with the date as text"""
+    values = row if isinstance(row, dict) else row._mapping
+    result = {name: values[name] for name in FIELDS}
+    if isinstance(result['note_date'], date):
+        result['note_date'] = result['note_date'].isoformat()
+    return result
+
+
+def pack(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def diff(base, target):
+    """Delta that turns ``base`` content into ``target``, for the fields that differ.
+
+    A text field becomes a list of operations: ``[start, end]`` copies
+    ``base`` tokens, a string is inserted as is. None is stored as None.
+    """
+    delta = {}
+    for name in FIELDS:
+        old, new = base[name], target[name]
+        if old == new:
+            continue
+        if new is None:
+            delta[name] = None
+            continue
+        old_tokens = _TOKENS.findall(old or '')
+        new_tokens = _TOKENS.findall(new)
+        operations = []
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_tokens, new_tokens, autojunk=False).get_opcodes():
+            if tag == 'equal':
+                operations.append([i1, i2])
+            elif j2 > j1:
+                operations.append(''.join(new_tokens[j1:j2]))
+        delta[name] = operations
+    return delta
+
+
+def patch(base, delta):
+    """``base`` content with a ``diff`` applied"""
+    result = dict(base)
+    for name, operations in delta.items():
+        if operations is None:
+            result[name] = None
+            continue
+        tokens = _TOKENS.findall(base[name] or '')
+        result[name] = ''.join(operation if isinstance(operation, str) else ''.join(tokens[slice(*operation)])
+                               for operation in operations)
+    return result
+
+
+def _snapshot_interval():
+    if has_app_context():
+        return current_app.config.get('NOTE_REVISION_SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL)
+    return DEFAULT_SNAPSHOT_INTERVAL
+
+
+def record(replaced, following=None):
+    """Store ``replaced``, a note row from ``columns()``, in the note's history.
+
+    ``following`` is the version that replaced it; None when the note was
+    deleted. Runs in the caller's transaction.
+    """
+    old = content(replaced)
+    if following is None or replaced.version % _snapshot_interval() == 0:
+        kind, payload = SNAPSHOT, pack(old)
+    else:
+        kind, payload = DELTA, pack(diff(content(following), old))
+    db.session.execute(insert(MedicalNoteRevision.__table__).values(
+        note_id=replaced.note_id,
+        patient_id=replaced.patient_id,
+        doctor_id=replaced.doctor_id,
+        version=replaced.version,
+        kind=kind,
+        payload=payload,
+        replaced_at=datetime.utcnow()
+    ))
+
+
+def _walk(current, revisions):
+    """``(version, replaced_at, content)`` newest first.
+
+    ``revisions`` are one note's rows ordered by descending version. Each
+    delta is applied to the version after it; a missing version breaks the
+    chain until the next snapshot.
+    """
+    if current is not None:
+        following, value = current.version, content(current)
+        yield following, None, value
+    else:
+        following, value = None, None
+    for revision in revisions:
+        if revision.kind == SNAPSHOT:
+            value = unpack(revision.payload)
+        elif value is not None and revision.version == following - 1:
+            value = patch(value, unpack(revision.payload))
+        else:
+            value = None
+        following = revision.version
+        if value is not None:
+            yield revision.version, revision.replaced_at, value
+
+
+def _entry(version, replaced_at, value):
+    return dict(version=version, replaced_at=replaced_at, **value)
+
+
+def _history(note_id, current, revisions, entries):
+    owner = current if current is not None else revisions[0]
+    return {
+        'note_id': note_id,
+        'patient_id': owner.patient_id,
+        'doctor_id': owner.doctor_id,
+        'deleted': current is None,
+        'revisions': entries
+    }
+
+
+def _current(note_id):
+    return db.session.execute(select(*columns()).where(MedicalNote.note_id == note_id)).first()
+
+
+def history(note_id):
+    """Every recoverable version of a note, newest first, or None if it never existed"""
+    current = _current(note_id)
+    revisions = db.session.execute(
+        select(MedicalNoteRevision)
+        .where(MedicalNoteRevision.note_id == note_id)
+        .order_by(MedicalNoteRevision.version.desc())
+    ).scalars().all()
+    if current is None and not revisions:
+        return None
+    return _history(note_id, current, revisions, [_entry(*item) for item in _walk(current, revisions)])
+
+
+def revision(note_id, version):
+    """Like ``history`` with only ``version`` in ``revisions`` (empty if it cannot be recovered).
+
+    Reads the revisions from ``version`` up to the first snapshot, so at
+    most one snapshot and the deltas in between.
+    """
+    rev = MedicalNoteRevision
+    snapshot = (select(func.min(rev.version))
+                .where(rev.note_id == note_id, rev.version >= version, rev.kind == SNAPSHOT)
+                .scalar_subquery())
+    revisions = db.session.execute(
+        select(rev)
+        .where(rev.note_id == note_id, rev.version >= version,
+               rev.version <= func.coalesce(snapshot, rev.version))
+        .order_by(rev.version.desc())
+    ).scalars().all()
+    current = None if revisions and revisions[0].kind == SNAPSHOT else _current(note_id)
+    if current is None and not revisions:
+        return None
+    entries = [_entry(*item) for item in _walk(current, revisions) if item[0] == version]
+    return _history(note_id, current, revisions, entries)
+
+
+def export_statements(owner, owner_id):
+    """The notes and revisions ``superseded`` needs; ``owner`` is 'patient_id' or 'doctor_id'"""
+    notes = select(*columns()).where(getattr(MedicalNote, owner) == owner_id)
+    revisions = (select(MedicalNoteRevision)
+                 .where(getattr(MedicalNoteRevision, owner) == owner_id)
+                 .order_by(MedicalNoteRevision.note_id, MedicalNoteRevision.version.desc()))
+    return notes, revisions
+
+
+def superseded(notes, revisions):
+    """Replaced versions of every note as flat dicts, from the rows of ``export_statements``"""
+    current = {note.note_id: note for note in notes}
+    by_note = defaultdict(list)
+    for revision in revisions:
+        by_note[revision.note_id].append(revision)
+    records = []
+    for note_id, rows in by_note.items():
+        records.extend(dict(note_id=note_id, **_entry(*item)) for item in _walk(current.get(note_id), rows)
+                       if item[1] is not None)
+    return records
@@ -0,0 +1,333 @@
+"""
+Monthly partitions for ``appointments`` and archival of old months.
+
+On PostgreSQL ``appointments`` is range-partitioned on ``appointment_date``,
+one partition per month (``appointments_y2025m01``) plus
+``appointments_default`` for dates outside them. Queries are unchanged: a
+filter on ``appointment_date`` is pruned to the matching partitions, and each
+partition's indexes only cover its month, so they stay small however much
+history there is.
+
+``maintain`` creates the partitions ``APPOINTMENT_PARTITION_MONTHS_AHEAD``
+months ahead and archives months older than
+``APPOINTMENT_ARCHIVE_AFTER_MONTHS``: their partitions are detached, their
+rows moved into ``appointments_archive`` and the partitions dropped. Run it
+daily:
+
+    python -m src.partitions maintain
+
+At startup only the partitions are created; old months are archived too when
+``APPOINTMENT_ARCHIVE_AT_STARTUP`` is set, since the app also starts for
+tests, the CLI and the dataset generator.
+
+The partitioned table needs ``appointment_date`` in its primary key, so it
+is created here rather than by ``db.create_all``. An existing unpartitioned
+table is converted with ``python -m src.partitions migrate``.
+
+SQLite has no partitioning; there ``maintain`` only archives old rows.
+
+Archived rows are stored per patient, doctor and month as zlib-compressed
+JSON, so a patient's or a doctor's archive can be exported and erased without
+touching anyone else's.
+"""
+import argparse
+import json
+import logging
+import re
+import sys
+import zlib
+from collections import defaultdict
+from datetime import date, time
+
+from sqlalchemy import column, delete, insert, select, table, text
+from src.models.user import db, Appointment, AppointmentArchive, Patient, Doctor
+
+logger = logging.getLogger(__name__)
+
+PARENT = 'appointments'
+DEFAULT_PARTITION = 'appointments_default'
+
+_PARTITION_NAME = re.compile(r'^appointments_y(\d{4})m(\d{2})$')
+
+# Arbitrary key for the advisory lock that keeps workers from maintaining at once
+_LOCK_KEY = 7302042
+
+_COLUMNS = [c.name for c in Appointment.__table__.columns]
+
+_POSTGRESQL_DDL = (
+    """CREATE TABLE appointments (
+        appointment_id SERIAL,
+        patient_id INTEGER NOT NULL REFERENCES patients(patient_id),
+        doctor_id INTEGER NOT NULL REFERENCES doctors(doctor_id),
+        appointment_date DATE NOT NULL,
+        appointment_time TIME NOT NULL,
+        reason TEXT,
+        created_at TIMESTAMP,
+        version INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (appointment_id, appointment_date),
+        CONSTRAINT uq_appointments_doctor_slot UNIQUE (doctor_id, appointment_date, appointment_time)
+    ) PARTITION BY RANGE (appointment_date)""",
+    'CREATE INDEX ix_appointments_patient_id ON appointments (patient_id)',
+    'CREATE INDEX ix_appointments_date_time ON appointments (appointment_date, appointment_time)',
+    f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF appointments DEFAULT'
+)
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT}_y{month.year}m{month.month:02d}'
+
+
+def _table(name):
+    """Lightweight typed table for ``appointments`` or one of its partitions"""
+    return table(name, *(column(c.name, c.type) for c in Appointment.__table__.columns))
+
+
+def _relkind(name):
+    """``'p'`` for a partitioned table, ``'r'`` for a plain one, None if missing"""
+    return db.session.execute(text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)'),
+                              {'name': name}).scalar()
+
+
+def is_partitioned():
+    return db.session.get_bind().dialect.name == 'postgresql' and _relkind(PARENT) == 'p'
+
+
+def monthly_partitions():
+    """``(name, month)`` of the attached monthly partitions, oldest first"""
+    names = db.session.execute(text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE pg_inherits.inhparent = to_regclass(:parent)'
+    ), {'parent': PARENT}).scalars()
+    months = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            months.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(months, key=lambda item: item[1])
+
+
+def create_partitioned_table():
+    """Create ``appointments`` partitioned on PostgreSQL; call before ``db.create_all``"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _LOCK_KEY})
+    if _relkind(PARENT) is None:
+        # The foreign keys need these first
+        db.metadata.create_all(db.session.connection(), tables=[Patient.__table__, Doctor.__table__])
+        for statement in _POSTGRESQL_DDL:
+            db.session.execute(text(statement))
+    db.session.commit()
+
+
+def _create_partition(name, start, end):
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    default = _table(DEFAULT_PARTITION)
+    in_range = (default.c.appointment_date >= start, default.c.appointment_date < end)
+    if db.session.execute(select(default.c.appointment_id).where(*in_range).limit(1)).first() is None:
+        db.session.execute(text(f'CREATE TABLE {name} PARTITION OF {PARENT} {bounds}'))
+        return
+    # Bookings beyond the horizon went to the default partition, which cannot
+    # overlap a new partition; move them over before attaching it
+    db.session.execute(text(f'CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)'))
+    moved = delete(default).where(*in_range).returning(*default.c).cte('moved')
+    db.session.execute(insert(_table(name)).from_select(_COLUMNS, select(moved)))
+    db.session.execute(text(f'ALTER TABLE {PARENT} ATTACH PARTITION {name} {bounds}'))
+
+
+def ensure_partitions(months_ahead, today=None, since=None):
+    """Create monthly partitions from ``since`` (default this month) to ``months_ahead`` months ahead.
+
+    Returns the names of the partitions created.
+    """
+    current = _month_start(today or date.today())
+    month = _month_start(since or current)
+    last = _add_months(current, months_ahead)
+    created = []
+    while month <= last:
+        name = partition_name(month)
+        if _relkind(name) is None:
+            _create_partition(name, month, _add_months(month, 1))
+            created.append(name)
+        month = _add_months(month, 1)
+    return created
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, (date, time)) else value
+
+
+def _archive_rows(rows):
+    """Store ``rows`` in ``appointments_archive``, one entry per patient, doctor and month; returns the count"""
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row.patient_id, row.doctor_id, _month_start(row.appointment_date))].append(
+            [_plain(getattr(row, name)) for name in _COLUMNS])
+    if groups:
+        db.session.execute(insert(AppointmentArchive), [{
+            'patient_id': patient_id,
+            'doctor_id': doctor_id,
+            'period_start': month,
+            'row_count': len(values),
+            'payload': zlib.compress(json.dumps({'columns': _COLUMNS, 'rows': values},
+                                                separators=(',', ':')).encode('utf-8'), 9)
+        } for (patient_id, doctor_id, month), values in groups.items()])
+    return sum(len(values) for values in groups.values())
+
+
+def archive_cutoff(older_than_months, today=None):
+    """First day that is not archived"""
+    return _add_months(_month_start(today or date.today()), -older_than_months)
+
+
+def archive(older_than_months, today=None):
+    """Move appointments from months older than ``older_than_months`` into the archive.
+
+    Returns ``(partitions dropped, rows archived)``.
+    """
+    cutoff = archive_cutoff(older_than_months, today)
+    dropped, archived = [], 0
+    if is_partitioned():
+        for name, month in monthly_partitions():
+            if _add_months(month, 1) > cutoff:
+                break
+            db.session.execute(text(f'ALTER TABLE {PARENT} DETACH PARTITION {name}'))
+            partition = _table(name)
+            archived += _archive_rows(db.session.execute(select(*partition.c)))
+            db.session.execute(text(f'DROP TABLE {name}'))
+            dropped.append(name)
+        source = _table(DEFAULT_PARTITION)
+    else:
+        source = _table(PARENT)
+    rows = db.session.execute(delete(source).where(source.c.appointment_date < cutoff).returning(*source.c))
+    archived += _archive_rows(rows.all())
+    return dropped, archived
+
+
+def maintain(months_ahead, archive_after_months, today=None, archive_old=True):
+    """Create upcoming partitions and, with ``archive_old``, archive old months in one transaction.
+
+    Returns a summary dict, or None when another worker is already at it.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        if not db.session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': _LOCK_KEY}).scalar():
+            db.session.rollback()
+            return None
+        if _relkind(PARENT) != 'p':
+            logger.warning('appointments is not partitioned; run python -m src.partitions migrate')
+    try:
+        created = ensure_partitions(months_ahead, today) if is_partitioned() else []
+        dropped, archived = archive(archive_after_months, today) if archive_old else ([], 0)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {'created': created, 'archived_partitions': dropped, 'archived_rows': archived}
+
+
+def migrate(months_ahead, archive_after_months, today=None):
+    """Convert an unpartitioned ``appointments`` table on PostgreSQL, keeping its rows and ids"""
+    if db.session.get_bind().dialect.name != 'postgresql' or _relkind(PARENT) != 'r':
+        return None
+    try:
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _LOCK_KEY})
+        db.session.execute(text(f'LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE'))
+        # Constraint and index names are per schema, so free them for the new table
+        db.session.execute(text(f'ALTER TABLE {PARENT} RENAME TO appointments_unpartitioned'))
+        db.session.execute(text('ALTER TABLE appointments_unpartitioned '
+                                'DROP CONSTRAINT IF EXISTS appointments_pkey, '
+                                'DROP CONSTRAINT IF EXISTS uq_appointments_doctor_slot'))
+        db.session.execute(text('DROP INDEX IF EXISTS ix_appointments_patient_id'))
+        db.session.execute(text('DROP INDEX IF EXISTS ix_appointments_date_time'))
+        for statement in _POSTGRESQL_DDL:
+            db.session.execute(text(statement))
+
+        old = _table('appointments_unpartitioned')
+        earliest = db.session.execute(select(old.c.appointment_date).order_by(old.c.appointment_date)
+                                      .limit(1)).scalar()
+        cutoff = archive_cutoff(archive_after_months, today)
+        since = max(earliest, cutoff) if earliest else None
+        created = ensure_partitions(months_ahead, today, since)
+        db.session.execute(insert(_table(PARENT)).from_select(_COLUMNS, select(*old.c)))
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('appointments', 'appointment_id'), "
+            "COALESCE((SELECT max(appointment_id) FROM appointments), 0) + 1, false)"
+        ))
+        db.session.execute(text('DROP TABLE appointments_unpartitioned'))
+        dropped, archived = archive(archive_after_months, today)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {'created': created, 'archived_partitions': dropped, 'archived_rows': archived}
+
+
+def unpack(payloads):
+    """Archived appointments as dicts, from ``appointments_archive.payload`` values"""
+    records = []
+    for payload in payloads:
+        archived = json.loads(zlib.decompress(payload))
+        records.extend(dict(zip(archived['columns'], row)) for row in archived['rows'])
+    return records
+
+
+def archived_statement(owner, owner_id):
+    """Archive payloads of a patient or doctor; ``owner`` is 'patient_id' or 'doctor_id'"""
+    return (select(AppointmentArchive.payload)
+            .where(getattr(AppointmentArchive, owner) == owner_id)
+            .order_by(AppointmentArchive.period_start, AppointmentArchive.archive_id))
+
+
+def archived_appointments(owner, owner_id):
+    """A patient's or doctor's archived appointments, oldest month first"""
+    return unpack(db.session.execute(archived_statement(owner, owner_id)).scalars())
+
+
+def init_app(app):
+    """Create upcoming partitions, and archive old months if configured; runs after ``db.create_all``"""
+    with app.app_context():
+        summary = maintain(app.config.get('APPOINTMENT_PARTITION_MONTHS_AHEAD', 12),
+                           app.config.get('APPOINTMENT_ARCHIVE_AFTER_MONTHS', 12),
+                           archive_old=app.config.get('APPOINTMENT_ARCHIVE_AT_STARTUP', False))
+        if summary and (summary['created'] or summary['archived_rows']):
+            logger.info('Appointment partitions: %s', summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Appointment partition maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('maintain', help='Create upcoming partitions and archive old months')
+    subparsers.add_parser('migrate', help='Partition an existing appointments table (PostgreSQL)')
+    args = parser.parse_args(argv)
+
+    from src.main import app
+    with app.app_context():
+        months_ahead = app.config.get('APPOINTMENT_PARTITION_MONTHS_AHEAD', 12)
+        archive_after = app.config.get('APPOINTMENT_ARCHIVE_AFTER_MONTHS', 12)
+        if args.command == 'migrate':
+            summary = migrate(months_ahead, archive_after)
+            if summary is None:
+                print('Nothing to migrate: appointments is already partitioned or not on PostgreSQL')
+                return 0
+        else:
+            summary = maintain(months_ahead, archive_after)
+            if summary is None:
+                print('Another worker is maintaining the partitions')
+                return 0
+    print(f"Created partitions: {', '.join(summary['created']) or '-'}")
+    print(f"Archived partitions: {', '.join(summary['archived_partitions']) or '-'}")
+    print(f"Archived appointments: {summary['archived_rows']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Patient typeahead search by name or email.
+
+Each query reads a bounded range of an index, so its cost depends on the
+number of results asked for rather than on the number of patients.
+
+PostgreSQL matches prefixes of the lower-cased full name (in both orders)
+and email with ``COLLATE "C"`` expression indexes, which serve both the
+``LIKE 'prefix%'`` and the ordering. Queries of three or more characters
+that find fewer results than asked for are topped up with ``pg_trgm``
+similarity matches through GIN indexes, catching typos and mid-word
+matches.
+
+SQLite has no trigram indexes. Triggers maintain ``patient_search_terms``,
+holding each patient's normalized full name (both orders) and email, with
+case and accents removed. A prefix is a range scan of its primary key.
+
+Matches on a whole word rank first, then shorter matching terms.
+"""
+import logging
+import sqlite3
+import unicodedata
+
+from sqlalchemy import case, column, event, func, inspect, literal_column, or_, select, table, text, union_all
+from sqlalchemy.engine import Engine
+from src.models.user import db, Patient
+from src.fieldsets import RESOURCES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+MAX_QUERY_LENGTH = 100
+TYPEAHEAD_FIELDS = ('patient_id', 'first_name', 'last_name', 'email', 'date_of_birth')
+
+# Shorter queries have too few trigrams to be selective
+TRIGRAM_MIN_LENGTH = 3
+
+# Sorts after every other code point, bounding a prefix range scan
+_MAX_CHAR = '\U0010ffff'
+
+_terms = table('patient_search_terms', column('term'), column('patient_id'))
+
+# Terms per patient; the SQLite scan reads this many terms per wanted result
+_TERMS_PER_PATIENT = 3
+
+_SQLITE_TERMS = (
+    "search_normalize({row}.first_name || ' ' || {row}.last_name)",
+    "search_normalize({row}.last_name || ' ' || {row}.first_name)",
+    "search_normalize({row}.email)"
+)
+
+
+def _sqlite_insert_terms(row):
+    values = ', '.join(f'({term.format(row=row)}, {row}.patient_id)' for term in _SQLITE_TERMS)
+    return f'INSERT OR IGNORE INTO patient_search_terms (term, patient_id) VALUES {values};'
+
+
+_SQLITE_DDL = (
+    """CREATE TABLE IF NOT EXISTS patient_search_terms (
+        term TEXT NOT NULL,
+        patient_id INTEGER NOT NULL,
+        PRIMARY KEY (term, patient_id)
+    ) WITHOUT ROWID""",
+    'CREATE INDEX IF NOT EXISTS ix_patient_search_terms_patient_id ON patient_search_terms (patient_id)',
+    f"""CREATE TRIGGER IF NOT EXISTS patients_search_insert AFTER INSERT ON patients BEGIN
+        {_sqlite_insert_terms('NEW')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS patients_search_update
+    AFTER UPDATE OF first_name, last_name, email ON patients BEGIN
+        DELETE FROM patient_search_terms WHERE patient_id = OLD.patient_id;
+        {_sqlite_insert_terms('NEW')}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS patients_search_delete AFTER DELETE ON patients BEGIN
+        DELETE FROM patient_search_terms WHERE patient_id = OLD.patient_id;
+    END"""
+)
+
+_SQLITE_BACKFILL = ' UNION ALL '.join(
+    f'SELECT {term.format(row="patients")}, patients.patient_id FROM patients' for term in _SQLITE_TERMS
+)
+
+_POSTGRESQL_DDL = (
+    """CREATE INDEX IF NOT EXISTS ix_patients_search_name
+    ON patients ((lower(first_name || ' ' || last_name) COLLATE "C"))""",
+    """CREATE INDEX IF NOT EXISTS ix_patients_search_reversed_name
+    ON patients ((lower(last_name || ' ' || first_name) COLLATE "C"))""",
+    """CREATE INDEX IF NOT EXISTS ix_patients_search_email ON patients ((lower(email) COLLATE "C"))"""
+)
+
+_POSTGRESQL_TRIGRAM_DDL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    """CREATE INDEX IF NOT EXISTS ix_patients_search_name_trgm
+    ON patients USING gin (lower(first_name || ' ' || last_name) gin_trgm_ops)""",
+    'CREATE INDEX IF NOT EXISTS ix_patients_search_email_trgm ON patients USING gin (lower(email) gin_trgm_ops)'
+)
+
+# Set by init_app once the pg_trgm indexes exist
+_trigram_enabled = False
+
+
+def normalize(value):
+    """Lower-case, accent-free form with single spaces, used for SQLite terms and queries"""
+    if value is None:
+        return None
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
+
+
+@event.listens_for(Engine, 'connect')
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('search_normalize', 1, normalize, deterministic=True)
+
+
+def _space():
+    # Inline rather than bound, so the expressions match the index definitions
+    return literal_column("' '")
+
+
+def _name():
+    return func.lower(Patient.first_name + _space() + Patient.last_name)
+
+
+def _postgresql_expressions():
+    return (
+        _name(),
+        func.lower(Patient.last_name + _space() + Patient.first_name),
+        func.lower(Patient.email)
+    )
+
+
+def _like_prefix(value):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+def _postgresql_candidates(query, limit):
+    """``(patient_id, matched)`` for up to ``limit`` prefix matches per expression"""
+    branches = []
+    for expression in _postgresql_expressions():
+        expression = expression.collate('C')
+        branch = (select(Patient.patient_id.label('patient_id'), expression.label('matched'))
+                  .where(expression.like(_like_prefix(query), escape='\\'))
+                  .order_by(expression)
+                  .limit(limit)
+                  .subquery())
+        branches.append(select(branch.c.patient_id, branch.c.matched))
+    return union_all(*branches).subquery('candidates')
+
+
+def _sqlite_candidates(query, limit):
+    """``(patient_id, matched)`` for the first terms starting with ``query``"""
+    return (select(_terms.c.patient_id.label('patient_id'), _terms.c.term.label('matched'))
+            .where(_terms.c.term >= query, _terms.c.term < query + _MAX_CHAR)
+            .order_by(_terms.c.term)
+            .limit(limit * _TERMS_PER_PATIENT)
+            .subquery('candidates'))
+
+
+def _columns(fields):
+    resource = RESOURCES['patients']
+    names = list(dict.fromkeys(list(fields) + ['patient_id']))
+    return [resource.fields[name][0].label(name) for name in names]
+
+
+def _prefix_matches(query, candidates, fields, limit):
+    matched = candidates.c.matched
+    whole_word = or_(matched == query, matched.like(_like_prefix(query + ' '), escape='\\'))
+    ranked = (select(candidates.c.patient_id,
+                     func.min(case((whole_word, 0), else_=1)).label('rank'),
+                     func.min(func.length(matched)).label('closeness'))
+              .group_by(candidates.c.patient_id)
+              .subquery('ranked'))
+    statement = (select(*_columns(fields))
+                 .join_from(ranked, Patient, Patient.patient_id == ranked.c.patient_id)
+                 .order_by(ranked.c.rank, ranked.c.closeness, Patient.last_name, Patient.first_name)
+                 .limit(limit))
+    return db.session.execute(statement).all()
+
+
+def _trigram_matches(query, fields, limit, exclude):
+    name, email = _name(), func.lower(Patient.email)
+    similarity = func.greatest(func.similarity(name, query), func.similarity(email, query))
+    statement = (select(*_columns(fields))
+                 .where(or_(name.op('%')(query), email.op('%')(query)))
+                 .order_by(similarity.desc(), Patient.patient_id)
+                 .limit(limit))
+    if exclude:
+        statement = statement.where(Patient.patient_id.notin_(exclude))
+    return db.session.execute(statement).all()
+
+
+def search(query, fields, limit=DEFAULT_LIMIT):
+    """Patients matching ``query``, best first, as rows of ``fields``"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        query = ' '.join(query.lower().split())
+        rows = _prefix_matches(query, _postgresql_candidates(query, limit), fields, limit)
+        if _trigram_enabled and len(rows) < limit and len(query) >= TRIGRAM_MIN_LENGTH:
+            rows += _trigram_matches(query, fields, limit - len(rows), [row.patient_id for row in rows])
+        return rows
+
+    query = normalize(query)
+    return _prefix_matches(query, _sqlite_candidates(query, limit), fields, limit)
+
+
+def _create_postgresql_indexes():
+    global _trigram_enabled
+    for statement in _POSTGRESQL_DDL:
+        db.session.execute(text(statement))
+    db.session.commit()
+    try:
+        for statement in _POSTGRESQL_TRIGRAM_DDL:
+            db.session.execute(text(statement))
+        db.session.commit()
+        _trigram_enabled = True
+    except Exception as e:
+        # CREATE EXTENSION needs privileges the app user may not have;
+        # prefix search still works without it
+        db.session.rollback()
+        logger.warning('pg_trgm unavailable, patient search falls back to prefixes only: %s', e)
+
+
+def _create_sqlite_index():
+    existed = inspect(db.engine).has_table('patient_search_terms')
+    for statement in _SQLITE_DDL:
+        db.session.execute(text(statement))
+    if not existed:
+        db.session.execute(text(f'INSERT OR IGNORE INTO patient_search_terms (term, patient_id) {_SQLITE_BACKFILL}'))
+    db.session.commit()
+
+
+def init_app(app):
+    """Create the search indexes (and, on SQLite, the term table and triggers)"""
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            _create_postgresql_indexes()
+        elif dialect == 'sqlite':
+            _create_sqlite_index()
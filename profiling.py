@@ -0,0 +1,216 @@
+"""
+On-demand sampling profiler for individual requests.
+
+A request is profiled when it carries an allow-listed ``X-Profile-Token``
+header or is picked by PROFILING_SAMPLE_RATE. A background thread samples
+the request thread's stack every PROFILING_INTERVAL_MS and, when the request
+finishes, collapsed stacks, a flamegraph SVG and a per-category time summary
+are written to PROFILING_OUTPUT_DIR. When no tokens are configured and the
+sample rate is zero no hooks are installed at all.
+"""
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from html import escape
+
+from flask import g, request
+
+# Checked leaf-first; the first category with a matching frame wins
+CATEGORIES = (
+    ('sql', lambda filename, name: 'sqlalchemy' in filename or 'psycopg' in filename or 'sqlite3' in filename),
+    ('bcrypt', lambda filename, name: 'bcrypt' in filename or name in ('hash_password', 'verify_password')),
+    ('serialization', lambda filename, name: name in ('to_dict', 'jsonify', 'dumps', 'response')
+        or 'json' in os.path.basename(filename)),
+    ('regex_validation', lambda filename, name: filename.endswith(os.path.join('re', '__init__.py'))
+        or name in ('validate_input', 'validate_password_strength', 'sanitize_input')),
+    ('logging', lambda filename, name: 'logging' in filename or name == 'log_security_event')
+)
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+_settings = {'tokens': (), 'sample_rate': 0.0, 'interval': 0.001, 'output_dir': None}
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            category = None
+            while frame is not None:
+                code = frame.f_code
+                if category is None:
+                    category = _categorize(code.co_filename, code.co_name)
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                             .replace(';', ','))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+            self.categories[category or 'other'] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _categorize(filename, name):
+    for category, matches in CATEGORIES:
+        if matches(filename, name):
+            return category
+    return None
+
+
+def _is_requested():
+    token = request.headers.get('X-Profile-Token')
+    if token:
+        for allowed in _settings['tokens']:
+            if hmac.compare_digest(token.encode('utf-8'), allowed.encode('utf-8')):
+                return True
+    return _settings['sample_rate'] > 0 and random.random() < _settings['sample_rate']
+
+
+def _start_profile():
+    if not _is_requested():
+        return
+    request_id = request.headers.get('X-Request-ID', '')
+    if not _REQUEST_ID.match(request_id):
+        request_id = uuid.uuid4().hex
+    sampler = StackSampler(threading.get_ident(), _settings['interval'])
+    g.profile = {'sampler': sampler, 'request_id': request_id, 'started': time.perf_counter()}
+    sampler.start()
+
+
+def _tag_response(response):
+    profile = g.get('profile')
+    if profile is not None:
+        response.headers['X-Profile-Id'] = profile['request_id']
+    return response
+
+
+def _finish_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    sampler = profile['sampler']
+    sampler.stop()
+    rule = request.url_rule
+    write_profile(
+        route=rule.rule if rule is not None else request.path,
+        request_id=profile['request_id'],
+        sampler=sampler,
+        duration=time.perf_counter() - profile['started']
+    )
+
+
+def write_profile(route, request_id, sampler, duration):
+    """Write collapsed stacks, a flamegraph and a category summary"""
+    output_dir = _settings['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    base = os.path.join(output_dir, f"{datetime.utcnow():%Y%m%dT%H%M%S}_{slug}_{request_id}")
+
+    with open(base + '.collapsed', 'w') as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+    with open(base + '.svg', 'w') as f:
+        f.write(render_flamegraph(sampler.stacks, title=f'{route} ({request_id})'))
+
+    samples = sampler.samples or 1
+    summary = {
+        'route': route,
+        'request_id': request_id,
+        'duration_seconds': duration,
+        'interval_seconds': sampler.interval,
+        'samples': sampler.samples,
+        'categories': {
+            category: {
+                'samples': count,
+                'seconds': count * sampler.interval,
+                'percent': round(100.0 * count / samples, 1)
+            }
+            for category, count in sampler.categories.most_common()
+        }
+    }
+    with open(base + '.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    return base
+
+
+def render_flamegraph(stacks, title='', width=1200, row_height=16):
+    """Render collapsed stacks as a self-contained flamegraph SVG"""
+    root = {'name': 'all', 'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        root['count'] += count
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'count': 0, 'children': {}})
+            node['count'] += count
+
+    rects = []
+    max_depth = 0
+
+    def layout(node, x, depth):
+        nonlocal max_depth
+        max_depth = max(max_depth, depth)
+        node_width = width * node['count'] / max(root['count'], 1)
+        rects.append((x, depth, node_width, node['name'], node['count']))
+        child_x = x
+        for child in sorted(node['children'].values(), key=lambda n: n['name']):
+            layout(child, child_x, depth + 1)
+            child_x += width * child['count'] / max(root['count'], 1)
+
+    layout(root, 0.0, 0)
+    height = (max_depth + 1) * row_height + 30
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="14">{escape(title)}</text>'
+    ]
+    for x, depth, rect_width, name, count in rects:
+        if rect_width < 0.5:
+            continue
+        y = height - (depth + 1) * row_height
+        hue = 20 + (hash(name) % 40)
+        label = escape(name[:int(rect_width / 7)]) if rect_width > 21 else ''
+        parts.append(
+            f'<g><title>{escape(name)} ({count} samples)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{rect_width:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+            f'<text x="{x + 2:.1f}" y="{y + row_height - 4}">{label}</text></g>'
+        )
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def init_app(app):
+    """Install the profiling hooks only when profiling can be triggered"""
+    _settings['tokens'] = tuple(token for token in app.config.get('PROFILING_ADMIN_TOKENS', ()) if token)
+    _settings['sample_rate'] = app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+    _settings['interval'] = app.config.get('PROFILING_INTERVAL_MS', 1) / 1000.0
+    _settings['output_dir'] = app.config.get('PROFILING_OUTPUT_DIR') or os.path.join(app.instance_path, 'profiles')
+    if not _settings['tokens'] and not _settings['sample_rate']:
+        return
+
+    app.before_request(_start_profile)
+    app.after_request(_tag_response)
+    app.teardown_request(_finish_profile)
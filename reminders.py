@@ -0,0 +1,324 @@
+"""
+Batched appointment reminders.
+
+    python -m src.reminders run            # every REMINDER_INTERVAL_SECONDS
+    python -m src.reminders run --once
+
+Each pass reads the appointments starting within the next
+``REMINDER_LEAD_HOURS`` in pages of ``REMINDER_BATCH_SIZE``, as keyset range
+scans of ``ix_appointments_date_time``. Appointments that already have a
+reminder are left out by an anti-join on ``appointment_reminders``. A page is
+claimed with one INSERT ... ON CONFLICT DO NOTHING RETURNING, so a reminder
+is claimed by one dispatcher even if several run. The claimed reminders go
+to the transport as one batch, on a pool of ``REMINDER_MAX_CONCURRENCY``
+threads, and each reminder is marked sent or failed.
+
+A reminder is keyed by the appointment's slot, so a rescheduled appointment
+gets another one. After downtime the next pass catches up on every
+appointment still ahead that has none. Failed sends are retried up to
+``REMINDER_MAX_ATTEMPTS``. A claim left behind by a crashed dispatcher is
+not retried, since its message may have gone out.
+
+Transports take a list of reminders and yield ``(appointment_id, error)``
+as each one is sent or refused, with ``error`` None for a sent reminder. If
+a transport raises part way through a batch, the reminders it already
+reported keep their outcome and only the rest are failed, so messages that
+went out are not sent again. ``file`` writes one .eml file per reminder, as
+a local stand-in for mail; ``smtp`` sends through ``REMINDER_SMTP_HOST``.
+Others can be added with ``register_transport``.
+"""
+import argparse
+import logging
+import os
+import smtplib
+import sys
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from sqlalchemy import and_, delete, select, tuple_, update
+from src.models.user import db, Appointment, AppointmentReminder, Doctor, Patient
+from src.db_utils import insert_ignoring_conflicts
+
+logger = logging.getLogger(__name__)
+
+SLOT_COLUMNS = ['appointment_id', 'appointment_date', 'appointment_time']
+
+
+def compose(reminder, sender):
+    """Reminder email; names the doctor and the time, never the reason"""
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = reminder['email']
+    message['Subject'] = 'Appointment reminder'
+    message.set_content(
+        f"Dear {reminder['patient_name']},\n\n"
+        f"This is a reminder of your appointment with Dr. {reminder['doctor_name']} "
+        f"on {reminder['appointment_date']:%A %d %B %Y} at {reminder['appointment_time']:%H:%M}.\n\n"
+        f"If you cannot attend, please cancel it in the patient portal.\n"
+    )
+    return message
+
+
+class FileTransport:
+    """Writes each reminder to ``directory`` as an .eml file"""
+
+    def __init__(self, directory, sender):
+        self.directory = directory
+        self.sender = sender
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, reminders):
+        for reminder in reminders:
+            name = (f"appointment-{reminder['appointment_id']}-"
+                    f"{reminder['appointment_date']:%Y%m%d}T{reminder['appointment_time']:%H%M}.eml")
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(compose(reminder, self.sender).as_bytes())
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                logger.warning('Could not write reminder %s: %s', path, e)
+                yield reminder['appointment_id'], str(e)
+            else:
+                yield reminder['appointment_id'], None
+
+
+class SMTPTransport:
+    """Sends a batch over one SMTP connection"""
+
+    def __init__(self, host, port, sender, username=None, password=None, starttls=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, reminders):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for reminder in reminders:
+                try:
+                    smtp.send_message(compose(reminder, self.sender))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    # Refused by the server, which resets the transaction; the connection is still usable
+                    yield reminder['appointment_id'], str(e)
+                else:
+                    yield reminder['appointment_id'], None
+
+
+def _file_transport(config):
+    return FileTransport(config['REMINDER_FILE_DIR'], config['REMINDER_SENDER'])
+
+
+def _smtp_transport(config):
+    return SMTPTransport(config['REMINDER_SMTP_HOST'], config['REMINDER_SMTP_PORT'], config['REMINDER_SENDER'],
+                         username=config.get('REMINDER_SMTP_USERNAME'),
+                         password=config.get('REMINDER_SMTP_PASSWORD'),
+                         starttls=config.get('REMINDER_SMTP_STARTTLS', False))
+
+
+TRANSPORTS = {
+    'file': _file_transport,
+    'smtp': _smtp_transport
+}
+
+
+def register_transport(name, factory):
+    """Make ``factory(config)`` available as ``REMINDER_TRANSPORT = name``"""
+    TRANSPORTS[name] = factory
+
+
+def transport_from_config(config):
+    name = config.get('REMINDER_TRANSPORT', 'file')
+    if name not in TRANSPORTS:
+        raise ValueError(f'Unknown reminder transport: {name}')
+    return TRANSPORTS[name](config)
+
+
+class ReminderDispatcher:
+    def __init__(self, transport, lead_hours=24, batch_size=100, max_concurrency=4, max_attempts=3,
+                 retention_days=30):
+        self.transport = transport
+        self.lead = timedelta(hours=lead_hours)
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retention_days = retention_days
+
+    @classmethod
+    def from_config(cls, config, transport=None):
+        return cls(transport or transport_from_config(config),
+                   lead_hours=config.get('REMINDER_LEAD_HOURS', 24),
+                   batch_size=config.get('REMINDER_BATCH_SIZE', 100),
+                   max_concurrency=config.get('REMINDER_MAX_CONCURRENCY', 4),
+                   max_attempts=config.get('REMINDER_MAX_ATTEMPTS', 3),
+                   retention_days=config.get('REMINDER_RETENTION_DAYS', 30))
+
+    def _details(self):
+        return select(Appointment.appointment_id, Appointment.appointment_date, Appointment.appointment_time,
+                      Patient.email, (Patient.first_name + ' ' + Patient.last_name).label('patient_name'),
+                      (Doctor.first_name + ' ' + Doctor.last_name).label('doctor_name')) \
+            .join(Patient, Patient.patient_id == Appointment.patient_id) \
+            .join(Doctor, Doctor.doctor_id == Appointment.doctor_id)
+
+    def _due(self, now, after):
+        """Next page of appointments starting in ``(after, now + lead]`` with no reminder yet"""
+        start = tuple_(Appointment.appointment_date, Appointment.appointment_time)
+        end = now + self.lead
+        reminder = AppointmentReminder
+        statement = (self._details()
+                     .outerjoin(reminder, and_(reminder.appointment_id == Appointment.appointment_id,
+                                               reminder.appointment_date == Appointment.appointment_date,
+                                               reminder.appointment_time == Appointment.appointment_time))
+                     .where(reminder.id.is_(None),
+                            start > tuple_(now.date(), now.time()),
+                            start <= tuple_(end.date(), end.time()),
+                            tuple_(Appointment.appointment_date, Appointment.appointment_time,
+                                   Appointment.appointment_id) > after)
+                     .order_by(Appointment.appointment_date, Appointment.appointment_time,
+                               Appointment.appointment_id)
+                     .limit(self.batch_size))
+        return db.session.execute(statement).all()
+
+    def _claim(self, rows, now):
+        """Appointment ids among ``rows`` claimed by this dispatcher"""
+        statement = insert_ignoring_conflicts(AppointmentReminder.__table__, SLOT_COLUMNS).values([
+            {'appointment_id': row.appointment_id, 'appointment_date': row.appointment_date,
+             'appointment_time': row.appointment_time, 'status': 'claimed', 'attempts': 1, 'claimed_at': now}
+            for row in rows
+        ]).returning(AppointmentReminder.appointment_id)
+        claimed = set(db.session.execute(statement).scalars())
+        db.session.commit()
+        return claimed
+
+    def _claim_retries(self, now):
+        """Failed reminders for appointments still ahead, claimed again"""
+        reminder = AppointmentReminder
+        start = tuple_(reminder.appointment_date, reminder.appointment_time)
+        claimed = db.session.execute(
+            update(reminder)
+            .where(reminder.status == 'failed', reminder.attempts < self.max_attempts,
+                   start > tuple_(now.date(), now.time()))
+            .values(status='claimed', attempts=reminder.attempts + 1, claimed_at=datetime.utcnow())
+            .returning(reminder.appointment_id, reminder.appointment_date, reminder.appointment_time)
+        ).all()
+        db.session.commit()
+        if not claimed:
+            return []
+        # Only while the appointment is still in the slot the reminder was for
+        return db.session.execute(self._details().where(
+            tuple_(Appointment.appointment_id, Appointment.appointment_date, Appointment.appointment_time)
+            .in_([tuple(row) for row in claimed])
+        )).all()
+
+    def _send(self, rows):
+        """``{appointment_id: error}`` for every reminder in ``rows``, None if it was sent"""
+        reminders = [dict(row._mapping) for row in rows]
+        outcomes = {}
+        try:
+            for appointment_id, error in self.transport.send(reminders):
+                outcomes[appointment_id] = error
+        except Exception as e:
+            # What was reported before the batch broke off still stands
+            logger.warning('Reminder batch of %d failed after %d: %s', len(reminders), len(outcomes), e)
+            for reminder in reminders:
+                outcomes.setdefault(reminder['appointment_id'], str(e))
+        for reminder in reminders:
+            outcomes.setdefault(reminder['appointment_id'], 'Not sent by transport')
+        return outcomes
+
+    def _record(self, rows, outcomes):
+        reminder = AppointmentReminder
+        key = tuple_(reminder.appointment_id, reminder.appointment_date, reminder.appointment_time)
+        by_error = {}
+        for row in rows:
+            by_error.setdefault(outcomes[row.appointment_id], []).append(
+                (row.appointment_id, row.appointment_date, row.appointment_time))
+        sent = by_error.pop(None, [])
+        if sent:
+            db.session.execute(update(reminder).where(key.in_(sent))
+                               .values(status='sent', sent_at=datetime.utcnow(), error=None))
+        for error, not_sent in by_error.items():
+            db.session.execute(update(reminder).where(key.in_(not_sent))
+                               .values(status='failed', error=error[:500]))
+        db.session.commit()
+        return len(sent), len(rows) - len(sent)
+
+    def run_once(self, now=None):
+        """One pass over due reminders; returns counts of sent and failed"""
+        now = now or datetime.now()
+        stats = {'sent': 0, 'failed': 0, 'batches': 0}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='reminders') as pool:
+            pending = []
+
+            def drain(limit):
+                while len(pending) > limit:
+                    rows, future = pending.pop(0)
+                    sent_count, failed_count = self._record(rows, future.result())
+                    stats['sent'] += sent_count
+                    stats['failed'] += failed_count
+
+            def submit(rows):
+                if rows:
+                    pending.append((rows, pool.submit(self._send, rows)))
+                    stats['batches'] += 1
+                    # At most max_concurrency batches in flight
+                    drain(self.max_concurrency - 1)
+
+            submit(self._claim_retries(now))
+            after = (now.date(), now.time(), 0)
+            while True:
+                rows = self._due(now, after)
+                if not rows:
+                    break
+                last = rows[-1]
+                after = (last.appointment_date, last.appointment_time, last.appointment_id)
+                claimed = self._claim(rows, datetime.utcnow())
+                submit([row for row in rows if row.appointment_id in claimed])
+            drain(0)
+        self.purge(now)
+        return stats
+
+    def purge(self, now=None):
+        """Drop bookkeeping for appointments older than the retention period"""
+        cutoff = (now or datetime.now()).date() - timedelta(days=self.retention_days)
+        db.session.execute(delete(AppointmentReminder).where(AppointmentReminder.appointment_date < cutoff))
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Appointment reminder dispatcher')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run')
+    run.add_argument('--once', action='store_true', help='Dispatch once and exit')
+    args = parser.parse_args(argv)
+
+    from src.main import app
+    with app.app_context():
+        dispatcher = ReminderDispatcher.from_config(app.config)
+        interval = app.config.get('REMINDER_INTERVAL_SECONDS', 60)
+        while True:
+            started = time_module.monotonic()
+            try:
+                stats = dispatcher.run_once()
+                if stats['batches']:
+                    print(f"Sent {stats['sent']} reminders, {stats['failed']} failed")
+            except Exception:
+                db.session.rollback()
+                logger.exception('Reminder pass failed')
+                if args.once:
+                    return 1
+            if args.once:
+                return 0
+            time_module.sleep(max(interval - (time_module.monotonic() - started), 0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
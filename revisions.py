@@ -0,0 +1,31 @@
+from flask import Blueprint, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from src import note_revisions
+
+revisions_bp = Blueprint('revisions', __name__)
+
+@revisions_bp.route('/medical-notes/<int:note_id>/revisions', methods=['GET'])
+@jwt_required()
+def get_medical_note_revisions(note_id):
+    """Earlier versions of a medical note, newest first; ?version=N for just one"""
+    current_user = get_jwt_identity()
+
+    version = request.args.get('version')
+    if version is not None:
+        if not version.isdigit() or int(version) < 1:
+            return jsonify({'error': 'version must be a positive integer'}), 400
+        history = note_revisions.revision(note_id, int(version))
+    else:
+        history = note_revisions.history(note_id)
+    if history is None:
+        return jsonify({'error': 'Medical note not found'}), 404
+
+    # Same access rules as the note itself, which may since have been deleted
+    if current_user['type'] == 'patient' and history['patient_id'] != current_user['id']:
+        return jsonify({'error': 'Access denied'}), 403
+    elif current_user['type'] == 'doctor' and history['doctor_id'] != current_user['id']:
+        return jsonify({'error': 'Access denied'}), 403
+
+    if version is not None and not history['revisions']:
+        return jsonify({'error': 'Revision not found'}), 404
+    return jsonify(history), 200
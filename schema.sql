@@ -7,7 +7,9 @@ CREATE TABLE patients (
     address TEXT,
     phone VARCHAR(50),
     email VARCHAR(255) UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL
+    password_hash TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    calendar_secret VARCHAR(64)
 );
 
 CREATE TABLE doctors (
@@ -17,19 +19,58 @@ CREATE TABLE doctors (
     specialty VARCHAR(255),
     phone VARCHAR(50),
     email VARCHAR(255) UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL
+    password_hash TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    calendar_secret VARCHAR(64)
 );
 
+-- Monthly partitions (appointments_y2025m01, ...) are created ahead of time
+-- and archived by partitions.py; the partition key must be in the primary key
 CREATE TABLE appointments (
-    appointment_id SERIAL PRIMARY KEY,
+    appointment_id SERIAL,
     patient_id INTEGER NOT NULL REFERENCES patients(patient_id),
     doctor_id INTEGER NOT NULL REFERENCES doctors(doctor_id),
     appointment_date DATE NOT NULL,
     appointment_time TIME NOT NULL,
     reason TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (appointment_id, appointment_date),
+    CONSTRAINT uq_appointments_doctor_slot UNIQUE (doctor_id, appointment_date, appointment_time)
+) PARTITION BY RANGE (appointment_date);
+
+CREATE INDEX ix_appointments_patient_id ON appointments (patient_id);
+CREATE INDEX ix_appointments_date_time ON appointments (appointment_date, appointment_time);
+CREATE TABLE appointments_default PARTITION OF appointments DEFAULT;
+
+CREATE TABLE appointments_archive (
+    archive_id SERIAL PRIMARY KEY,
+    patient_id INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    period_start DATE NOT NULL,
+    row_count INTEGER NOT NULL,
+    payload BYTEA NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX ix_appointments_archive_patient_id ON appointments_archive (patient_id);
+CREATE INDEX ix_appointments_archive_doctor_id ON appointments_archive (doctor_id);
+
+CREATE TABLE appointment_reminders (
+    id SERIAL PRIMARY KEY,
+    appointment_id INTEGER NOT NULL,
+    appointment_date DATE NOT NULL,
+    appointment_time TIME NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'claimed',
+    attempts INTEGER NOT NULL DEFAULT 1,
+    claimed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    error TEXT,
+    CONSTRAINT uq_appointment_reminders_slot UNIQUE (appointment_id, appointment_date, appointment_time)
+);
+
+CREATE INDEX ix_appointment_reminders_appointment_date ON appointment_reminders (appointment_date);
+
 CREATE TABLE medical_notes (
     note_id SERIAL PRIMARY KEY,
     patient_id INTEGER NOT NULL REFERENCES patients(patient_id),
@@ -38,5 +79,129 @@ CREATE TABLE medical_notes (
     note_details TEXT,
     medication TEXT,
     treatment TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE INDEX ix_medical_notes_doctor_date ON medical_notes (doctor_id, note_date);
+
+-- Per-doctor daily rollups (doctor_stats.py also creates the triggers that fill doctor_stats_changes)
+CREATE TABLE doctor_daily_stats (
+    doctor_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    appointments INTEGER NOT NULL DEFAULT 0,
+    attended INTEGER NOT NULL DEFAULT 0,
+    notes INTEGER NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (doctor_id, day)
+);
+
+CREATE TABLE doctor_stats_changes (
+    id SERIAL PRIMARY KEY,
+    doctor_id INTEGER NOT NULL,
+    day DATE NOT NULL
+);
+
+-- Replaced versions of medical notes (note_revisions.py)
+CREATE TABLE medical_note_revisions (
+    revision_id SERIAL PRIMARY KEY,
+    note_id INTEGER NOT NULL,
+    patient_id INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    kind VARCHAR(8) NOT NULL,
+    payload BYTEA NOT NULL,
+    replaced_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_medical_note_revisions_note_version UNIQUE (note_id, version)
+);
+
+CREATE INDEX ix_medical_note_revisions_patient_id ON medical_note_revisions (patient_id);
+CREATE INDEX ix_medical_note_revisions_doctor_id ON medical_note_revisions (doctor_id);
+
+-- Attachment metadata; the files are stored by content hash under ATTACHMENT_DIR
+CREATE TABLE note_attachments (
+    attachment_id SERIAL PRIMARY KEY,
+    note_id INTEGER NOT NULL,
+    patient_id INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    content_type VARCHAR(127) NOT NULL,
+    size BIGINT NOT NULL,
+    sha256 VARCHAR(64) NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+
+CREATE INDEX ix_note_attachments_note_id ON note_attachments (note_id);
+CREATE INDEX ix_note_attachments_patient_id ON note_attachments (patient_id);
+CREATE INDEX ix_note_attachments_doctor_id ON note_attachments (doctor_id);
+CREATE INDEX ix_note_attachments_sha256 ON note_attachments (sha256);
+
+CREATE TABLE attachment_uploads (
+    upload_id VARCHAR(32) PRIMARY KEY,
+    note_id INTEGER NOT NULL,
+    patient_id INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    content_type VARCHAR(127) NOT NULL,
+    size BIGINT NOT NULL,
+    received BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX ix_attachment_uploads_patient_id ON attachment_uploads (patient_id);
+CREATE INDEX ix_attachment_uploads_doctor_id ON attachment_uploads (doctor_id);
+CREATE INDEX ix_attachment_uploads_updated_at ON attachment_uploads (updated_at);
+
+-- Background jobs claimed by job_queue.py workers with FOR UPDATE SKIP LOCKED
+CREATE TABLE jobs (
+    job_id SERIAL PRIMARY KEY,
+    queue VARCHAR(50) NOT NULL,
+    name VARCHAR(100) NOT NULL,
+    payload TEXT NOT NULL,
+    owner VARCHAR(64),
+    status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    lease VARCHAR(32),
+    result TEXT,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX ix_jobs_queue_status_run_at ON jobs (queue, status, run_at);
+CREATE INDEX ix_jobs_owner ON jobs (owner);
+
+CREATE TABLE revoked_tokens (
+    id SERIAL PRIMARY KEY,
+    jti VARCHAR(36) UNIQUE NOT NULL,
+    token_type VARCHAR(10) NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX ix_revoked_tokens_expires_at ON revoked_tokens (expires_at);
+
+CREATE TABLE idempotency_keys (
+    id SERIAL PRIMARY KEY,
+    identity VARCHAR(64) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    status_code INTEGER,
+    response_body TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_idempotency_keys_identity_key UNIQUE (identity, idempotency_key)
+);
+
+CREATE INDEX ix_idempotency_keys_created_at ON idempotency_keys (created_at);
+
+-- Patient typeahead (patient_search.py creates these at startup as well)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_patients_search_name ON patients ((lower(first_name || ' ' || last_name) COLLATE "C"));
+CREATE INDEX ix_patients_search_reversed_name ON patients ((lower(last_name || ' ' || first_name) COLLATE "C"));
+CREATE INDEX ix_patients_search_email ON patients ((lower(email) COLLATE "C"));
+CREATE INDEX ix_patients_search_name_trgm ON patients USING gin (lower(first_name || ' ' || last_name) gin_trgm_ops);
+CREATE INDEX ix_patients_search_email_trgm ON patients USING gin (lower(email) gin_trgm_ops);
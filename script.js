@@ -3,6 +3,7 @@ let currentUser = null;
 let currentUserType = 'patient';
 let currentRegisterUserType = 'patient';
 let authToken = null;
+let refreshToken = null;
 
 // API Base URL
 const API_BASE = '/api';
@@ -15,6 +16,7 @@ document.addEventListener('DOMContentLoaded', function() {
     
     if (token && user) {
         authToken = token;
+        refreshToken = localStorage.getItem('refreshToken');
         currentUser = JSON.parse(user);
         showDashboard();
     }
@@ -49,6 +51,14 @@ function setupEventListeners() {
     // Medical note form
     document.getElementById('medicalNoteForm').addEventListener('submit', handleMedicalNote);
     
+    // Patient typeahead
+    document.getElementById('patientSearch').addEventListener('input', debounce(event => {
+        searchPatients(event.target.value).then(displayPatientsList);
+    }, 200));
+    document.getElementById('notePatientSearch').addEventListener('input', debounce(event => {
+        loadPatients(event.target.value);
+    }, 200));
+    
     // Mobile menu toggle
     const hamburger = document.getElementById('hamburger');
     const navMenu = document.getElementById('nav-menu');
@@ -104,11 +114,11 @@ function formatTime(timeString) {
 async function apiRequest(endpoint, options = {}) {
     const url = `${API_BASE}${endpoint}`;
     const config = {
+        ...options,
         headers: {
             'Content-Type': 'application/json',
             ...options.headers
-        },
-        ...options
+        }
     };
     
     if (authToken) {
@@ -116,7 +126,14 @@ async function apiRequest(endpoint, options = {}) {
     }
     
     try {
-        const response = await fetch(url, config);
+        let response = await fetch(url, config);
+        
+        // Access tokens are short-lived: refresh once and retry
+        if (response.status === 401 && refreshToken && await refreshAuthToken()) {
+            config.headers['Authorization'] = `Bearer ${authToken}`;
+            response = await fetch(url, config);
+        }
+        
         const data = await response.json();
         
         if (!response.ok) {
@@ -130,6 +147,23 @@ async function apiRequest(endpoint, options = {}) {
     }
 }
 
+async function refreshAuthToken() {
+    const response = await fetch(`${API_BASE}/token/refresh`, {
+        method: 'POST',
+        headers: {'Authorization': `Bearer ${refreshToken}`}
+    });
+    if (!response.ok) {
+        return false;
+    }
+    
+    const data = await response.json();
+    authToken = data.access_token;
+    refreshToken = data.refresh_token;
+    localStorage.setItem('authToken', authToken);
+    localStorage.setItem('refreshToken', refreshToken);
+    return true;
+}
+
 // Modal functions
 function showLoginModal(userType = 'patient') {
     setUserType(userType);
@@ -221,10 +255,12 @@ async function handleLogin(event) {
         });
         
         authToken = response.access_token;
+        refreshToken = response.refresh_token;
         currentUser = response.user;
         
         // Store in localStorage
         localStorage.setItem('authToken', authToken);
+        localStorage.setItem('refreshToken', refreshToken);
         localStorage.setItem('currentUser', JSON.stringify(currentUser));
         localStorage.setItem('userType', currentUserType);
         
@@ -280,9 +316,23 @@ async function handleRegister(event) {
 }
 
 function logout() {
+    if (authToken) {
+        // Revoke both tokens server-side; the local session ends regardless
+        fetch(`${API_BASE}/logout`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${authToken}`
+            },
+            body: JSON.stringify({refresh_token: refreshToken})
+        }).catch(() => {});
+    }
+    
     authToken = null;
+    refreshToken = null;
     currentUser = null;
     localStorage.removeItem('authToken');
+    localStorage.removeItem('refreshToken');
     localStorage.removeItem('currentUser');
     localStorage.removeItem('userType');
     
@@ -384,9 +434,8 @@ async function loadDoctorData() {
         const medicalNotes = await apiRequest('/medical-notes');
         displayDoctorMedicalNotes(medicalNotes);
         
-        // Load patients list
-        const patients = await apiRequest('/patients');
-        displayPatientsList(patients);
+        // Patients are found through the search box rather than listed in full
+        displayPatientsList([]);
         
     } catch (error) {
         showNotification('Failed to load doctor data', 'error');
@@ -432,7 +481,8 @@ function displayPatientsList(patients) {
     const container = document.getElementById('patientsList');
     
     if (patients.length === 0) {
-        container.innerHTML = '<p>No patients registered.</p>';
+        const query = document.getElementById('patientSearch').value.trim();
+        container.innerHTML = query ? '<p>No matching patients.</p>' : '<p>Search for a patient by name or email.</p>';
         return;
     }
     
@@ -480,6 +530,7 @@ async function handleBooking(event) {
     try {
         await apiRequest('/appointments', {
             method: 'POST',
+            headers: {'Idempotency-Key': crypto.randomUUID()},
             body: JSON.stringify(bookingData)
         });
         
@@ -498,12 +549,34 @@ async function handleBooking(event) {
 }
 
 // Medical notes functions
-async function loadPatients() {
+function debounce(fn, delay) {
+    let timer = null;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), delay);
+    };
+}
+
+async function searchPatients(query) {
+    query = query.trim();
+    if (!query) {
+        return [];
+    }
+    try {
+        const fields = 'patient_id,first_name,last_name,email,phone,date_of_birth';
+        return await apiRequest(`/patients/search?q=${encodeURIComponent(query)}&fields=${fields}`);
+    } catch (error) {
+        showNotification('Failed to search patients', 'error');
+        return [];
+    }
+}
+
+async function loadPatients(query = '') {
     try {
-        const patients = await apiRequest('/patients');
+        const patients = await searchPatients(query);
         const select = document.getElementById('patientSelect');
         
-        select.innerHTML = '<option value="">Choose a patient...</option>';
+        select.innerHTML = `<option value="">${query.trim() ? 'Choose a patient...' : 'Search for a patient first...'}</option>`;
         patients.forEach(patient => {
             const option = document.createElement('option');
             option.value = patient.patient_id;
@@ -532,6 +605,7 @@ async function handleMedicalNote(event) {
     try {
         await apiRequest('/medical-notes', {
             method: 'POST',
+            headers: {'Idempotency-Key': crypto.randomUUID()},
             body: JSON.stringify(noteData)
         });
         
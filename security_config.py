@@ -1,13 +1,26 @@
-from flask import request, jsonify
+from flask import request, jsonify, current_app, has_app_context
 from functools import wraps
+import bcrypt
 import re
+import secrets
 import time
 from collections import defaultdict
 from datetime import datetime, timedelta
+from src.metrics import record_bcrypt_time
 
 # Rate limiting storage (in production, use Redis or similar)
 rate_limit_storage = defaultdict(list)
 
+# Input sanitization: characters stripped in one str.translate pass, and the length cap
+SANITIZE_TABLE = str.maketrans('', '', '<>"\'')
+MAX_INPUT_LENGTH = 1000
+
+# JSON body limits enforced before the body is parsed
+DEFAULT_MAX_JSON_BODY_BYTES = 1024 * 1024
+DEFAULT_MAX_JSON_DEPTH = 32
+DEFAULT_MAX_JSON_KEYS = 2000
+_JSON_STRUCTURE_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}:]')
+
 # Security headers configuration
 SECURITY_HEADERS = {
     'X-Content-Type-Options': 'nosniff',
@@ -30,10 +43,10 @@ def rate_limit(max_requests=100, window_minutes=15):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Get client IP
-            client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-            if client_ip:
-                client_ip = client_ip.split(',')[0].strip()
+            if not current_app.config.get('RATE_LIMIT_ENABLED', True):
+                return f(*args, **kwargs)
+            # Get client IP; set from X-Forwarded-For by ProxyFix when PROXY_FIX_X_FOR is configured
+            client_ip = request.remote_addr
             
             current_time = time.time()
             window_start = current_time - (window_minutes * 60)
@@ -128,24 +141,125 @@ def validate_password_strength(password):
     
     return errors
 
+# Hash checked when no account matches, so unknown emails cost the same as wrong passwords
+_dummy_password_hash = None
+
+def hash_password(password):
+    """Hash a password with bcrypt"""
+    started = time.perf_counter()
+    rounds = current_app.config.get('BCRYPT_ROUNDS', 12) if has_app_context() else 12
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    record_bcrypt_time('hash', time.perf_counter() - started)
+    return password_hash
+
+def verify_password(password, password_hash):
+    """Check a password against a stored hash in constant time.
+
+    When ``password_hash`` is None (no such account) an equivalent bcrypt
+    check is still performed so response timing does not reveal which
+    emails are registered.
+    """
+    global _dummy_password_hash
+    if password_hash is None:
+        if _dummy_password_hash is None:
+            _dummy_password_hash = hash_password(secrets.token_hex(16))
+        started = time.perf_counter()
+        bcrypt.checkpw(password.encode('utf-8'), _dummy_password_hash.encode('utf-8'))
+        record_bcrypt_time('verify', time.perf_counter() - started)
+        return False
+    started = time.perf_counter()
+    matches = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    record_bcrypt_time('verify', time.perf_counter() - started)
+    return matches
+
+def _sanitize_string(value):
+    """Strip dangerous characters and cap the length, translating only what is kept"""
+    # Substring checks are memchr scans; clean strings are returned without copying
+    dirty = '<' in value or '>' in value or '"' in value or "'" in value
+    if len(value) <= MAX_INPUT_LENGTH:
+        return value.translate(SANITIZE_TABLE) if dirty else value
+    if not dirty:
+        return value[:MAX_INPUT_LENGTH]
+
+    cleaned = value[:MAX_INPUT_LENGTH].translate(SANITIZE_TABLE)
+    consumed = MAX_INPUT_LENGTH
+    while len(cleaned) < MAX_INPUT_LENGTH and consumed < len(value):
+        needed = MAX_INPUT_LENGTH - len(cleaned)
+        cleaned += value[consumed:consumed + needed].translate(SANITIZE_TABLE)
+        consumed += needed
+    return cleaned
+
 def sanitize_input(data):
-    """Sanitize input data"""
-    if isinstance(data, dict):
-        return {key: sanitize_input(value) for key, value in data.items()}
+    """Sanitize input data.
+
+    Unchanged strings, dicts and lists are returned as-is; a container is
+    only copied when one of its values actually changes.
+    """
+    if isinstance(data, str):
+        return _sanitize_string(data)
+    elif isinstance(data, dict):
+        sanitized = None
+        for key, value in data.items():
+            cleaned = sanitize_input(value)
+            if cleaned is not value:
+                if sanitized is None:
+                    sanitized = dict(data)
+                sanitized[key] = cleaned
+        return data if sanitized is None else sanitized
     elif isinstance(data, list):
-        return [sanitize_input(item) for item in data]
-    elif isinstance(data, str):
-        # Remove potentially dangerous characters
-        data = re.sub(r'[<>"\']', '', data)
-        # Limit length
-        return data[:1000]
+        sanitized = None
+        for index, item in enumerate(data):
+            cleaned = sanitize_input(item)
+            if cleaned is not item:
+                if sanitized is None:
+                    sanitized = list(data)
+                sanitized[index] = cleaned
+        return data if sanitized is None else sanitized
     else:
         return data
 
+def check_json_structure(body, max_depth, max_keys):
+    """Reject JSON nested deeper than max_depth or with more than max_keys keys.
+
+    Runs on the raw bytes before parsing. Byte counts of brackets and colons
+    are an upper bound, so most bodies pass without a token scan.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if body.count(b'{') + body.count(b'[') <= max_depth and body.count(b':') <= max_keys:
+        return
+
+    depth = 0
+    keys = 0
+    for match in _JSON_STRUCTURE_TOKENS.finditer(body):
+        token = match.group()
+        if token in (b'{', b'['):
+            depth += 1
+            if depth > max_depth:
+                raise ValueError(f'JSON nesting exceeds {max_depth} levels')
+        elif token in (b'}', b']'):
+            depth -= 1
+        elif token == b':':
+            keys += 1
+            if keys > max_keys:
+                raise ValueError(f'JSON body has more than {max_keys} keys')
+
+def reject_oversized_json_body():
+    """Reject JSON bodies over MAX_JSON_BODY_BYTES before anything reads them"""
+    if not request.is_json:
+        return None
+    limit = current_app.config.get('MAX_JSON_BODY_BYTES', DEFAULT_MAX_JSON_BODY_BYTES)
+    length = request.content_length
+    if length is None and request.headers.get('Transfer-Encoding'):
+        return jsonify({'error': 'Content-Length is required for JSON requests'}), 411
+    if length is not None and length > limit:
+        return jsonify({'error': 'Request body too large'}), 413
+    return None
+
 def log_security_event(event_type, details, user_id=None):
     """Log security events for monitoring"""
     timestamp = datetime.utcnow().isoformat()
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+    client_ip = request.remote_addr
     user_agent = request.headers.get('User-Agent', 'Unknown')
     
     log_entry = {
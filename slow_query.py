@@ -0,0 +1,236 @@
+"""
+Slow-query capture with sampled EXPLAIN plans.
+
+Any statement slower than SLOW_QUERY_THRESHOLD_MS is written to a rotating
+JSON-lines store with its normalized SQL, a fingerprint, the shapes of its
+bind parameters (types only - values may be PHI) and the calling route. A
+sample of slow SELECTs on PostgreSQL also gets an EXPLAIN (ANALYZE, BUFFERS)
+plan. Run this module as a script to get a report grouped by fingerprint:
+
+    python -m src.slow_query report --dir instance/slow_queries
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LOG_FILENAME = 'slow_queries.jsonl'
+
+logger = logging.getLogger(__name__)
+_store = logging.getLogger(__name__ + '.store')
+_store.propagate = False
+
+_settings = {'enabled': False, 'threshold': 0.2, 'explain_sample_rate': 0.0}
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_BIND_PARAMETER = re.compile(r'%\([^)]+\)s|%s|\?|(?<!:):(?!:)\w+|\$\d+')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(statement):
+    """Replace literals and parameters with ? so equivalent queries group together"""
+    sql = _STRING_LITERAL.sub('?', statement)
+    sql = _BIND_PARAMETER.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def fingerprint(normalized_sql):
+    return hashlib.sha1(normalized_sql.encode('utf-8')).hexdigest()[:16]
+
+
+def parameter_shapes(parameters, executemany=False):
+    """Describe bind parameters by type only, never by value"""
+    if executemany and parameters:
+        return {'rows': len(parameters), 'row': parameter_shapes(parameters[0])}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+def _explain(conn, statement, parameters):
+    """Run EXPLAIN (ANALYZE, BUFFERS) inside a savepoint on a separate cursor"""
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return json.loads(plan) if isinstance(plan, str) else plan
+    except Exception as e:
+        logger.warning('EXPLAIN failed for slow query: %s', e)
+        return None
+    finally:
+        cursor.close()
+
+
+def _should_explain(conn, statement, executemany):
+    return (not executemany
+            and conn.dialect.name == 'postgresql'
+            and statement.lstrip()[:6].upper() == 'SELECT'
+            and random.random() < _settings['explain_sample_rate'])
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['slow_query_start'] = perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _settings['enabled']:
+        return
+    elapsed = perf_counter() - conn.info.get('slow_query_start', perf_counter())
+    if elapsed < _settings['threshold']:
+        return
+
+    normalized = normalize_sql(statement)
+    record = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'fingerprint': fingerprint(normalized),
+        'duration_ms': round(elapsed * 1000, 3),
+        'sql': normalized,
+        'parameters': parameter_shapes(parameters, executemany),
+        'route': None,
+        'endpoint': None,
+        'method': None,
+        'plan': None
+    }
+    if has_request_context():
+        record['route'] = request.url_rule.rule if request.url_rule is not None else None
+        record['endpoint'] = request.endpoint
+        record['method'] = request.method
+    if _should_explain(conn, statement, executemany):
+        record['plan'] = _explain(conn, statement, parameters)
+
+    logger.warning('Slow query %s (%.1f ms) on %s', record['fingerprint'], record['duration_ms'], record['route'])
+    _store.info(json.dumps(record, default=str))
+
+
+def init_app(app):
+    """Enable slow-query capture with the app's configuration"""
+    _settings['enabled'] = app.config.get('SLOW_QUERY_ENABLED', True)
+    _settings['threshold'] = app.config.get('SLOW_QUERY_THRESHOLD_MS', 200) / 1000.0
+    _settings['explain_sample_rate'] = app.config.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.0)
+    if not _settings['enabled']:
+        return
+
+    log_dir = app.config.get('SLOW_QUERY_LOG_DIR') or os.path.join(app.instance_path, 'slow_queries')
+    os.makedirs(log_dir, exist_ok=True)
+    for handler in list(_store.handlers):
+        _store.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(
+        os.path.join(log_dir, LOG_FILENAME),
+        maxBytes=app.config.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024),
+        backupCount=app.config.get('SLOW_QUERY_LOG_BACKUPS', 5)
+    )
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _store.addHandler(handler)
+    _store.setLevel(logging.INFO)
+
+
+def _plan_summary(plan):
+    """One-line summary of the node types and relations in an EXPLAIN plan"""
+    if not plan:
+        return ''
+    nodes = []
+
+    def walk(node):
+        label = node.get('Node Type', '?')
+        if node.get('Relation Name'):
+            label += f" on {node['Relation Name']}"
+        if node.get('Index Name'):
+            label += f" using {node['Index Name']}"
+        nodes.append(label)
+        for child in node.get('Plans', []):
+            walk(child)
+
+    root = plan[0] if isinstance(plan, list) else plan
+    walk(root.get('Plan', {}))
+    return ' > '.join(nodes)
+
+
+def build_report(log_dir):
+    """Group captured slow queries by fingerprint"""
+    groups = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, LOG_FILENAME + '*'))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                group = groups.setdefault(record['fingerprint'], {
+                    'fingerprint': record['fingerprint'],
+                    'sql': record['sql'],
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'routes': set(),
+                    'plan': None,
+                    'last_seen': ''
+                })
+                group['count'] += 1
+                group['total_ms'] += record['duration_ms']
+                group['max_ms'] = max(group['max_ms'], record['duration_ms'])
+                if record.get('route'):
+                    group['routes'].add(record['route'])
+                if record['timestamp'] >= group['last_seen']:
+                    group['last_seen'] = record['timestamp']
+                    group['plan'] = record.get('plan') or group['plan']
+    for group in groups.values():
+        group['mean_ms'] = group['total_ms'] / group['count']
+        group['routes'] = sorted(group['routes'])
+    return sorted(groups.values(), key=lambda g: g['total_ms'], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Slow query report grouped by fingerprint')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report = subparsers.add_parser('report')
+    report.add_argument('--dir', default=os.path.join('instance', 'slow_queries'))
+    report.add_argument('--top', type=int, default=20)
+    report.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    groups = build_report(args.dir)[:args.top]
+    if args.json:
+        print(json.dumps(groups, indent=2, default=str))
+        return 0
+    if not groups:
+        print(f'No slow queries recorded in {args.dir}')
+        return 0
+    for group in groups:
+        print(f"{group['fingerprint']}  count={group['count']}  total={group['total_ms']:.1f}ms  "
+              f"mean={group['mean_ms']:.1f}ms  max={group['max_ms']:.1f}ms")
+        print(f"  routes: {', '.join(group['routes']) or '-'}")
+        print(f"  sql:    {group['sql'][:200]}")
+        if group['plan']:
+            print(f"  plan:   {_plan_summary(group['plan'])}")
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+ASGI bridge: GET requests for ``ASYNC_ROUTES`` run as coroutines and answer
+like the sync views, everything else (other methods and paths, and
+``Prefer: respond-async``) falls through to the Flask app, and request
+bodies reach WSGI views as they arrive.
+
+The async engine opens its own connections, which cannot see the test's
+uncommitted transaction, so ``async_reads`` runs the async views'
+statements on the test session instead.
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import date, time
+
+import pytest
+
+from src.models.user import db, Appointment, MedicalNote
+
+
+@pytest.fixture
+def async_reads(monkeypatch):
+    from src import async_db
+
+    class TestSession:
+        async def execute(self, statement):
+            return db.session.execute(statement)
+
+    sessions = []
+
+    @asynccontextmanager
+    async def session(config):
+        sessions.append(config)
+        yield TestSession()
+
+    monkeypatch.setattr(async_db, 'session', session)
+    return sessions
+
+
+def call(method, path, headers=None, chunks=(), query=b'', disconnect=False):
+    """Run one request through the ASGI application; returns ``(status, headers, body)``.
+
+    The body is sent as ``chunks``; with ``disconnect`` the client goes away
+    instead of sending the last message.
+    """
+    from src.asgi import application
+
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    if not disconnect:
+        messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(), 'query_string': query,
+        'headers': [(b'host', b'localhost')] + [(name.lower().encode(), value.encode())
+                                              for name, value in (headers or {}).items()],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80),
+        'client': ('127.0.0.1', 5000), 'root_path': ''
+    }
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+@pytest.fixture
+def people(make_patient, make_doctor, auth_headers):
+    patient, doctor = make_patient(), make_doctor()
+    db.session.add(Appointment(patient_id=patient.patient_id, doctor_id=doctor.doctor_id,
+                               appointment_date=date(2031, 5, 6), appointment_time=time(9, 30), reason='Check-up'))
+    db.session.add(MedicalNote(patient_id=patient.patient_id, doctor_id=doctor.doctor_id,
+                               note_date=date(2024, 5, 6), note_details='Follow-up'))
+    db.session.commit()
+    return {'patient': auth_headers(patient), 'doctor': auth_headers(doctor), 'doctor_id': doctor.doctor_id}
+
+
+def test_async_routes_match_sync_views(client, async_reads, people):
+    for path, query in (('/api/appointments', ''), ('/api/medical-notes', ''), ('/api/doctors', ''),
+                        ('/api/profile', ''), ('/api/appointments', 'fields=appointment_id,doctor_name'),
+                        ('/api/doctors', 'fields=bogus')):
+        for user in ('patient', 'doctor'):
+            status, headers, body = call('GET', path, people[user], query=query.encode())
+            expected = client.get(f'{path}?{query}', headers=people[user])
+            assert (status, json.loads(body)) == (expected.status_code, expected.get_json())
+            assert headers.get('etag') == expected.headers.get('ETag')
+            assert headers['x-content-type-options'] == 'nosniff'
+
+    for user in ('patient', 'doctor'):
+        status, _, body = call('GET', '/api/gdpr/data-export', people[user])
+        expected = client.get('/api/gdpr/data-export', headers=people[user]).get_json()
+        body = json.loads(body)
+        assert status == 200
+        assert body['data'] == expected['data']
+        assert body['data']['appointments']
+
+    # Every read but the two rejected fieldsets went through the async engine
+    assert len(async_reads) == 12
+    status, _, body = call('GET', '/api/appointments')
+    assert status == 401 and 'msg' in json.loads(body)
+
+
+def test_other_requests_fall_through(async_reads, people):
+    status, _, body = call('GET', '/api/gdpr/privacy-policy')
+    assert status == 200 and json.loads(body)['version'] == '1.0'
+
+    status, headers, _ = call('GET', '/api/gdpr/data-export', dict(people['patient'], Prefer='respond-async'))
+    assert status == 202
+    assert headers['location'].startswith('/api/jobs/')
+    assert async_reads == []
+
+
+def test_request_body_is_streamed(async_reads, people):
+    body = json.dumps({'doctor_id': people['doctor_id'], 'appointment_date': '2031-05-07',
+                       'appointment_time': '10:00', 'reason': 'Streamed'}).encode()
+    headers = dict(people['patient'], **{'Content-Type': 'application/json', 'Content-Length': str(len(body))})
+    chunks = [body[:10], body[10:30], body[30:]]
+    status, _, response = call('POST', '/api/appointments', headers, chunks=chunks)
+    assert status == 201
+    assert json.loads(response)['appointment']['reason'] == 'Streamed'
+
+    # The client went away part way through its body
+    status, _, _ = call('POST', '/api/appointments', headers, chunks=chunks[:1], disconnect=True)
+    assert status == 400
+    assert async_reads == []
@@ -0,0 +1,262 @@
+"""
+Medical note attachments: bodies are streamed to content-addressed files
+without holding a database connection, chunked uploads resume from the
+confirmed offset (a cancelled one is not found), and downloads honour
+Range and If-None-Match. Files of deleted attachments are collected by a
+job, never while the same content is being stored again.
+"""
+import hashlib
+import io
+import os
+import time
+import tracemalloc
+from datetime import date, datetime
+
+import pytest
+
+from src.models.user import db, Job, MedicalNote
+from src import attachment_store
+from src.job_queue import Worker
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 40
+
+
+@pytest.fixture(autouse=True)
+def storage(app, tmp_path):
+    attachment_store.configure(root=str(tmp_path))
+    yield tmp_path
+    attachment_store.configure(root=app.config['ATTACHMENT_DIR'])
+
+
+@pytest.fixture
+def people(make_patient, make_doctor, auth_headers):
+    patient, doctor = make_patient(), make_doctor()
+    note = MedicalNote(patient_id=patient.patient_id, doctor_id=doctor.doctor_id,
+                       note_date=date.today(), note_details='Scan attached')
+    db.session.add(note)
+    db.session.commit()
+    return {
+        'patient': auth_headers(patient),
+        'doctor': auth_headers(doctor),
+        'other_doctor': auth_headers(make_doctor()),
+        'note_id': note.note_id
+    }
+
+
+class Zeros(io.RawIOBase):
+    """A request body of ``size`` zero bytes that is never held in memory"""
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        # The test client seeks to the end to measure the body
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = offset if whence == io.SEEK_SET else self.size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self.size - self.position))
+        buffer[:count] = bytes(count)
+        self.position += count
+        return count
+
+
+class Watched(io.BytesIO):
+    """A request body that notes whether the session had a transaction open as it was read"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.in_transaction = []
+
+    def read(self, size=-1):
+        self.in_transaction.append(db.session().in_transaction())
+        return super().read(size)
+
+    def readinto(self, buffer):
+        self.in_transaction.append(db.session().in_transaction())
+        return super().readinto(buffer)
+
+
+def upload(client, people, body=PDF, filename='scan.pdf', content_type='application/pdf'):
+    return client.post(f"/api/medical-notes/{people['note_id']}/attachments?filename={filename}",
+                       headers=dict(people['doctor'], **{'Content-Type': content_type}), data=body)
+
+
+def test_upload_and_range_download(client, people, storage):
+    response = upload(client, people)
+    assert response.status_code == 201
+    attachment = response.get_json()['attachment']
+    assert attachment['sha256'] == hashlib.sha256(PDF).hexdigest()
+    assert attachment['size'] == len(PDF)
+    assert os.path.exists(attachment_store.object_path(attachment['sha256']))
+
+    # The same content is stored once
+    assert upload(client, people, filename='copy.pdf').status_code == 201
+    assert len(os.listdir(storage / 'objects' / attachment['sha256'][:2])) == 1
+
+    url = f"/api/attachments/{attachment['attachment_id']}"
+    response = client.get(url, headers=people['patient'])
+    assert response.status_code == 200
+    assert response.data == PDF
+    assert 'attachment; filename=scan.pdf' in response.headers['Content-Disposition']
+
+    response = client.get(url, headers=dict(people['patient'], Range='bytes=100-199'))
+    assert response.status_code == 206
+    assert response.data == PDF[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(PDF)}'
+
+    etag = response.headers['ETag']
+    assert client.get(url, headers=dict(people['patient'], **{'If-None-Match': etag})).status_code == 304
+    assert client.get(url, headers=people['other_doctor']).status_code == 403
+
+    listed = client.get(f"/api/medical-notes/{people['note_id']}/attachments", headers=people['patient'])
+    assert [item['filename'] for item in listed.get_json()] == ['scan.pdf', 'copy.pdf']
+
+
+def test_multipart_upload(client, people):
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments", headers=people['doctor'],
+                           data={'file': (io.BytesIO(PDF), 'report.pdf', 'application/pdf')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 201
+    attachment = response.get_json()['attachment']
+    assert (attachment['filename'], attachment['sha256']) == ('report.pdf', hashlib.sha256(PDF).hexdigest())
+    assert os.listdir(attachment_store.staging_path('')) == []
+
+
+def test_upload_checks(client, people):
+    assert upload(client, people, content_type='text/html').status_code == 415
+    assert upload(client, people, body=b'').status_code == 400
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments?filename=x.pdf",
+                           headers=dict(people['other_doctor'], **{'Content-Type': 'application/pdf'}), data=PDF)
+    assert response.status_code == 403
+
+
+def test_resumable_upload(client, people):
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments/uploads", headers=people['doctor'],
+                           json={'filename': 'mri.dcm', 'content_type': 'application/dicom', 'size': len(PDF)})
+    assert response.status_code == 201
+    url = f"/api/attachments/uploads/{response.get_json()['upload_id']}"
+
+    def put(start, end):
+        return client.put(url, data=PDF[start:end + 1], headers=dict(
+            people['doctor'], **{'Content-Range': f'bytes {start}-{end}/{len(PDF)}',
+                                 'Content-Type': 'application/octet-stream'}))
+
+    assert put(0, 4095).get_json()['offset'] == 4096
+    response = put(0, 4095)
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 4096
+    assert client.get(url, headers=people['doctor']).get_json()['offset'] == 4096
+    assert client.get(url, headers=people['other_doctor']).status_code == 404
+
+    # As if the next chunk reached another worker: the staged bytes are rehashed
+    attachment_store._hashes.clear()
+    response = put(4096, len(PDF) - 1)
+    assert response.status_code == 201
+    attachment = response.get_json()['attachment']
+    assert attachment['sha256'] == hashlib.sha256(PDF).hexdigest()
+    assert client.get(url, headers=people['doctor']).status_code == 404
+    assert client.get(f"/api/attachments/{attachment['attachment_id']}", headers=people['doctor']).data == PDF
+
+
+def test_upload_cancelled_before_it_completes(client, people, monkeypatch):
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments/uploads", headers=people['doctor'],
+                           json={'filename': 'scan.pdf', 'content_type': 'application/pdf', 'size': len(PDF)})
+    upload_id = response.get_json()['upload_id']
+    finish_upload = attachment_store.finish_upload
+
+    def cancelled_first(upload_id, size):
+        # A cancellation or expiry lands between the last chunk and completion
+        attachment_store.discard_upload(upload_id)
+        return finish_upload(upload_id, size)
+
+    monkeypatch.setattr(attachment_store, 'finish_upload', cancelled_first)
+    response = client.put(f'/api/attachments/uploads/{upload_id}', data=PDF, headers=dict(
+        people['doctor'], **{'Content-Range': f'bytes 0-{len(PDF) - 1}/{len(PDF)}',
+                             'Content-Type': 'application/octet-stream'}))
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'Upload not found'}
+    assert client.get(f"/api/medical-notes/{people['note_id']}/attachments",
+                      headers=people['doctor']).get_json() == []
+
+
+def test_upload_memory_stays_flat(client, people):
+    size = 64 * 1024 * 1024
+    tracemalloc.start()
+    try:
+        response = client.post(
+            f"/api/medical-notes/{people['note_id']}/attachments?filename=big.pdf",
+            headers=dict(people['doctor'], **{'Content-Type': 'application/pdf'}),
+            input_stream=Zeros(size))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert response.status_code == 201
+    assert response.get_json()['attachment']['size'] == size
+    assert peak < 16 * 1024 * 1024
+
+
+def test_bodies_are_read_outside_a_transaction(client, people):
+    body = Watched(PDF)
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments?filename=scan.pdf",
+                           headers=dict(people['doctor'], **{'Content-Type': 'application/pdf'}),
+                           input_stream=body)
+    assert response.status_code == 201
+    assert body.in_transaction and not any(body.in_transaction)
+
+    response = client.post(f"/api/medical-notes/{people['note_id']}/attachments/uploads", headers=people['doctor'],
+                           json={'filename': 'scan.pdf', 'content_type': 'application/pdf', 'size': len(PDF)})
+    chunk = Watched(PDF)
+    response = client.put(f"/api/attachments/uploads/{response.get_json()['upload_id']}", input_stream=chunk,
+                          headers=dict(people['doctor'], **{'Content-Range': f'bytes 0-{len(PDF) - 1}/{len(PDF)}',
+                                                            'Content-Type': 'application/octet-stream',
+                                                            'Content-Length': str(len(PDF))}))
+    assert response.status_code == 201
+    assert chunk.in_transaction and not any(chunk.in_transaction)
+
+
+def collect_released(storage, age_seconds):
+    """Run the queued collections as if ``age_seconds`` had passed since each file was stored"""
+    for path in (storage / 'objects').rglob('*'):
+        if path.is_file():
+            os.utime(path, (time.time() - age_seconds,) * 2)
+    db.session.execute(db.update(Job).where(Job.name == 'attachments.collect', Job.status == 'queued')
+                       .values(run_at=datetime.utcnow()))
+    db.session.commit()
+    return Worker(['attachments']).run_once()
+
+
+def test_deleted_files_are_collected(client, people, storage):
+    attachment = upload(client, people).get_json()['attachment']
+    path = attachment_store.object_path(attachment['sha256'])
+    url = f"/api/attachments/{attachment['attachment_id']}"
+    assert client.delete(url, headers=people['doctor']).status_code == 200
+    assert os.path.exists(path)
+
+    # The same content was stored again; until its row is committed it is only recent
+    attachment_store.save(io.BytesIO(PDF))
+    assert collect_released(storage, 0)['succeeded'] == 1
+    assert os.path.exists(path)
+
+    # Referenced again by the time the grace period is over
+    assert upload(client, people).status_code == 201
+    collect_released(storage, 3600)
+    assert os.path.exists(path)
+
+    # Released and unreferenced for longer than the grace period
+    [attachment] = client.get(f"/api/medical-notes/{people['note_id']}/attachments",
+                              headers=people['doctor']).get_json()
+    url = f"/api/attachments/{attachment['attachment_id']}"
+    assert client.delete(url, headers=people['doctor']).status_code == 200
+    collect_released(storage, 3600)
+    assert not os.path.exists(path)
@@ -0,0 +1,152 @@
+"""
+iCalendar feeds served from the per-worker cache.
+
+Polls of a cached feed only look up the URL's secret, and bookings,
+updates and cancellations patch the cached feed into the same body a
+rebuild would produce. Erasing an account drops its appointments from the
+other parties' cached feeds. Rotating the secret in a feed URL or erasing
+the account retires the old URL in every worker on its next poll.
+
+"""
+from urllib.parse import urlsplit
+
+import pytest
+from sqlalchemy import event
+
+from src.models.user import db
+from src.calendar_feeds import FeedCache, feeds, parse_token
+from src.token_revocation import revoked_tokens
+
+
+@pytest.fixture(autouse=True)
+def revocation_sync(app):
+    # The revocation list syncs at most once a second; keep that out of the counts
+    revoked_tokens.configure(sync_seconds=float('inf'))
+    yield
+    revoked_tokens.configure(sync_seconds=app.config['TOKEN_REVOCATION_SYNC_SECONDS'])
+
+
+@pytest.fixture
+def client(app):
+    feeds.clear()
+    return app.test_client()
+
+
+@pytest.fixture
+def accounts(make_patient, make_doctor, auth_headers):
+    patient = make_patient(first_name='Feed')
+    doctor = make_doctor(first_name='Feed')
+    return {
+        'doctor_id': doctor.doctor_id,
+        'patient': auth_headers(patient),
+        'doctor': auth_headers(doctor)
+    }
+
+
+def feed_path(client, headers):
+    return urlsplit(client.get('/api/calendar/feed', headers=headers).get_json()['url']).path
+
+
+def book(client, accounts, time):
+    response = client.post('/api/appointments', headers=accounts['patient'], json={
+        'doctor_id': accounts['doctor_id'], 'appointment_date': '2031-06-02', 'appointment_time': time
+    })
+    assert response.status_code == 201
+    return response.get_json()['appointment']['appointment_id']
+
+
+def test_cached_poll_only_checks_the_secret(app, client, accounts):
+    path = feed_path(client, accounts['patient'])
+    book(client, accounts, '09:00')
+    first = client.get(path)
+    assert first.status_code == 200
+    assert first.mimetype == 'text/calendar'
+
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        unchanged = client.get(path, headers={'If-None-Match': first.headers['ETag']})
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert unchanged.status_code == 304
+    assert len(statements) == 1
+    assert 'appointments' not in statements[0]
+
+
+def test_writes_patch_cached_feeds(client, accounts):
+    patient_path = feed_path(client, accounts['patient'])
+    doctor_path = feed_path(client, accounts['doctor'])
+    client.get(patient_path)
+    client.get(doctor_path)
+
+    first = book(client, accounts, '09:00')
+    second = book(client, accounts, '10:00')
+    assert client.put(f'/api/appointments/{first}', headers=accounts['doctor'],
+                      json={'appointment_time': '11:30'}).status_code == 200
+    assert client.delete(f'/api/appointments/{second}', headers=accounts['patient']).status_code == 200
+
+    patched = client.get(patient_path).get_data(as_text=True)
+    assert patched.count('BEGIN:VEVENT') == 1
+    assert 'DTSTART:20310602T113000' in patched
+    assert client.get(doctor_path).get_data(as_text=True).count('BEGIN:VEVENT') == 1
+
+    feeds.clear()
+    assert client.get(patient_path).get_data(as_text=True) == patched
+
+
+def test_invalid_token_is_not_found(client, accounts):
+    path = feed_path(client, accounts['patient'])
+    assert client.get(path.replace('.ics', 'x.ics')).status_code == 404
+    assert client.get('/api/calendar/p1-forged.ics').status_code == 404
+
+
+def test_erasure_removes_cached_events(client, accounts):
+    doctor_path = feed_path(client, accounts['doctor'])
+    book(client, accounts, '09:00')
+    assert 'Feed' in client.get(doctor_path).get_data(as_text=True)
+
+    assert client.delete('/api/gdpr/data-deletion', headers=accounts['patient']).status_code == 200
+    assert 'BEGIN:VEVENT' not in client.get(doctor_path).get_data(as_text=True)
+
+
+def test_rotated_url_replaces_the_old_one(client, context, accounts):
+    path = feed_path(client, accounts['patient'])
+    # The URL is stored with the account, not derived from this worker's key
+    assert feed_path(client, accounts['patient']) == path
+    assert client.get(path).status_code == 200
+
+    other_worker = FeedCache()
+    other_worker.configure(sync_seconds=float('inf'))
+    old = parse_token(path.rsplit('/', 1)[1][:-len('.ics')])
+    assert other_worker.render(*old) is not None
+
+    response = client.post('/api/calendar/feed/rotate', headers=accounts['patient'])
+    assert response.status_code == 200
+    rotated = urlsplit(response.get_json()['url']).path
+    assert rotated != path
+    assert feed_path(client, accounts['patient']) == rotated
+    assert client.get(path).status_code == 404
+    assert client.get(rotated).status_code == 200
+
+    # Another worker refuses the old URL although its cached feed is not due for a check
+    new = parse_token(rotated.rsplit('/', 1)[1][:-len('.ics')])
+    assert other_worker.render(*old) is None
+    assert other_worker.render(*new) is not None
+
+
+def test_erased_account_feed_is_gone_in_every_worker(client, context, accounts):
+    path = feed_path(client, accounts['patient'])
+    book(client, accounts, '09:00')
+    other_worker = FeedCache()
+    other_worker.configure(sync_seconds=float('inf'))
+    token = parse_token(path.rsplit('/', 1)[1][:-len('.ics')])
+    assert 'BEGIN:VEVENT' in other_worker.render(*token)[0]
+
+    assert client.delete('/api/gdpr/data-deletion', headers=accounts['patient']).status_code == 200
+    assert other_worker.render(*token) is None
@@ -0,0 +1,142 @@
+"""
+Doctor rollups: writes queue their days through triggers, refresh recounts
+only those days, and the analytics endpoints read the rollup alone.
+"""
+import re
+from datetime import date, time, timedelta
+
+import pytest
+from sqlalchemy import delete, event, select, update
+
+from src.models.user import db, Appointment, DoctorDailyStats, DoctorStatsChange, MedicalNote
+from src import doctor_stats
+
+TODAY = date.today()
+YESTERDAY = TODAY - timedelta(days=1)
+TOMORROW = TODAY + timedelta(days=1)
+
+
+@pytest.fixture
+def people(make_patient, make_doctor):
+    patients = [make_patient() for _ in range(3)]
+    doctor = make_doctor()
+    doctor_stats.refresh()
+    return [patient.patient_id for patient in patients], doctor.doctor_id
+
+
+def book(patient_id, doctor_id, day, hour):
+    appointment = Appointment(patient_id=patient_id, doctor_id=doctor_id, appointment_date=day,
+                              appointment_time=time(hour))
+    db.session.add(appointment)
+    db.session.commit()
+    return appointment.appointment_id
+
+
+def note(patient_id, doctor_id, day):
+    db.session.add(MedicalNote(patient_id=patient_id, doctor_id=doctor_id, note_date=day, note_details='Seen'))
+    db.session.commit()
+
+
+def stats(doctor_id):
+    return {row.day: (row.appointments, row.attended, row.notes) for row in db.session.execute(
+        select(DoctorDailyStats).where(DoctorDailyStats.doctor_id == doctor_id)
+    ).scalars()}
+
+
+def test_refresh_counts_changed_days(people):
+    (first, second, third), doctor_id = people
+    book(first, doctor_id, YESTERDAY, 9)
+    book(second, doctor_id, YESTERDAY, 10)
+    book(third, doctor_id, TOMORROW, 9)
+    note(first, doctor_id, YESTERDAY)
+    note(third, doctor_id, YESTERDAY)
+
+    assert doctor_stats.refresh() == 2
+    assert stats(doctor_id) == {YESTERDAY: (2, 1, 2), TOMORROW: (1, 0, 0)}
+    assert db.session.execute(select(DoctorStatsChange)).first() is None
+    assert doctor_stats.refresh() == 0
+
+
+def test_updates_and_deletes_recount_both_days(people):
+    (first, second, _), doctor_id = people
+    moved = book(first, doctor_id, YESTERDAY, 9)
+    book(second, doctor_id, YESTERDAY, 10)
+    doctor_stats.refresh()
+
+    db.session.execute(update(Appointment).where(Appointment.appointment_id == moved)
+                       .values(appointment_date=TOMORROW))
+    db.session.commit()
+    doctor_stats.refresh()
+    assert stats(doctor_id) == {YESTERDAY: (1, 0, 0), TOMORROW: (1, 0, 0)}
+
+    db.session.execute(delete(Appointment).where(Appointment.appointment_id == moved))
+    db.session.commit()
+    doctor_stats.refresh()
+    assert stats(doctor_id) == {YESTERDAY: (1, 0, 0)}
+
+
+def test_rebuild_matches_refresh(people):
+    (first, second, _), doctor_id = people
+    book(first, doctor_id, YESTERDAY, 9)
+    book(second, doctor_id, TODAY, 9)
+    note(first, doctor_id, YESTERDAY)
+    doctor_stats.refresh()
+    refreshed = stats(doctor_id)
+
+    db.session.execute(delete(DoctorDailyStats).where(DoctorDailyStats.doctor_id == doctor_id))
+    db.session.commit()
+    doctor_stats.rebuild(YESTERDAY, TODAY)
+    assert stats(doctor_id) == refreshed
+
+
+def test_frozen_days_are_not_recounted(people):
+    (first, _, _), doctor_id = people
+    old_day = date(2001, 3, 12)
+    book(first, doctor_id, old_day, 9)
+    doctor_stats.refresh(frozen_before=date(2001, 4, 1))
+    assert stats(doctor_id) == {}
+
+
+def test_endpoint_reads_only_the_rollup(client, people, auth_headers):
+    (first, second, _), doctor_id = people
+    book(first, doctor_id, YESTERDAY, 9)
+    book(second, doctor_id, YESTERDAY, 10)
+    book(first, doctor_id, TOMORROW, 9)
+    note(first, doctor_id, YESTERDAY)
+    doctor_stats.refresh()
+    headers = auth_headers({'id': doctor_id, 'type': 'doctor'})
+    url = f'/api/analytics/doctors/{doctor_id}?from={YESTERDAY}&to={TOMORROW}'
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url, headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['totals'] == {'appointments': 3, 'past_appointments': 2, 'no_shows': 1, 'no_show_rate': 0.5,
+                              'notes': 1}
+    assert [day['no_shows'] for day in body['days']] == [1, None]
+    assert not [statement for statement in statements
+                if re.search(r'\b(FROM|JOIN) (appointments|medical_notes)\b', statement)]
+
+    summary = client.get(f'/api/analytics/doctors?from={YESTERDAY}&to={TOMORROW}', headers=headers).get_json()
+    assert {'doctor_id': doctor_id, 'appointments': 3, 'past_appointments': 2, 'no_shows': 1,
+            'no_show_rate': 0.5, 'notes': 1, 'active_days': 2} in summary['doctors']
+
+
+def test_endpoint_rejects_patients_and_bad_ranges(client, people, auth_headers):
+    (first, _, _), doctor_id = people
+    patient = auth_headers({'id': first, 'type': 'patient'})
+    doctor = auth_headers({'id': doctor_id, 'type': 'doctor'})
+    assert client.get(f'/api/analytics/doctors/{doctor_id}', headers=patient).status_code == 403
+    assert client.get(f'/api/analytics/doctors/{doctor_id}?from={TODAY}&to={YESTERDAY}',
+                      headers=doctor).status_code == 400
+    assert client.get(f'/api/analytics/doctors/{doctor_id}?from=2020-01-01&to=2025-01-01',
+                      headers=doctor).status_code == 400
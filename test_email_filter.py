@@ -0,0 +1,113 @@
+"""
+Registered email filter: no false negatives, a false positive rate close to
+the configured one, accounts registered by this worker are not counted twice
+when the next sync reads them back, accounts committed after a higher id
+are still synced, and lookups are exported in /metrics.
+"""
+import uuid
+
+import pytest
+
+from src.models.user import db, Patient
+from src.email_filter import CountingBloomFilter, RegisteredEmailFilter
+
+
+@pytest.fixture
+def email_filter(context):
+    email_filter = RegisteredEmailFilter(Patient, 'patient_id')
+    email_filter.configure(enabled=True, sync_seconds=0)
+    email_filter.rebuild()
+    return email_filter
+
+
+def test_counting_filter():
+    bloom = CountingBloomFilter(1000)
+    emails = [f'user-{n}@example.com' for n in range(1000)]
+    for email in emails:
+        bloom.add(email)
+    assert all(email in bloom for email in emails)
+
+    probes = [f'{uuid.uuid4().hex}@example.com' for _ in range(10000)]
+    assert sum(email in bloom for email in probes) / len(probes) < 0.03
+
+    for email in emails:
+        bloom.discard(email)
+    assert bloom.count == 0
+    assert not any(email in bloom for email in emails)
+
+
+def test_measured_false_positive_rate(email_filter):
+    assert email_filter.measure_false_positive_rate(samples=5000) < 0.03
+
+
+def test_registration_is_not_added_twice(email_filter, make_patient):
+    patient = make_patient()
+    # The registration adds the account; the next sync reads the same row
+    email_filter.add(patient.email, patient.patient_id)
+    email_filter.add(patient.email, patient.patient_id)
+    email_filter.sync()
+    assert email_filter._filter.count == 1
+    assert email_filter.might_exist(patient.email)
+
+    email = patient.email
+    db.session.delete(patient)
+    db.session.commit()
+    email_filter.discard(email, patient.patient_id)
+    assert email_filter._filter.count == 0
+    assert not email_filter.might_exist(email)
+
+
+def test_sync_adds_accounts_from_other_workers(email_filter, make_patient):
+    patient = make_patient()
+    assert patient.email not in email_filter._filter
+    email_filter.sync()
+    assert email_filter.might_exist(patient.email)
+    assert email_filter._filter.count == 1
+
+
+def test_metrics_export(client, email_filter):
+    email_filter.might_exist(f'{uuid.uuid4().hex}@example.com')
+    body = client.get('/metrics', headers={'Authorization': 'Bearer test-metrics-token'}).get_data(as_text=True)
+    assert '# TYPE email_filter_lookups_total counter' in body
+    assert 'email_filter_negatives_total{table="patients"}' in body
+    assert 'email_filter_false_positive_rate{table="patients",estimate="measured"}' in body
+
+
+def test_reused_id_is_added(email_filter, make_patient):
+    patient = make_patient()
+    patient_id, email = patient.patient_id, patient.email
+    email_filter.sync()
+    db.session.delete(patient)
+    db.session.commit()
+    email_filter.discard(email, patient_id)
+
+    # SQLite hands the id of a deleted newest row to the next registration
+    reused = make_patient(patient_id=patient_id)
+    email_filter.add(reused.email, patient_id)
+    assert email_filter.might_exist(reused.email)
+    assert email_filter._filter.count == 1
+
+
+def test_late_commit_below_the_watermark_is_found(context, make_patient):
+    first = make_patient()
+    other_worker = RegisteredEmailFilter(Patient, 'patient_id')
+    other_worker.configure(enabled=True, sync_seconds=0)
+    other_worker.rebuild()
+
+    # Ids first + 1 and first + 2 were handed out; the higher one commits first
+    newer = make_patient(patient_id=first.patient_id + 2)
+    assert other_worker.might_exist(newer.email)
+    late = make_patient(patient_id=first.patient_id + 1)
+    assert other_worker.might_exist(late.email)
+
+    # The reread window does not add accounts twice
+    other_worker.sync()
+    assert other_worker._filter.count == 3
+
+
+def test_rebuild_does_not_probe(email_filter, monkeypatch):
+    probes = []
+    monkeypatch.setattr(email_filter, 'measure_false_positive_rate', lambda: probes.append(True))
+    # Overflowing rebuilds run inside a login or registration
+    email_filter.rebuild()
+    assert probes == []
@@ -0,0 +1,59 @@
+"""
+Idempotency-Key on registration: without a token the key is scoped to the
+client address and the request, so a retry replays the first response but
+another client using the same key never sees it. Expired keys are purged
+while the app runs.
+"""
+import uuid
+
+PASSWORD = 'Idem!potent1'
+
+
+def registration():
+    return {'first_name': 'Idem', 'last_name': 'Patient', 'password': PASSWORD,
+            'email': f'idem-{uuid.uuid4().hex[:12]}@example.com'}
+
+
+def test_retry_is_replayed(client):
+    body = registration()
+    headers = {'Idempotency-Key': 'signup-1'}
+    first = client.post('/api/register/patient', json=body, headers=headers)
+    assert first.status_code == 201
+    retry = client.post('/api/register/patient', json=body, headers=headers)
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+
+
+def test_key_is_not_shared_between_clients(client):
+    headers = {'Idempotency-Key': 'signup-1'}
+    assert client.post('/api/register/patient', json=registration(), headers=headers).status_code == 201
+
+    # Another client's registration with the same key runs as usual
+    response = client.post('/api/register/patient', json=registration(), headers=headers,
+                           environ_base={'REMOTE_ADDR': '192.0.2.10'})
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+
+    # So does another body from the same address
+    response = client.post('/api/register/patient', json=registration(), headers=headers)
+    assert response.status_code == 201
+
+
+def test_expired_keys_are_purged(app, client, context):
+    from datetime import datetime, timedelta
+    from src.models.user import db, IdempotencyKey
+    from src.idempotency import idempotency_store
+
+    expired = IdempotencyKey(identity='patient:1', idempotency_key='old', request_hash='x', status_code=201,
+                             response_body='{}', created_at=datetime.utcnow() - timedelta(days=2))
+    db.session.add(expired)
+    db.session.commit()
+
+    idempotency_store.configure(purge_seconds=0)
+    try:
+        headers = {'Idempotency-Key': 'signup-purge'}
+        assert client.post('/api/register/patient', json=registration(), headers=headers).status_code == 201
+    finally:
+        idempotency_store.configure(ttl_seconds=app.config['IDEMPOTENCY_TTL_SECONDS'],
+                                    purge_seconds=app.config['IDEMPOTENCY_PURGE_SECONDS'])
+    assert IdempotencyKey.query.filter_by(idempotency_key='old').first() is None
@@ -0,0 +1,134 @@
+"""
+Background jobs: GDPR requests sent with ``Prefer: respond-async`` are run
+by a worker, failed jobs are retried with backoff, expired leases are
+claimed again, and capped queues stop claiming at their limit.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.models.user import db, Job, Patient
+from src.job_queue import Fail, Worker, claim, enqueue, task
+
+calls = []
+
+
+@task('test.flaky', queue='test', max_attempts=3)
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError('transient')
+    return {'calls': len(calls)}
+
+
+@task('test.refused', queue='test')
+def refused():
+    raise Fail('Nothing to do')
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    calls.clear()
+
+
+@pytest.fixture
+def patient(make_patient, auth_headers):
+    patient = make_patient()
+    return patient.patient_id, auth_headers(patient)
+
+
+def test_async_export_and_erasure(client, patient, auth_headers):
+    patient_id, headers = patient
+    prefer = dict(headers, Prefer='respond-async')
+
+    response = client.get('/api/gdpr/data-export', headers=prefer)
+    assert response.status_code == 202
+    assert response.headers['Preference-Applied'] == 'respond-async'
+    url = response.headers['Location']
+    assert client.get(url, headers=headers).get_json()['status'] == 'queued'
+    # Asking again while it is queued returns the same job
+    assert client.get('/api/gdpr/data-export', headers=prefer).headers['Location'] == url
+
+    other = auth_headers({'id': patient_id + 1000, 'type': 'patient'})
+    assert client.get(url, headers=other).status_code == 404
+
+    assert Worker(['gdpr']).run_once()['succeeded'] == 1
+    job = client.get(url, headers=headers).get_json()
+    assert (job['status'], job['attempts']) == ('succeeded', 1)
+    assert job['result']['data_subject'] == 'patient'
+    assert job['result']['data']['patient_id'] == patient_id
+    # The synchronous export is unchanged
+    assert client.get('/api/gdpr/data-export', headers=headers).get_json()['data'] == job['result']['data']
+
+    response = client.delete('/api/gdpr/data-deletion', headers=prefer)
+    assert response.status_code == 202
+    assert db.session.get(Patient, patient_id) is not None
+    assert Worker(['gdpr']).run_once()['succeeded'] == 1
+    assert db.session.get(Patient, patient_id) is None
+
+    # The finished export held personal data and went with the account
+    assert client.get(url, headers=headers).status_code == 404
+    erasure = client.get(response.headers['Location'], headers=headers).get_json()
+    assert erasure['status'] == 'succeeded'
+    assert [job['name'] for job in client.get('/api/jobs', headers=headers).get_json()] == ['gdpr.erase']
+
+
+def test_retries_with_backoff(context):
+    job = enqueue('test.flaky', {'fail_times': 2})
+    db.session.commit()
+    worker = Worker(['test'], retry_base_seconds=30)
+
+    assert worker.run_once() == {'succeeded': 0, 'retried': 1, 'failed': 0, 'lost': 0}
+    db.session.refresh(job)
+    assert (job.status, job.attempts, job.error) == ('queued', 1, 'RuntimeError')
+    assert timedelta(seconds=25) < job.run_at - datetime.utcnow() <= timedelta(seconds=30)
+    # Not due until the backoff has passed
+    assert worker.run_next() is None
+
+    for expected in ('retried', 'succeeded'):
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        assert worker.run_next() == expected
+    db.session.refresh(job)
+    assert (job.status, job.attempts, job.result) == ('succeeded', 3, '{"calls":3}')
+
+    refused = enqueue('test.refused')
+    db.session.commit()
+    assert worker.run_next() == 'failed'
+    db.session.refresh(refused)
+    assert (refused.status, refused.attempts, refused.error) == ('failed', 1, 'Nothing to do')
+
+
+def test_expired_lease_is_claimed_again(context):
+    job = enqueue('test.flaky', {'fail_times': 0})
+    db.session.commit()
+
+    [first] = claim('test', lease_seconds=60)
+    assert claim('test', lease_seconds=60) == []
+
+    # The first worker died; once its lease runs out another takes the job
+    job.run_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    worker = Worker(['test'])
+    assert worker.run_next() == 'succeeded'
+    db.session.refresh(job)
+    assert (job.status, job.attempts) == ('succeeded', 2)
+
+    # The first worker's outcome no longer counts
+    assert worker.run(first) == 'lost'
+    assert calls == [0, 0]
+
+
+def test_queue_concurrency_limit(context):
+    jobs = [enqueue('test.flaky', {'fail_times': 0}) for _ in range(3)]
+    db.session.commit()
+
+    assert len(claim('test', 60, limit=5, concurrency=2)) == 2
+    assert claim('test', 60, concurrency=2) == []
+    # A running job whose lease ran out no longer takes a slot
+    db.session.execute(db.update(Job).where(Job.job_id == jobs[0].job_id)
+                       .values(run_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+    [reclaimed] = claim('test', 60, limit=5, concurrency=2)
+    assert reclaimed.job_id == jobs[0].job_id
+    assert claim('test', 60, concurrency=2) == []
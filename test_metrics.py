@@ -0,0 +1,34 @@
+"""
+/metrics: scrapes need the bearer token, and snapshots left behind by
+workers that have exited are removed.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from src import metrics
+
+
+def test_scrape_needs_token(client):
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    # The client address is no longer trusted
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 404
+
+    client.get('/api/appointments')
+    response = client.get('/metrics', headers={'Authorization': 'Bearer test-metrics-token'})
+    assert response.status_code == 200
+    assert '# TYPE http_request_duration_seconds histogram' in response.get_data(as_text=True)
+
+
+def test_dead_worker_snapshots_are_removed(tmp_path):
+    exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                            capture_output=True, text=True, check=True)
+    dead = tmp_path / f'metrics_{exited.stdout.strip()}.json'
+    alive = tmp_path / f'metrics_{os.getpid()}.json'
+    for path in (dead, alive):
+        path.write_text(json.dumps({'histograms': [], 'counters': [], 'gauges': []}))
+
+    assert metrics.remove_dead_snapshots(str(tmp_path)) == 1
+    assert not dead.exists() and alive.exists()
@@ -0,0 +1,164 @@
+"""
+Medical note history: updates and deletes keep the replaced version as a
+snapshot every NOTE_REVISION_SNAPSHOT_INTERVAL versions and a reverse delta
+otherwise, and any version can be rebuilt from one snapshot and a few deltas.
+An update without If-Match that loses a race with another update reads the
+note again instead of failing, and asks the client to retry later if it
+keeps losing.
+"""
+import random
+
+import pytest
+from sqlalchemy import select, update
+
+from src.models.user import db, MedicalNoteRevision
+from src import note_revisions
+
+WORDS = 'patient reports mild headache fever cough rest fluids review in two weeks'.split()
+
+
+@pytest.fixture
+def people(make_patient, make_doctor, auth_headers):
+    patient = make_patient()
+    return {
+        'patient': auth_headers(patient),
+        'doctor': auth_headers(make_doctor()),
+        'other_doctor': auth_headers(make_doctor()),
+        'patient_id': patient.patient_id
+    }
+
+
+def edit(rng, text):
+    words = text.split(' ')
+    position = rng.randrange(len(words) + 1)
+    if rng.random() < 0.3 and len(words) > 1:
+        del words[min(position, len(words) - 1)]
+    else:
+        words.insert(position, rng.choice(WORDS))
+    return ' '.join(words)
+
+
+def test_diff_and_patch_round_trip():
+    rng = random.Random(48)
+    base = {'note_date': '2031-01-02', 'note_details': 'Seen  for\nfollow-up', 'medication': None, 'treatment': ''}
+    for _ in range(200):
+        target = dict(base, note_details=edit(rng, base['note_details']),
+                      medication=rng.choice([None, '', 'Ibuprofen 200mg', base['medication']]))
+        assert note_revisions.patch(target, note_revisions.diff(target, base)) == base
+        base = target
+
+
+def test_every_version_is_recoverable(app, client, people):
+    app.config['NOTE_REVISION_SNAPSHOT_INTERVAL'] = 4
+    try:
+        response = client.post('/api/medical-notes', headers=people['doctor'], json={
+            'patient_id': people['patient_id'], 'note_date': '2031-03-04', 'note_details': 'Initial consultation'
+        })
+        note_id = response.get_json()['note']['note_id']
+        url = f'/api/medical-notes/{note_id}'
+
+        rng = random.Random(7)
+        versions = {1: 'Initial consultation'}
+        for version in range(2, 12):
+            details = edit(rng, versions[version - 1])
+            response = client.put(url, headers=people['doctor'], json={'note_details': details})
+            assert response.status_code == 200
+            versions[version] = details
+    finally:
+        app.config['NOTE_REVISION_SNAPSHOT_INTERVAL'] = note_revisions.DEFAULT_SNAPSHOT_INTERVAL
+
+    kinds = dict(db.session.execute(select(MedicalNoteRevision.version, MedicalNoteRevision.kind)
+                                    .where(MedicalNoteRevision.note_id == note_id)).all())
+    assert kinds == {version: 'snapshot' if version % 4 == 0 else 'delta' for version in range(1, 11)}
+
+    history = client.get(f'{url}/revisions', headers=people['patient']).get_json()
+    assert not history['deleted']
+    assert [(entry['version'], entry['note_details']) for entry in history['revisions']] == \
+        sorted(versions.items(), reverse=True)
+    assert history['revisions'][0]['replaced_at'] is None
+
+    for version, details in versions.items():
+        body = client.get(f'{url}/revisions?version={version}', headers=people['doctor']).get_json()
+        assert [entry['note_details'] for entry in body['revisions']] == [details]
+    assert client.get(f'{url}/revisions?version=12', headers=people['doctor']).status_code == 404
+
+
+def test_history_survives_delete(client, people):
+    response = client.post('/api/medical-notes', headers=people['doctor'], json={
+        'patient_id': people['patient_id'], 'note_date': '2031-03-04', 'medication': 'Aspirin'
+    })
+    note_id = response.get_json()['note']['note_id']
+    url = f'/api/medical-notes/{note_id}'
+    client.put(url, headers=people['doctor'], json={'medication': 'Paracetamol', 'note_date': '2031-03-05'})
+    assert client.delete(url, headers=people['doctor']).status_code == 200
+
+    history = client.get(f'{url}/revisions', headers=people['doctor']).get_json()
+    assert history['deleted']
+    assert [(entry['version'], entry['note_date'], entry['medication']) for entry in history['revisions']] == \
+        [(2, '2031-03-05', 'Paracetamol'), (1, '2031-03-04', 'Aspirin')]
+
+    assert client.get(f'{url}/revisions', headers=people['other_doctor']).status_code == 403
+    assert client.get('/api/medical-notes/999999/revisions', headers=people['doctor']).status_code == 404
+
+    export = client.get('/api/gdpr/data-export', headers=people['patient']).get_json()
+    assert [entry['version'] for entry in export['data']['medical_note_revisions']
+            if entry['note_id'] == note_id] == [2, 1]
+
+    assert client.delete('/api/gdpr/data-deletion', headers=people['patient']).status_code == 200
+    assert db.session.execute(select(MedicalNoteRevision).where(MedicalNoteRevision.note_id == note_id)).first() \
+        is None
+
+
+def test_unconditional_update_after_a_concurrent_one(client, people, monkeypatch):
+    from src.routes import medical_notes
+    response = client.post('/api/medical-notes', headers=people['doctor'], json={
+        'patient_id': people['patient_id'], 'note_date': '2031-03-04', 'note_details': 'Initial consultation'
+    })
+    url = f"/api/medical-notes/{response.get_json()['note']['note_id']}"
+    original = medical_notes.versioned_update
+    raced = []
+
+    def racing_update(model, key, *args, **kwargs):
+        # Another request replaces the note between this one's read and write
+        if len(raced) < 2:
+            db.session.execute(update(model).where(key).values(note_details=f'Other {len(raced)}',
+                                                               version=model.version + 1))
+            raced.append(True)
+        return original(model, key, *args, **kwargs)
+
+    monkeypatch.setattr(medical_notes, 'versioned_update', racing_update)
+    response = client.put(url, headers=people['doctor'], json={'note_details': 'Without If-Match'})
+    assert response.status_code == 200
+    assert response.get_json()['note']['version'] == 4
+    # The revision kept is the version the write actually replaced
+    body = client.get(f'{url}/revisions?version=3', headers=people['doctor']).get_json()
+    assert [entry['note_details'] for entry in body['revisions']] == ['Other 1']
+
+    # With If-Match the client named the version it replaces
+    raced.clear()
+    response = client.put(url, headers=dict(people['doctor'], **{'If-Match': '"4"'}),
+                          json={'note_details': 'With If-Match'})
+    assert response.status_code == 412
+    assert response.headers['ETag'] == '"5"'
+
+
+def test_unconditional_update_that_keeps_losing_is_retried_later(client, people, monkeypatch):
+    from src.routes import medical_notes
+    response = client.post('/api/medical-notes', headers=people['doctor'], json={
+        'patient_id': people['patient_id'], 'note_date': '2031-03-04', 'note_details': 'Initial consultation'
+    })
+    url = f"/api/medical-notes/{response.get_json()['note']['note_id']}"
+    original = medical_notes.versioned_update
+
+    def always_racing_update(model, key, *args, **kwargs):
+        db.session.execute(update(model).where(key).values(version=model.version + 1))
+        return original(model, key, *args, **kwargs)
+
+    monkeypatch.setattr(medical_notes, 'versioned_update', always_racing_update)
+    response = client.put(url, headers=people['doctor'], json={'note_details': 'Without If-Match'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(medical_notes.UNCONDITIONAL_UPDATE_RETRY_AFTER)
+
+    monkeypatch.setattr(medical_notes, 'versioned_update', original)
+    body = client.get(url, headers=people['doctor']).get_json()
+    assert (body['note_details'], body['version']) == ('Initial consultation', 1)
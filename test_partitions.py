@@ -0,0 +1,160 @@
+"""
+Appointment partitions and archival.
+
+Archival runs on any database. The partition tests need PostgreSQL and
+check with EXPLAIN that queries bounded by appointment_date only read the
+matching monthly partition.
+
+The PostgreSQL tests run with `pytest --postgres`.
+"""
+import os
+import re
+from datetime import date, time
+
+import pytest
+from flask import current_app
+from sqlalchemy import select, text
+
+from src.models.user import db, Appointment
+from src import partitions
+
+POSTGRESQL = (os.environ.get('TEST_DATABASE_URL') or '').startswith('postgresql')
+
+postgresql_only = pytest.mark.skipif(not POSTGRESQL, reason='Partitioning needs PostgreSQL')
+
+THIS_MONTH = date.today().replace(day=1)
+
+
+@pytest.fixture
+def people(make_patient, make_doctor):
+    return make_patient().patient_id, make_doctor().doctor_id
+
+
+def book(patient_id, doctor_id, day):
+    appointment = Appointment(patient_id=patient_id, doctor_id=doctor_id, appointment_date=day,
+                              appointment_time=time(9, 30), reason='Check-up')
+    db.session.add(appointment)
+    db.session.commit()
+    return appointment.appointment_id
+
+
+def scanned_tables(statement):
+    sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    plan = '\n'.join(db.session.execute(text(f'EXPLAIN {sql}')).scalars())
+    return set(re.findall(r' on (appointments_\w+)', plan))
+
+
+def stored_in(appointment_id):
+    return db.session.execute(text('SELECT tableoid::regclass::text FROM appointments WHERE appointment_id = :id'),
+                              {'id': appointment_id}).scalar()
+
+
+@postgresql_only
+def test_partitions_exist_ahead(context):
+    months_ahead = current_app.config['APPOINTMENT_PARTITION_MONTHS_AHEAD']
+    names = {name for name, month in partitions.monthly_partitions()}
+    for offset in range(months_ahead + 1):
+        assert partitions.partition_name(partitions._add_months(THIS_MONTH, offset)) in names
+
+
+@postgresql_only
+def test_date_range_reads_one_partition(context):
+    month = partitions._add_months(THIS_MONTH, 1)
+    statement = select(Appointment.appointment_id).where(
+        Appointment.doctor_id == 1,
+        Appointment.appointment_date >= month,
+        Appointment.appointment_date < partitions._add_months(month, 1)
+    )
+    assert scanned_tables(statement) == {partitions.partition_name(month)}
+
+
+@postgresql_only
+def test_slot_lookup_reads_one_partition(context):
+    day = partitions._add_months(THIS_MONTH, 2).replace(day=14)
+    statement = select(Appointment.appointment_id).where(
+        Appointment.doctor_id == 1, Appointment.appointment_date == day, Appointment.appointment_time == time(9)
+    )
+    assert scanned_tables(statement) == {partitions.partition_name(day)}
+
+
+@postgresql_only
+def test_booking_beyond_horizon_moves_into_new_partition(people):
+    months_ahead = current_app.config['APPOINTMENT_PARTITION_MONTHS_AHEAD']
+    month = partitions._add_months(THIS_MONTH, months_ahead + 6)
+    appointment_id = book(*people, month.replace(day=3))
+    assert stored_in(appointment_id) == partitions.DEFAULT_PARTITION
+
+    assert partitions.ensure_partitions(0, today=month) == [partitions.partition_name(month)]
+    db.session.commit()
+    assert stored_in(appointment_id) == partitions.partition_name(month)
+
+
+def test_archive_moves_old_months(people):
+    patient_id, doctor_id = people
+    old_month = date(2001, 3, 1)
+    if POSTGRESQL:
+        partitions.ensure_partitions(0, today=old_month)
+        db.session.commit()
+    old_id = book(patient_id, doctor_id, old_month.replace(day=12))
+    recent_id = book(patient_id, doctor_id, partitions._add_months(THIS_MONTH, 1).replace(day=12))
+    if POSTGRESQL:
+        assert stored_in(old_id) == partitions.partition_name(old_month)
+
+    summary = partitions.maintain(current_app.config['APPOINTMENT_PARTITION_MONTHS_AHEAD'],
+                                  current_app.config['APPOINTMENT_ARCHIVE_AFTER_MONTHS'])
+    assert summary['archived_rows'] >= 1
+    if POSTGRESQL:
+        assert partitions.partition_name(old_month) in summary['archived_partitions']
+        assert partitions._relkind(partitions.partition_name(old_month)) is None
+
+    remaining = db.session.execute(select(Appointment.appointment_id)
+                                   .where(Appointment.patient_id == patient_id)).scalars().all()
+    assert remaining == [recent_id]
+    archived = partitions.archived_appointments('patient_id', patient_id)
+    assert len(archived) == 1
+    assert archived[0]['appointment_id'] == old_id
+    assert archived[0]['doctor_id'] == doctor_id
+    assert archived[0]['appointment_date'] == '2001-03-12'
+    assert archived[0]['appointment_time'] == '09:30:00'
+    assert archived[0]['reason'] == 'Check-up'
+
+
+def test_archive_is_exported_and_erased_with_either_party(client, people, make_patient, auth_headers):
+    patient_id, doctor_id = people
+    other_patient_id = make_patient().patient_id
+    old_day = date(2001, 3, 12)
+    if POSTGRESQL:
+        partitions.ensure_partitions(0, today=old_day)
+        db.session.commit()
+    first_id = book(patient_id, doctor_id, old_day)
+    second_id = book(other_patient_id, doctor_id, old_day.replace(day=13))
+    partitions.maintain(current_app.config['APPOINTMENT_PARTITION_MONTHS_AHEAD'],
+                        current_app.config['APPOINTMENT_ARCHIVE_AFTER_MONTHS'])
+
+    doctor = auth_headers({'id': doctor_id, 'type': 'doctor'})
+    archived = client.get('/api/gdpr/data-export', headers=doctor).get_json()['data']['archived_appointments']
+    assert sorted(row['appointment_id'] for row in archived) == [first_id, second_id]
+
+    # Erasing the doctor removes them from both patients' archives
+    assert client.delete('/api/gdpr/data-deletion', headers=doctor).status_code == 200
+    assert partitions.archived_appointments('patient_id', patient_id) == []
+    assert partitions.archived_appointments('patient_id', other_patient_id) == []
+
+
+def test_startup_archives_only_when_configured(app, people):
+    old_day = date(2001, 3, 12)
+    if POSTGRESQL:
+        partitions.ensure_partitions(0, today=old_day)
+        db.session.commit()
+    old_id = book(*people, old_day)
+    stored = select(Appointment.appointment_id).where(Appointment.appointment_id == old_id)
+
+    partitions.init_app(app)
+    assert db.session.execute(stored).first() is not None
+
+    app.config['APPOINTMENT_ARCHIVE_AT_STARTUP'] = True
+    try:
+        partitions.init_app(app)
+    finally:
+        app.config['APPOINTMENT_ARCHIVE_AT_STARTUP'] = False
+    assert db.session.execute(stored).first() is None
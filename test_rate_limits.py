@@ -0,0 +1,28 @@
+"""
+Rate limits count requests by peer address: a client cannot get a fresh
+allowance by sending its own X-Forwarded-For unless PROXY_FIX_X_FOR says a
+proxy sets it. RATE_LIMIT_ENABLED turns the limits off for benchmarks.
+"""
+import pytest
+
+LOGIN = {'email': 'nobody@example.com', 'password': 'Wrong1!password'}
+
+
+@pytest.fixture
+def limits_disabled(app):
+    app.config['RATE_LIMIT_ENABLED'] = False
+    yield
+    app.config['RATE_LIMIT_ENABLED'] = True
+
+
+def test_forwarded_for_is_not_trusted(client):
+    for n in range(10):
+        headers = {'X-Forwarded-For': f'10.0.0.{n}'}
+        assert client.post('/api/login/patient', json=LOGIN, headers=headers).status_code == 401
+    response = client.post('/api/login/patient', json=LOGIN, headers={'X-Forwarded-For': '10.0.1.1'})
+    assert response.status_code == 429
+
+
+def test_limits_can_be_disabled(client, limits_disabled):
+    for _ in range(12):
+        assert client.post('/api/login/patient', json=LOGIN).status_code == 401
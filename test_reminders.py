@@ -0,0 +1,115 @@
+"""
+Reminder dispatch: one reminder per appointment slot, catch-up after
+downtime, and retries of failed reminders without sending again the ones
+that went out before a batch broke off.
+
+"""
+import itertools
+import os
+import smtplib
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.models.user import db, Appointment
+from src import reminders
+from src.reminders import FileTransport, ReminderDispatcher, SMTPTransport
+
+# Each test gets its own stretch of calendar, away from the other test modules
+_weeks = itertools.count()
+
+
+class FailingTransport:
+    def send(self, reminders):
+        raise OSError('mail server unavailable')
+
+
+class FlakySMTP:
+    """Refuses the second message of a connection and drops it at the fourth"""
+    delivered = []
+
+    def __init__(self, host, port, timeout):
+        self.messages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send_message(self, message):
+        self.messages += 1
+        if self.messages == 2:
+            raise smtplib.SMTPDataError(554, b'Message rejected')
+        if self.messages == 4:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.delivered.append(message['To'])
+
+
+@pytest.fixture
+def now():
+    return datetime(2032, 3, 1, 12, 0) + timedelta(weeks=next(_weeks))
+
+
+@pytest.fixture
+def appointments(make_patient, make_doctor, now):
+    """One appointment an hour from 3 hours ago to 40 hours ahead"""
+    patient, doctor = make_patient(), make_doctor()
+    starts = [now + timedelta(hours=hours, minutes=5) for hours in range(-3, 40)]
+    db.session.add_all([Appointment(patient_id=patient.patient_id, doctor_id=doctor.doctor_id,
+                                    appointment_date=start.date(), appointment_time=start.time())
+                        for start in starts])
+    db.session.commit()
+    return starts
+
+
+@pytest.fixture
+def outbox():
+    return tempfile.mkdtemp()
+
+
+def dispatcher(transport):
+    return ReminderDispatcher(transport, lead_hours=24, batch_size=5, max_concurrency=2)
+
+
+def test_reminds_each_upcoming_appointment_once(now, appointments, outbox):
+    due = [start for start in appointments if now < start <= now + timedelta(hours=24)]
+
+    stats = dispatcher(FileTransport(outbox, 'clinic@example.com')).run_once(now)
+    assert stats['sent'] == len(due)
+    assert stats['batches'] == -(-len(due) // 5)
+    assert len(os.listdir(outbox)) == len(due)
+
+    assert dispatcher(FileTransport(outbox, 'clinic@example.com')).run_once(now)['sent'] == 0
+
+
+def test_catches_up_after_downtime(now, appointments, outbox):
+    transport = FileTransport(outbox, 'clinic@example.com')
+    dispatcher(transport).run_once(now)
+
+    # Six hours later only the appointments that entered the window are due
+    assert dispatcher(transport).run_once(now + timedelta(hours=6))['sent'] == 6
+    assert len(os.listdir(outbox)) == 30
+
+
+def test_retries_failed_batches(now, appointments, outbox):
+    assert dispatcher(FailingTransport()).run_once(now)['failed'] == 24
+
+    stats = dispatcher(FileTransport(outbox, 'clinic@example.com')).run_once(now)
+    assert stats['sent'] == 24
+    assert len(os.listdir(outbox)) == 24
+
+
+def test_sent_reminders_survive_a_broken_batch(monkeypatch, now, appointments, outbox):
+    monkeypatch.setattr(reminders.smtplib, 'SMTP', FlakySMTP)
+    FlakySMTP.delivered = []
+    # Five batches: 5, 5, 5, 5 and 4 reminders, two of each delivered
+    stats = dispatcher(SMTPTransport('localhost', 25, 'clinic@example.com')).run_once(now)
+    assert (stats['sent'], stats['failed']) == (10, 14)
+    assert len(FlakySMTP.delivered) == 10
+
+    # Only the refused and unsent ones are tried again
+    stats = dispatcher(FileTransport(outbox, 'clinic@example.com')).run_once(now)
+    assert stats['sent'] == 14
+    assert len(os.listdir(outbox)) == 14
@@ -0,0 +1,96 @@
+"""
+Token revocation: refresh tokens rotate and can be used once, a refresh
+token reused after another worker rotated it is refused by the database,
+logout revokes both tokens, revocations reach other workers with the
+next sync, and rows of expired tokens are purged by later revocations.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from flask_jwt_extended import decode_token
+
+from src.models.user import db, RevokedToken
+from src.token_revocation import RevocationList, revoked_tokens
+
+PASSWORD = 'Rev0ke!tokens'
+
+
+@pytest.fixture
+def login(client):
+    email = f'revoke-{uuid.uuid4().hex[:12]}@example.com'
+    response = client.post('/api/register/patient', json={
+        'first_name': 'Revoke', 'last_name': 'Patient', 'email': email, 'password': PASSWORD})
+    assert response.status_code == 201
+    response = client.post('/api/login/patient', json={'email': email, 'password': PASSWORD})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_refresh_rotation(client, login):
+    response = client.post('/api/token/refresh', headers=bearer(login['refresh_token']))
+    assert response.status_code == 200
+    rotated = response.get_json()
+    assert rotated['refresh_token'] != login['refresh_token']
+    assert client.get('/api/profile', headers=bearer(rotated['access_token'])).status_code == 200
+
+    # Each refresh token works once
+    assert client.post('/api/token/refresh', headers=bearer(login['refresh_token'])).status_code == 401
+    assert client.post('/api/token/refresh', headers=bearer(rotated['refresh_token'])).status_code == 200
+
+
+def test_reuse_before_sync_is_refused(client, context, login, app):
+    revoked_tokens.configure(sync_seconds=float('inf'))
+    try:
+        assert client.post('/api/token/refresh', headers=bearer(login['refresh_token'])).status_code == 200
+        # A worker that has not synced yet does not know the token was rotated
+        revoked_tokens._expiry.clear()
+        response = client.post('/api/token/refresh', headers=bearer(login['refresh_token']))
+        assert response.status_code == 401
+        assert response.get_json() == {'error': 'Token has been revoked'}
+    finally:
+        revoked_tokens.configure(sync_seconds=app.config['TOKEN_REVOCATION_SYNC_SECONDS'])
+        revoked_tokens.rebuild()
+
+
+def test_logout(client, login):
+    response = client.post('/api/logout', headers=bearer(login['access_token']),
+                           json={'refresh_token': login['refresh_token']})
+    assert response.status_code == 200
+    assert client.get('/api/profile', headers=bearer(login['access_token'])).status_code == 401
+    assert client.post('/api/token/refresh', headers=bearer(login['refresh_token'])).status_code == 401
+    # Logging out again is harmless but the token no longer authenticates
+    assert client.post('/api/logout', headers=bearer(login['access_token'])).status_code == 401
+
+
+def test_revocation_reaches_other_workers(client, context, login):
+    other_worker = RevocationList()
+    other_worker.configure(sync_seconds=float('inf'))
+    other_worker.rebuild()
+    jti = decode_token(login['access_token'])['jti']
+
+    assert client.post('/api/logout', headers=bearer(login['access_token'])).status_code == 200
+    assert not other_worker.is_revoked(jti)
+    # The next sync picks it up
+    other_worker.configure(sync_seconds=0)
+    assert other_worker.is_revoked(jti)
+
+
+def test_expired_rows_are_purged(app, client, context, login):
+    expired_jti = str(uuid.uuid4())
+    db.session.add(RevokedToken(jti=expired_jti, token_type='access',
+                                expires_at=datetime.utcnow() - timedelta(minutes=1)))
+    db.session.commit()
+
+    revoked_tokens.configure(sync_seconds=app.config['TOKEN_REVOCATION_SYNC_SECONDS'], purge_seconds=0)
+    try:
+        assert client.post('/api/logout', headers=bearer(login['access_token'])).status_code == 200
+    finally:
+        revoked_tokens.configure(sync_seconds=app.config['TOKEN_REVOCATION_SYNC_SECONDS'],
+                                 purge_seconds=app.config['TOKEN_REVOCATION_PURGE_SECONDS'])
+    assert RevokedToken.query.filter_by(jti=expired_jti).first() is None
+    assert RevokedToken.query.filter_by(jti=decode_token(login['access_token'])['jti']).first() is not None
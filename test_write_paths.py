@@ -0,0 +1,209 @@
+"""
+Statement counts for the write endpoints.
+
+Creates, updates and deletes rely on constraints instead of pre-checks and
+get their response from RETURNING, so each is a single statement. SQLite
+cannot put DML in a CTE and reads patient/doctor names with one more
+SELECT; PostgreSQL joins them in the same statement.
+
+Medical note updates and deletes also write the version they replace to the
+revision history: the update reads it first and inserts it afterwards, the
+delete inserts it from RETURNING.
+
+Listings join the patient and doctor names into the one SELECT rather than
+loading them per row.
+
+Savepoints opened by the test harness are not counted.
+"""
+import re
+import uuid
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from src.models.user import db
+from src.token_revocation import revoked_tokens
+
+PASSWORD = 'Wr1te!Paths'
+
+SAVEPOINT = re.compile(r'(RELEASE |ROLLBACK TO )?SAVEPOINT ', re.IGNORECASE)
+
+
+@pytest.fixture(autouse=True)
+def revocation_sync(app):
+    # The revocation list syncs at most once a second; keep that out of the counts
+    revoked_tokens.configure(sync_seconds=float('inf'))
+    yield
+    revoked_tokens.configure(sync_seconds=app.config['TOKEN_REVOCATION_SYNC_SECONDS'])
+
+
+@pytest.fixture
+def count_statements(app):
+    with app.app_context():
+        engine = db.engine
+
+    @contextmanager
+    def count():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not SAVEPOINT.match(statement):
+                statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+    return count
+
+
+@pytest.fixture(scope='module')
+def name_lookups(app):
+    with app.app_context():
+        return 0 if db.engine.dialect.name == 'postgresql' else 1
+
+
+@pytest.fixture
+def accounts(client, make_patient, make_doctor, auth_headers):
+    patient = make_patient(first_name='Write')
+    doctor = make_doctor(first_name='Write')
+    return {
+        'client': client,
+        'patient_email': patient.email,
+        'patient_id': patient.patient_id,
+        'doctor_id': doctor.doctor_id,
+        'patient': auth_headers(patient),
+        'doctor': auth_headers(doctor)
+    }
+
+
+def test_register_patient(count_statements, accounts):
+    client = accounts['client']
+    with count_statements() as statements:
+        response = client.post('/api/register/patient', json={
+            'first_name': 'New', 'last_name': 'Patient', 'email': f'new-{uuid.uuid4().hex[:8]}@example.com',
+            'password': PASSWORD, 'date_of_birth': '1990-05-06'
+        })
+    assert response.status_code == 201
+    assert len(statements) == 1
+
+    with count_statements() as statements:
+        response = client.post('/api/register/patient', json={
+            'first_name': 'Dup', 'last_name': 'Patient', 'email': accounts['patient_email'], 'password': PASSWORD
+        })
+    assert response.status_code == 400
+    assert len(statements) == 1
+
+
+def test_register_doctor(count_statements, accounts):
+    with count_statements() as statements:
+        response = accounts['client'].post('/api/register/doctor', json={
+            'first_name': 'New', 'last_name': 'Doctor', 'email': f'new-{uuid.uuid4().hex[:8]}@example.com',
+            'password': PASSWORD
+        })
+    assert response.status_code == 201
+    assert len(statements) == 1
+
+
+def test_appointment_writes(count_statements, accounts, name_lookups):
+    client = accounts['client']
+    body = {'doctor_id': accounts['doctor_id'], 'appointment_date': '2031-03-04', 'appointment_time': '09:00'}
+
+    with count_statements() as statements:
+        response = client.post('/api/appointments', headers=accounts['patient'], json=body)
+    assert response.status_code == 201
+    assert len(statements) == 1 + name_lookups
+    appointment = response.get_json()['appointment']
+    assert appointment['doctor_name'] == 'Write Doctor'
+
+    with count_statements() as statements:
+        response = client.post('/api/appointments', headers=accounts['patient'], json=body)
+    assert response.status_code == 400
+    assert len(statements) == 1
+
+    with count_statements() as statements:
+        response = client.post('/api/appointments', headers=accounts['patient'], json=dict(body, doctor_id=999999))
+    assert response.status_code == 404
+    assert len(statements) == 1
+
+    url = f"/api/appointments/{appointment['appointment_id']}"
+    with count_statements() as statements:
+        response = client.put(url, headers=dict(accounts['doctor'], **{'If-Match': '"1"'}),
+                              json={'appointment_time': '09:30'})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"2"'
+    assert len(statements) == 1 + name_lookups
+
+    # A stale version costs one more SELECT to tell 412 from 404/403
+    with count_statements() as statements:
+        response = client.put(url, headers=dict(accounts['doctor'], **{'If-Match': '"1"'}), json={'reason': 'x'})
+    assert response.status_code == 412
+    assert len(statements) == 2
+
+    with count_statements() as statements:
+        response = client.delete(url, headers=accounts['patient'])
+    assert response.status_code == 200
+    assert len(statements) == 1
+
+
+def test_medical_note_writes(count_statements, accounts, name_lookups):
+    client = accounts['client']
+
+    with count_statements() as statements:
+        response = client.post('/api/medical-notes', headers=accounts['doctor'], json={
+            'patient_id': accounts['patient_id'], 'note_date': '2031-03-04', 'note_details': 'Checkup'
+        })
+    assert response.status_code == 201
+    assert len(statements) == 1 + name_lookups
+    note = response.get_json()['note']
+    assert note['patient_name'] == 'Write Patient'
+
+    with count_statements() as statements:
+        response = client.post('/api/medical-notes', headers=accounts['doctor'], json={
+            'patient_id': 999999, 'note_date': '2031-03-04'
+        })
+    assert response.status_code == 404
+    assert len(statements) == 1
+
+    url = f"/api/medical-notes/{note['note_id']}"
+    with count_statements() as statements:
+        response = client.put(url, headers=accounts['doctor'], json={'treatment': 'Rest'})
+    assert response.status_code == 200
+    assert len(statements) == 3 + name_lookups
+
+    with count_statements() as statements:
+        response = client.delete(url, headers=accounts['doctor'])
+    assert response.status_code == 200
+    assert len(statements) == 2
+
+
+def test_rectification(count_statements, accounts):
+    with count_statements() as statements:
+        response = accounts['client'].put('/api/gdpr/data-rectification', headers=accounts['patient'],
+                                          json={'phone': '+44 20 7946 0000', 'date_of_birth': '1985-01-02'})
+    assert response.status_code == 200
+    assert len(statements) == 1
+
+
+def test_listings(count_statements, accounts):
+    client = accounts['client']
+    for day in range(1, 4):
+        client.post('/api/appointments', headers=accounts['patient'], json={
+            'doctor_id': accounts['doctor_id'], 'appointment_date': f'2031-03-{day:02d}',
+            'appointment_time': '09:00', 'reason': 'Check-up'})
+        client.post('/api/medical-notes', headers=accounts['doctor'], json={
+            'patient_id': accounts['patient_id'], 'note_date': f'2024-03-{day:02d}',
+            'note_details': 'Follow-up', 'medication': 'None', 'treatment': 'Rest'})
+
+    # The names are joined in, not loaded per row
+    for url, headers, statement_count in (('/api/appointments', 'patient', 1),
+                                          ('/api/medical-notes', 'doctor', 1),
+                                          (f"/api/medical-notes/patient/{accounts['patient_id']}", 'doctor', 2)):
+        with count_statements() as statements:
+            response = client.get(url, headers=accounts[headers])
+        assert response.status_code == 200
+        assert len(response.get_json()) == 3
+        assert response.get_json()[0]['patient_name'] == 'Write Patient'
+        assert len(statements) == statement_count
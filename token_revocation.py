@@ -0,0 +1,148 @@
+"""
+Per-worker revocation list of JWT ids.
+
+Access tokens are short-lived and refresh tokens are revoked on logout and
+rotation. Revoked token ids are written to the ``revoked_tokens`` table and
+held in memory until the token would have expired anyway, so the check on
+every protected request is a dict lookup. Other workers pick up new
+revocations with one indexed primary-key range query per sync interval,
+the same way the email filters pick up new registrations. Rows of tokens
+that have expired are deleted as new revocations are written, at most once
+every ``TOKEN_REVOCATION_PURGE_SECONDS`` per worker.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, select
+from src.models.user import db, RevokedToken
+
+# Ids are assigned at insert but become visible at commit, so a sync also
+# rereads a few ids below the watermark to catch late commits.
+_SYNC_OVERLAP = 100
+
+# Expired rows deleted by one purge during a request
+PURGE_BATCH_SIZE = 1000
+
+
+class RevocationList:
+    """Unexpired revoked token ids for this worker"""
+
+    def __init__(self):
+        self.sync_seconds = 1.0
+        self.purge_seconds = 300.0
+        self._last_purge = 0.0
+        self._expiry = {}  # jti -> expiry (epoch seconds)
+        self._heap = []  # (expiry, jti), for eviction in expiry order
+        self._watermark = 0
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, sync_seconds=1.0, purge_seconds=300.0):
+        self.sync_seconds = sync_seconds
+        self.purge_seconds = purge_seconds
+
+    def _remember(self, jti, expires):
+        if jti not in self._expiry:
+            self._expiry[jti] = expires
+            heapq.heappush(self._heap, (expires, jti))
+
+    def _evict(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, jti = heapq.heappop(heap)
+            self._expiry.pop(jti, None)
+
+    def _load(self, query):
+        for row_id, jti, expires_at in query:
+            self._remember(jti, expires_at.replace(tzinfo=timezone.utc).timestamp())
+            self._watermark = max(self._watermark, row_id)
+
+    def rebuild(self):
+        """Load every unexpired revocation, replacing the current list"""
+        now = datetime.utcnow()
+        rows = (db.session.query(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at)
+                .filter(RevokedToken.expires_at > now)
+                .order_by(RevokedToken.id))
+        with self._lock:
+            self._expiry = {}
+            self._heap = []
+            self._watermark = db.session.query(db.func.max(RevokedToken.id)).scalar() or 0
+            self._load(rows)
+            self._last_sync = time.monotonic()
+
+    def sync_due(self):
+        return time.monotonic() - self._last_sync >= self.sync_seconds
+
+    def sync(self):
+        """Pull in revocations made by other workers since the last sync.
+
+        Runs at most once per ``sync_seconds``; requests in between only
+        touch memory.
+        """
+        now = time.monotonic()
+        if now - self._last_sync < self.sync_seconds or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sync = now
+            self._load(db.session.query(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at)
+                       .filter(RevokedToken.id > self._watermark - _SYNC_OVERLAP)
+                       .order_by(RevokedToken.id)
+                       .all())
+            self._evict(time.time())
+        finally:
+            self._lock.release()
+
+    def is_revoked(self, jti):
+        self.sync()
+        expires = self._expiry.get(jti)
+        return expires is not None and expires > time.time()
+
+    def revoke(self, jwt_payload):
+        """Revoke a decoded token until it expires; the caller commits"""
+        jti = jwt_payload['jti']
+        expires = jwt_payload.get('exp')
+        if expires is None:
+            return
+        db.session.add(RevokedToken(
+            jti=jti,
+            token_type=jwt_payload.get('type', 'access'),
+            expires_at=datetime.utcfromtimestamp(expires)
+        ))
+        with self._lock:
+            self._remember(jti, expires)
+            purge = time.monotonic() - self._last_purge >= self.purge_seconds
+            if purge:
+                self._last_purge = time.monotonic()
+        if purge:
+            self.purge_expired(limit=PURGE_BATCH_SIZE)
+
+    def purge_expired(self, limit=None):
+        """Delete rows for tokens that have expired, at most ``limit``; the caller commits"""
+        now = datetime.utcnow()
+        if limit is None:
+            return RevokedToken.query.filter(RevokedToken.expires_at <= now).delete()
+        expired = select(RevokedToken.id).where(RevokedToken.expires_at <= now).limit(limit)
+        return db.session.execute(delete(RevokedToken).where(RevokedToken.id.in_(expired))).rowcount
+
+    def stats(self):
+        return {'revoked': len(self._expiry), 'watermark': self._watermark}
+
+
+revoked_tokens = RevocationList()
+
+
+def init_app(app, jwt):
+    """Load the revocation list and register the per-request check"""
+    revoked_tokens.configure(sync_seconds=app.config.get('TOKEN_REVOCATION_SYNC_SECONDS', 1.0),
+                             purge_seconds=app.config.get('TOKEN_REVOCATION_PURGE_SECONDS', 300.0))
+
+    @jwt.token_in_blocklist_loader
+    def check_if_token_revoked(jwt_header, jwt_payload):
+        return revoked_tokens.is_revoked(jwt_payload['jti'])
+
+    with app.app_context():
+        revoked_tokens.purge_expired()
+        db.session.commit()
+        revoked_tokens.rebuild()
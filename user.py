@@ -15,6 +15,9 @@ class Patient(db.Model):
     phone = db.Column(db.String(50))
     email = db.Column(db.String(255), unique=True, nullable=False)
     password_hash = db.Column(db.Text, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Secret in the calendar feed URL, created on first use
+    calendar_secret = db.Column(db.String(64))
     
     # Relationships
     appointments = db.relationship('Appointment', backref='patient', lazy=True)
@@ -28,13 +31,17 @@ class Patient(db.Model):
             'patient_id': self.patient_id,
             'first_name': self.first_name,
             'last_name': self.last_name,
-            'date_of_birth': self.date_of_birth.isoformat() if self.date_of_birth else None,
+            'date_of_birth': self.date_of_birth,
             'gender': self.gender,
             'address': self.address,
             'phone': self.phone,
-            'email': self.email
+            'email': self.email,
+            'version': self.version
         }
 
+    def __json__(self):
+        return self.to_dict()
+
 class Doctor(db.Model):
     __tablename__ = 'doctors'
     
@@ -45,6 +52,9 @@ class Doctor(db.Model):
     phone = db.Column(db.String(50))
     email = db.Column(db.String(255), unique=True, nullable=False)
     password_hash = db.Column(db.Text, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Secret in the calendar feed URL, created on first use
+    calendar_secret = db.Column(db.String(64))
     
     # Relationships
     appointments = db.relationship('Appointment', backref='doctor', lazy=True)
@@ -60,19 +70,30 @@ class Doctor(db.Model):
             'last_name': self.last_name,
             'specialty': self.specialty,
             'phone': self.phone,
-            'email': self.email
+            'email': self.email,
+            'version': self.version
         }
 
+    def __json__(self):
+        return self.to_dict()
+
 class Appointment(db.Model):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'appointment_date', 'appointment_time',
+                            name='uq_appointments_doctor_slot'),
+        # Range scans of upcoming appointments by src.reminders
+        db.Index('ix_appointments_date_time', 'appointment_date', 'appointment_time'),
+    )
     
     appointment_id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patients.patient_id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.patient_id'), nullable=False, index=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.doctor_id'), nullable=False)
     appointment_date = db.Column(db.Date, nullable=False)
     appointment_time = db.Column(db.Time, nullable=False)
     reason = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
         return f'<Appointment {self.appointment_id}>'
@@ -82,16 +103,63 @@ class Appointment(db.Model):
             'appointment_id': self.appointment_id,
             'patient_id': self.patient_id,
             'doctor_id': self.doctor_id,
-            'appointment_date': self.appointment_date.isoformat() if self.appointment_date else None,
-            'appointment_time': self.appointment_time.isoformat() if self.appointment_time else None,
+            'appointment_date': self.appointment_date,
+            'appointment_time': self.appointment_time,
             'reason': self.reason,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'created_at': self.created_at,
+            'version': self.version,
             'patient_name': f"{self.patient.first_name} {self.patient.last_name}" if self.patient else None,
             'doctor_name': f"{self.doctor.first_name} {self.doctor.last_name}" if self.doctor else None
         }
 
+    def __json__(self):
+        return self.to_dict()
+
+class AppointmentArchive(db.Model):
+    """A patient's appointments with one doctor for one month, moved out of the live table by src.partitions"""
+    __tablename__ = 'appointments_archive'
+
+    archive_id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, nullable=False, index=True)
+    period_start = db.Column(db.Date, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    # zlib-compressed JSON: {"columns": [...], "rows": [[...], ...]}
+    payload = db.Column(db.LargeBinary, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<AppointmentArchive {self.patient_id} {self.doctor_id} {self.period_start}>'
+
+class AppointmentReminder(db.Model):
+    """Send-once bookkeeping for src.reminders, keyed by the appointment's slot"""
+    __tablename__ = 'appointment_reminders'
+    __table_args__ = (
+        # A rescheduled appointment gets a new reminder
+        db.UniqueConstraint('appointment_id', 'appointment_date', 'appointment_time',
+                            name='uq_appointment_reminders_slot'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, nullable=False)
+    appointment_date = db.Column(db.Date, nullable=False, index=True)
+    appointment_time = db.Column(db.Time, nullable=False)
+    # claimed -> sent, or failed and claimed again up to REMINDER_MAX_ATTEMPTS
+    status = db.Column(db.String(10), nullable=False, default='claimed')
+    attempts = db.Column(db.Integer, nullable=False, default=1)
+    claimed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<AppointmentReminder {self.appointment_id} {self.status}>'
+
 class MedicalNote(db.Model):
     __tablename__ = 'medical_notes'
+    __table_args__ = (
+        # Per-doctor, per-day counts for src.doctor_stats
+        db.Index('ix_medical_notes_doctor_date', 'doctor_id', 'note_date'),
+    )
     
     note_id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.patient_id'), nullable=False)
@@ -101,6 +169,7 @@ class MedicalNote(db.Model):
     medication = db.Column(db.Text)
     treatment = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __repr__(self):
         return f'<MedicalNote {self.note_id}>'
@@ -110,11 +179,201 @@ class MedicalNote(db.Model):
             'note_id': self.note_id,
             'patient_id': self.patient_id,
             'doctor_id': self.doctor_id,
-            'note_date': self.note_date.isoformat() if self.note_date else None,
+            'note_date': self.note_date,
             'note_details': self.note_details,
             'medication': self.medication,
             'treatment': self.treatment,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'created_at': self.created_at,
+            'version': self.version,
             'patient_name': f"{self.patient.first_name} {self.patient.last_name}" if self.patient else None,
             'doctor_name': f"{self.doctor.first_name} {self.doctor.last_name}" if self.doctor else None
         }
+
+    def __json__(self):
+        return self.to_dict()
+
+class DoctorDailyStats(db.Model):
+    """A doctor's appointment and note counts for one day, kept by src.doctor_stats"""
+    __tablename__ = 'doctor_daily_stats'
+
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    appointments = db.Column(db.Integer, nullable=False, default=0)
+    # Appointments the doctor wrote a note for, for that patient on that day
+    attended = db.Column(db.Integer, nullable=False, default=0)
+    notes = db.Column(db.Integer, nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DoctorDailyStats {self.doctor_id} {self.day}>'
+
+class DoctorStatsChange(db.Model):
+    """A (doctor, day) whose counts changed, appended by triggers on appointments and medical_notes"""
+    __tablename__ = 'doctor_stats_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, nullable=False)
+    day = db.Column(db.Date, nullable=False)
+
+    def __repr__(self):
+        return f'<DoctorStatsChange {self.doctor_id} {self.day}>'
+
+class MedicalNoteRevision(db.Model):
+    """A version of a medical note that an update or delete replaced, kept by src.note_revisions"""
+    __tablename__ = 'medical_note_revisions'
+    __table_args__ = (
+        db.UniqueConstraint('note_id', 'version', name='uq_medical_note_revisions_note_version'),
+    )
+
+    revision_id = db.Column(db.Integer, primary_key=True)
+    # No foreign keys: the history outlives a deleted note
+    note_id = db.Column(db.Integer, nullable=False)
+    patient_id = db.Column(db.Integer, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False)
+    # 'snapshot' or 'delta'; both are zlib-compressed JSON
+    kind = db.Column(db.String(8), nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    replaced_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<MedicalNoteRevision {self.note_id} v{self.version}>'
+
+class NoteAttachment(db.Model):
+    """A file attached to a medical note; the bytes are kept by src.attachment_store"""
+    __tablename__ = 'note_attachments'
+
+    attachment_id = db.Column(db.Integer, primary_key=True)
+    # No foreign keys: like the note's revisions, attachments outlive the note
+    note_id = db.Column(db.Integer, nullable=False, index=True)
+    patient_id = db.Column(db.Integer, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(127), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<NoteAttachment {self.attachment_id}>'
+
+    def to_dict(self):
+        return {
+            'attachment_id': self.attachment_id,
+            'note_id': self.note_id,
+            'patient_id': self.patient_id,
+            'doctor_id': self.doctor_id,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'sha256': self.sha256,
+            'created_at': self.created_at
+        }
+
+    def __json__(self):
+        return self.to_dict()
+
+class AttachmentUpload(db.Model):
+    """A resumable attachment upload in progress; its bytes are staged by src.attachment_store"""
+    __tablename__ = 'attachment_uploads'
+
+    upload_id = db.Column(db.String(32), primary_key=True)
+    note_id = db.Column(db.Integer, nullable=False)
+    patient_id = db.Column(db.Integer, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(127), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    # Bytes written and confirmed so far; the next chunk must start here
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<AttachmentUpload {self.upload_id}>'
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'note_id': self.note_id,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'offset': self.received
+        }
+
+    def __json__(self):
+        return self.to_dict()
+
+class Job(db.Model):
+    """Background work run by src.job_queue workers"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_queue_status_run_at', 'queue', 'status', 'run_at'),
+    )
+
+    job_id = db.Column(db.Integer, primary_key=True)
+    queue = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    # 'patient:<id>' or 'doctor:<id>' of the user who may follow the job
+    owner = db.Column(db.String(64), index=True)
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, succeeded, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # When a queued job may start, or when a running job's lease runs out
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Token of the claim that holds a running job
+    lease = db.Column(db.String(32))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.job_id} {self.name}>'
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+    def __json__(self):
+        return self.to_dict()
+
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    token_type = db.Column(db.String(10), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<RevokedToken {self.jti}>'
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.UniqueConstraint('identity', 'idempotency_key', name='uq_idempotency_keys_identity_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    identity = db.Column(db.String(64), nullable=False)
+    idempotency_key = db.Column(db.String(255), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # NULL while the first request is still running
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.identity} {self.idempotency_key}>'